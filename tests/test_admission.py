@@ -0,0 +1,98 @@
+import unittest
+from unittest import mock
+from tlex import admission, logs
+from tlex.admission import FORGET_AFTER, AdmissionControl
+
+class Clock:
+    # Stands in for the time module in tlex.admission and tlex.logs.
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        for module in (admission, logs):
+            patcher = mock.patch.object(module, 'time', self.clock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_saturated(self):
+        control = AdmissionControl(max_connections=2)
+        self.assertIsNone(control.admit('10.0.0.1'))
+        self.assertIsNone(control.admit('10.0.0.2'))
+        self.assertEqual(control.admit('10.0.0.3'), 'saturated')
+        control.release('10.0.0.1')
+        self.assertIsNone(control.admit('10.0.0.3'))
+        self.assertEqual(control.active, 2)
+
+    def test_per_source_cap(self):
+        control = AdmissionControl(max_per_source=2)
+        self.assertIsNone(control.admit('10.0.0.1'))
+        self.assertIsNone(control.admit('10.0.0.1'))
+        self.assertEqual(control.admit('10.0.0.1'), 'source_limit')
+        self.assertIsNone(control.admit('10.0.0.2'))
+        control.release('10.0.0.1')
+        self.assertIsNone(control.admit('10.0.0.1'))
+
+    def test_per_source_rate(self):
+        control = AdmissionControl(rate_per_source=2)
+        # Bursts of twice the rate, then rate per second.
+        for _ in range(4):
+            self.assertIsNone(control.admit('10.0.0.1'))
+        self.assertEqual(control.admit('10.0.0.1'), 'source_rate')
+        self.assertIsNone(control.admit('10.0.0.2'))
+        self.clock.now += 0.5
+        self.assertIsNone(control.admit('10.0.0.1'))
+        self.assertEqual(control.admit('10.0.0.1'), 'source_rate')
+
+    def test_penalty_doubles_up_to_the_maximum(self):
+        control = AdmissionControl(auth_penalty=1, max_auth_penalty=5)
+        for penalty in (1, 2, 4, 5, 5):
+            control.auth_failed('10.0.0.1')
+            self.assertEqual(control.admit('10.0.0.1'), 'auth_penalty')
+            self.clock.now += penalty - 0.01
+            self.assertEqual(control.admit('10.0.0.1'), 'auth_penalty')
+            self.clock.now += 0.01
+            self.assertIsNone(control.admit('10.0.0.1'))
+            control.release('10.0.0.1')
+        self.assertIsNone(control.admit('10.0.0.2'))
+
+    def test_success_resets_the_penalty(self):
+        control = AdmissionControl(auth_penalty=1)
+        for _ in range(3):
+            control.auth_failed('10.0.0.1')
+        control.auth_succeeded('10.0.0.1')
+        control.auth_failed('10.0.0.1')
+        self.assertEqual(control.sources['10.0.0.1'].failures, 1)
+        self.assertEqual(control.sources['10.0.0.1'].blocked_until, self.clock.now + 1)
+
+    def test_failures_are_forgotten(self):
+        control = AdmissionControl(auth_penalty=1)
+        for _ in range(3):
+            control.auth_failed('10.0.0.1')
+        self.clock.now += FORGET_AFTER + 1
+        control.auth_failed('10.0.0.1')
+        self.assertEqual(control.sources['10.0.0.1'].failures, 1)
+
+    def test_no_penalty(self):
+        control = AdmissionControl(auth_penalty=0)
+        control.auth_failed('10.0.0.1')
+        self.assertIsNone(control.admit('10.0.0.1'))
+
+    def test_prune_keeps_busy_and_penalised_sources(self):
+        control = AdmissionControl(auth_penalty=1)
+        control.admit('10.0.0.1')
+        control.admit('10.0.0.2')
+        control.release('10.0.0.2')
+        control.auth_failed('10.0.0.3')
+        control.prune()
+        self.assertEqual(set(control.sources), {'10.0.0.1', '10.0.0.3'})
+        self.clock.now += FORGET_AFTER + 1
+        control.prune()
+        self.assertEqual(set(control.sources), {'10.0.0.1'})
+
+if __name__ == '__main__':
+    unittest.main()
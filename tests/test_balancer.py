@@ -0,0 +1,124 @@
+import asyncio
+import time
+import unittest
+from tlex.balancer import Balancer, Endpoint, parse_endpoint
+
+def endpoints(*weights):
+    return [Endpoint(f"10.0.0.{i}", 443, weight) for i, weight in enumerate(weights, 1)]
+
+class ParseEndpointTest(unittest.TestCase):
+    def test_forms(self):
+        for item in ("example.com:8443", ["example.com", 8443, 2], {"host": "example.com", "port": 8443, "weight": 2}):
+            endpoint = parse_endpoint(item)
+            self.assertEqual((endpoint.host, endpoint.port), ("example.com", 8443))
+        self.assertEqual(parse_endpoint("[::1]:8443").host, "::1")
+        self.assertEqual(parse_endpoint("example.com").port, 443)
+        self.assertEqual(parse_endpoint(["example.com", 443, 0]).weight, 1)
+
+class PickTest(unittest.TestCase):
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            Balancer(endpoints(1), 'random')
+
+    def test_latency_measures_new_endpoints_first(self):
+        a, b, c = endpoints(1, 1, 1)
+        balancer = Balancer([a, b, c])
+        balancer.success(a, 0.05)
+        balancer.success(b, 0.01)
+        self.assertIs(balancer.pick(), c)
+        balancer.success(c, 0.03)
+        self.assertIs(balancer.pick(), b)
+        self.assertIs(balancer.pick(exclude={b}), c)
+
+    def test_least_conn_weighs_active_connections(self):
+        a, b = endpoints(1, 3)
+        balancer = Balancer([a, b], 'least_conn')
+        a.active, b.active = 1, 2
+        self.assertIs(balancer.pick(), b)
+        b.active = 4
+        self.assertIs(balancer.pick(), a)
+
+    def test_round_robin_is_smooth_and_weighted(self):
+        a, b = endpoints(3, 1)
+        balancer = Balancer([a, b], 'round_robin')
+        picks = [balancer.pick() for _ in range(8)]
+        self.assertEqual(picks.count(a), 6)
+        self.assertEqual(picks.count(b), 2)
+        # Smooth: the light endpoint is not starved until the end of a cycle.
+        self.assertIn(b, picks[:4])
+
+    def test_nothing_left(self):
+        a, b = endpoints(1, 1)
+        self.assertIsNone(Balancer([a, b]).pick(exclude={a, b}))
+
+class EjectionTest(unittest.TestCase):
+    def test_ejects_after_consecutive_failures(self):
+        a, b = endpoints(1, 1)
+        balancer = Balancer([a, b], eject_after=2, eject_time=30)
+        balancer.failure(a)
+        self.assertTrue(a.available(time.monotonic()))
+        balancer.failure(a)
+        self.assertFalse(a.available(time.monotonic()))
+        self.assertIs(balancer.pick(), b)
+
+    def test_success_readmits(self):
+        a, b = endpoints(1, 1)
+        balancer = Balancer([a, b], eject_after=1)
+        balancer.failure(a)
+        balancer.success(a, 0.01)
+        self.assertTrue(a.available(time.monotonic()))
+        self.assertEqual((a.failures, a.ejections), (0, 0))
+
+    def test_repeat_ejections_double(self):
+        a, b = endpoints(1, 1)
+        balancer = Balancer([a, b], eject_after=1, eject_time=10)
+        balancer.failure(a)
+        first = a.ejected_until - time.monotonic()
+        # Failing while still ejected does not extend it.
+        balancer.failure(a)
+        self.assertAlmostEqual(a.ejected_until - time.monotonic(), first, delta=1)
+        a.ejected_until = 0
+        balancer.failure(a)
+        self.assertAlmostEqual(a.ejected_until - time.monotonic(), 2 * first, delta=1)
+
+    def test_single_endpoint_is_never_ejected(self):
+        a, = endpoints(1)
+        balancer = Balancer([a], eject_after=1)
+        balancer.failure(a)
+        self.assertTrue(a.available(time.monotonic()))
+
+    def test_all_ejected_picks_first_due_back(self):
+        a, b = endpoints(1, 1)
+        balancer = Balancer([a, b], eject_after=1, eject_time=30)
+        balancer.failure(b)
+        balancer.failure(a)
+        a.ejected_until += 60
+        self.assertIs(balancer.pick(), b)
+
+class HealthLoopTest(unittest.TestCase):
+    def test_survives_any_probe_error(self):
+        healthy, *broken = endpoints(1, 1, 1, 1, 1)
+        errors = dict(zip(broken, (OSError("refused"), EOFError(), asyncio.TimeoutError(), RuntimeError("bug"))))
+        balancer = Balancer([healthy, *broken], eject_after=100)
+
+        async def probe(endpoint):
+            if endpoint in errors:
+                raise errors[endpoint]
+            return 0.01
+
+        async def main():
+            task = asyncio.create_task(balancer.health_loop(probe, 0.01))
+            await asyncio.sleep(0.1)
+            self.assertFalse(task.done())
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(main())
+        self.assertEqual(healthy.failures, 0)
+        self.assertEqual(healthy.rtt, 0.01)
+        for endpoint in broken:
+            self.assertGreater(endpoint.failures, 1)
+
+if __name__ == '__main__':
+    unittest.main()
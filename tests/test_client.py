@@ -0,0 +1,61 @@
+import asyncio
+import time
+import unittest
+from tlex.client import TunnelClient
+from tlex.protocol import MAGIC, STATUS_OK, ReplayCache, build_reply, read_hello
+
+class HealthProbeTest(unittest.TestCase):
+    async def start_servers(self):
+        async def hang_up(reader, writer):
+            writer.close()
+
+        async def answer(reader, writer):
+            await reader.readexactly(len(MAGIC))
+            hello = await read_hello(reader, 'pw', ReplayCache())
+            writer.write(build_reply('pw', hello.nonce, STATUS_OK))
+            await writer.drain()
+            writer.close()
+
+        closing = await asyncio.start_server(hang_up, '127.0.0.1', 0)
+        healthy = await asyncio.start_server(answer, '127.0.0.1', 0)
+        return closing, healthy
+
+    def client(self, *servers):
+        ports = [server.sockets[0].getsockname()[1] for server in servers]
+        client = TunnelClient(passwd='pw', use_ssl=False, protocol='plain', servers=[f"127.0.0.1:{port}" for port in ports], eject_after=2)
+        client.balancer = client.create_balancer()
+        return client
+
+    def test_hang_up_is_a_connection_error(self):
+        async def main():
+            closing, healthy = await self.start_servers()
+            client = self.client(closing, healthy)
+            with self.assertRaises(ConnectionError):
+                await client.probe_endpoint(client.balancer.endpoints[0])
+            self.assertGreater(await client.probe_endpoint(client.balancer.endpoints[1]), 0)
+            closing.close()
+            healthy.close()
+
+        asyncio.run(main())
+
+    def test_health_loop_ejects_server_that_hangs_up(self):
+        async def main():
+            closing, healthy = await self.start_servers()
+            client = self.client(closing, healthy)
+            bad, good = client.balancer.endpoints
+            task = asyncio.create_task(client.balancer.health_loop(client.probe_endpoint, 0.01))
+            await asyncio.sleep(0.3)
+            self.assertFalse(task.done())
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            closing.close()
+            healthy.close()
+            return bad, good
+
+        bad, good = asyncio.run(main())
+        self.assertFalse(bad.available(time.monotonic()))
+        self.assertTrue(good.available(time.monotonic()))
+        self.assertIsNotNone(good.rtt)
+
+if __name__ == '__main__':
+    unittest.main()
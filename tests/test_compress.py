@@ -0,0 +1,38 @@
+import os
+import unittest
+from tlex.compress import CODECS, MAX_FRAME_INPUT, codec_available
+
+class CodecTest(unittest.TestCase):
+    def frames(self):
+        yield b'x'
+        yield b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n' * 100
+        yield os.urandom(MAX_FRAME_INPUT)
+        yield bytes(MAX_FRAME_INPUT)
+
+    def check_round_trip(self, name):
+        sender, receiver = CODECS[name](), CODECS[name]()
+        for data in self.frames():
+            self.assertEqual(receiver.decompress(sender.compress(data)), data)
+
+    def check_oversize(self, name):
+        # A peer may put anything in a frame; expanding past the limit is an error.
+        bomb = CODECS[name]().compress(bytes(16 * MAX_FRAME_INPUT))
+        with self.assertRaises(ValueError):
+            CODECS[name]().decompress(bomb)
+
+    def test_zlib(self):
+        self.check_round_trip('zlib')
+        self.check_oversize('zlib')
+
+    @unittest.skipUnless(codec_available('zstd'), "zstandard is not installed")
+    def test_zstd(self):
+        self.check_round_trip('zstd')
+        self.check_oversize('zstd')
+
+    @unittest.skipUnless(codec_available('lz4'), "lz4 is not installed")
+    def test_lz4(self):
+        self.check_round_trip('lz4')
+        self.check_oversize('lz4')
+
+if __name__ == '__main__':
+    unittest.main()
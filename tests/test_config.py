@@ -0,0 +1,88 @@
+import json
+import os
+import tempfile
+import unittest
+from tlex.client import TunnelClient
+from tlex.config import SCHEMA_VERSION, ConfigError, ConfigStore, TunnelConfig
+from tlex.reverse import ReverseTunnelClient
+from tlex.server import TunnelServer
+
+class ValidationTest(unittest.TestCase):
+    def test_unknown_kind(self):
+        with self.assertRaises(ConfigError):
+            TunnelConfig('socks', {})
+
+    def test_unknown_option(self):
+        with self.assertRaises(ConfigError):
+            TunnelConfig('client', {'local_port': 8080, 'colour': 'blue'})
+
+    def test_wrong_types(self):
+        for options in ({'local_port': '8080'}, {'use_ssl': 1}, {'local_port': True}, {'connect_timeout': None}):
+            with self.assertRaises(ConfigError):
+                TunnelConfig('client', options)
+
+    def test_accepted_types(self):
+        TunnelConfig('client', {'local_port': 8080, 'connect_timeout': 2.5, 'ca_cert': None, 'servers': ['a:443']})
+        TunnelConfig('server', {'handshake_timeout': 10, 'metrics_port': None})
+
+    def test_malformed_record(self):
+        for record in ([], {'kind': 'client', 'options': []}, {'options': {}}):
+            with self.assertRaises(ConfigError):
+                TunnelConfig.from_dict(record)
+
+class RoundTripTest(unittest.TestCase):
+    def check(self, tunnel, **expected):
+        config = TunnelConfig.from_tunnel(tunnel)
+        config = TunnelConfig.from_dict(json.loads(json.dumps(config.to_dict())))
+        rebuilt = config.build()
+        self.assertIs(type(rebuilt), type(tunnel))
+        self.assertEqual(TunnelConfig.from_tunnel(rebuilt, config.id).key(), config.key())
+        for name, value in expected.items():
+            self.assertEqual(config.options[name], value)
+            self.assertEqual(getattr(rebuilt, name), value)
+
+    def test_client(self):
+        self.check(TunnelClient(local_port=9000, server_host='example.com', passwd='pw', mux=True, mux_connections=4, servers=['a:443', 'b:443']), local_port=9000, mux_connections=4, servers=['a:443', 'b:443'])
+
+    def test_server(self):
+        self.check(TunnelServer('0.0.0.0', 9443, None, None, 'pw', False, 'plain', auth_penalty=2.5), listen_port=9443, auth_penalty=2.5)
+
+    def test_reverse_client_keeps_mux_connections(self):
+        self.check(ReverseTunnelClient(server_host='example.com', passwd='pw', mux=True, mux_connections=3, pool_max=8), mux_connections=3, pool_max=8)
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'configs.json')
+
+    def test_add_replace_remove(self):
+        store = ConfigStore(self.path)
+        config = TunnelConfig('client', {'local_port': 8080, 'passwd': 'pw'})
+        store.add(config)
+        config.options['local_port'] = 8081
+        store.replace(config)
+        loaded = ConfigStore(self.path).load()
+        self.assertEqual([(c.id, c.options) for c in loaded], [(config.id, {'local_port': 8081, 'passwd': 'pw'})])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        store.remove(config.id)
+        self.assertEqual(ConfigStore(self.path).load(), [])
+        with self.assertRaises(KeyError):
+            store.replace(config)
+
+    def test_bad_records_are_skipped(self):
+        good = TunnelConfig('server', {'listen_port': 443})
+        with open(self.path, 'w') as f:
+            json.dump({'version': SCHEMA_VERSION, 'tunnels': [good.to_dict(), {'kind': 'client', 'options': {'local_port': 'x'}}]}, f)
+        self.assertEqual([c.id for c in ConfigStore(self.path).load()], [good.id])
+        with self.assertRaises(ConfigError):
+            ConfigStore(self.path).load(strict=True)
+
+    def test_newer_schema(self):
+        with open(self.path, 'w') as f:
+            json.dump({'version': SCHEMA_VERSION + 1, 'tunnels': []}, f)
+        with self.assertRaises(ConfigError):
+            ConfigStore(self.path).load()
+
+if __name__ == '__main__':
+    unittest.main()
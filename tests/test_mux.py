@@ -0,0 +1,198 @@
+import asyncio
+import unittest
+from tlex.mux import HEADER, OPEN, DATA, RST, WINDOW, INITIAL_WINDOW, MAX_FRAME, MAX_CONTROL_FRAME, MuxSession, decode_target, encode_target
+
+class Pipe:
+    # One end of an in-memory connection with the calls MuxSession uses.
+    def __init__(self):
+        self.buffer = bytearray()
+        self.readable = asyncio.Event()
+        self.closed = False
+        self.peer = None
+
+    @classmethod
+    def pair(cls):
+        a, b = cls(), cls()
+        a.peer, b.peer = b, a
+        return a, b
+
+    async def readexactly(self, size):
+        while len(self.buffer) < size:
+            if self.closed:
+                raise asyncio.IncompleteReadError(bytes(self.buffer), size)
+            self.readable.clear()
+            await self.readable.wait()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def sendall(self, data):
+        if self.closed:
+            raise ConnectionResetError("Pipe closed")
+        self.peer.buffer += data
+        self.peer.readable.set()
+
+    def close(self):
+        for end in (self, self.peer):
+            end.closed = True
+            end.readable.set()
+
+async def read_frame(conn):
+    type_, stream_id, length = HEADER.unpack(await conn.readexactly(HEADER.size))
+    return type_, stream_id, await conn.readexactly(length)
+
+def frame(type_, stream_id, payload=b''):
+    return HEADER.pack(type_, stream_id, len(payload)) + payload
+
+class TargetTest(unittest.TestCase):
+    def test_round_trip(self):
+        self.assertEqual(decode_target(encode_target('example.com', 443)), ('example.com', 443))
+        self.assertEqual(decode_target(encode_target('', 0)), ('', 0))
+
+    def test_malformed(self):
+        for payload in (b'', b'\x05abc', encode_target('example.com', 443) + b'x', b'\x02\xff\xfe\x00\x50'):
+            with self.assertRaises(ValueError):
+                decode_target(payload)
+
+class SessionTest(unittest.TestCase):
+    def run_session(self, test, open_handler=None):
+        # Runs a server-side session against a raw peer that writes frames.
+        async def main():
+            conn, peer = Pipe.pair()
+            session = MuxSession(conn, False, open_handler)
+            task = asyncio.create_task(session.run())
+            try:
+                await test(session, peer, task)
+            finally:
+                session.close()
+                await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(main())
+
+    def check_closes(self, data):
+        async def test(session, peer, task):
+            await peer.sendall(data)
+            await asyncio.wait_for(task, 1)
+            self.assertTrue(session.closed)
+
+        self.run_session(test)
+
+    def test_oversized_data_frame_closes_session(self):
+        self.check_closes(HEADER.pack(DATA, 1, MAX_FRAME + 1))
+
+    def test_oversized_control_frame_closes_session(self):
+        self.check_closes(HEADER.pack(OPEN, 1, MAX_CONTROL_FRAME + 1))
+
+    def test_window_frame_must_be_four_bytes(self):
+        self.check_closes(frame(WINDOW, 1, b'\x00\x01\x00'))
+
+    def test_open_from_wrong_half_is_reset(self):
+        opened = []
+
+        async def handler(stream, host, port):
+            opened.append(stream.stream_id)
+
+        async def test(session, peer, task):
+            # This is the server side, which opens the even ids itself.
+            await peer.sendall(frame(OPEN, 2, encode_target('example.com', 80)))
+            self.assertEqual(await asyncio.wait_for(read_frame(peer), 1), (RST, 2, b''))
+            await peer.sendall(frame(OPEN, 1, encode_target('example.com', 80)))
+            await asyncio.sleep(0.05)
+            self.assertEqual(opened, [1])
+            self.assertFalse(task.done())
+
+        self.run_session(test, handler)
+
+    def test_malformed_open_resets_only_that_stream(self):
+        async def handler(stream, host, port):
+            await stream.sendall(f"{host}:{port}".encode())
+
+        async def test(session, peer, task):
+            await peer.sendall(frame(OPEN, 1, encode_target('example.com', 80)))
+            self.assertEqual(await asyncio.wait_for(read_frame(peer), 1), (DATA, 1, b'example.com:80'))
+            await peer.sendall(frame(OPEN, 3, b'\x04\xff\xfe\xfd\xfc\x00\x50'))
+            self.assertEqual(await asyncio.wait_for(read_frame(peer), 1), (RST, 3, b''))
+            await peer.sendall(frame(OPEN, 5, b'\x09short'))
+            self.assertEqual(await asyncio.wait_for(read_frame(peer), 1), (RST, 5, b''))
+            self.assertFalse(session.closed)
+            self.assertIn(1, session.streams)
+
+        self.run_session(test, handler)
+
+class StreamTest(unittest.TestCase):
+    def run_pair(self, test, open_handler):
+        async def main():
+            client_conn, server_conn = Pipe.pair()
+            client = MuxSession(client_conn, True)
+            server = MuxSession(server_conn, False, open_handler)
+            tasks = [asyncio.create_task(client.run()), asyncio.create_task(server.run())]
+            try:
+                await asyncio.wait_for(test(client, server), 5)
+            finally:
+                client.close()
+                server.close()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run(main())
+
+    def test_echo_and_fin(self):
+        async def echo(stream, host, port):
+            while data := await stream.recv(65536):
+                await stream.sendall(data)
+            stream.write_eof()
+
+        async def test(client, server):
+            stream = client.open_stream('example.com', 80)
+            await stream.sendall(b'hello')
+            self.assertEqual(await stream.recv(100), b'hello')
+            stream.write_eof()
+            self.assertEqual(await stream.recv(100), b'')
+
+        self.run_pair(test, echo)
+
+    def test_window_blocks_sender_until_peer_reads(self):
+        release = asyncio.Event()
+        received = []
+
+        async def slow_reader(stream, host, port):
+            await release.wait()
+            while data := await stream.recv(65536):
+                received.append(len(data))
+
+        async def test(client, server):
+            stream = client.open_stream('example.com', 80)
+            sender = asyncio.create_task(stream.sendall(bytes(INITIAL_WINDOW + MAX_FRAME)))
+            await asyncio.sleep(0.1)
+            self.assertFalse(sender.done())
+            self.assertEqual(stream.send_window, 0)
+            release.set()
+            await sender
+            stream.write_eof()
+            while sum(received) < INITIAL_WINDOW + MAX_FRAME:
+                await asyncio.sleep(0.01)
+
+        self.run_pair(test, slow_reader)
+
+    def test_reset_reaches_the_peer(self):
+        opened = asyncio.Event()
+        streams = []
+
+        async def handler(stream, host, port):
+            streams.append(stream)
+            opened.set()
+            await stream.recv(1)
+
+        async def test(client, server):
+            stream = client.open_stream('example.com', 80)
+            await opened.wait()
+            streams[0].close()
+            self.assertEqual(await stream.recv(100), b'')
+            self.assertTrue(stream.reset)
+            with self.assertRaises(ConnectionResetError):
+                await stream.sendall(b'late')
+            self.assertNotIn(stream.stream_id, client.streams)
+
+        self.run_pair(test, handler)
+
+if __name__ == '__main__':
+    unittest.main()
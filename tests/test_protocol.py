@@ -0,0 +1,130 @@
+import asyncio
+import unittest
+from unittest import mock
+from tlex import protocol
+from tlex.protocol import MAGIC, FLAG_MUX, FLAG_POOL, MAX_CLOCK_SKEW, STATUS_OK, STATUS_UDP, STATUS_REJECTED, REJECT, REJECT_V1, ReplayCache, build_hello, build_reply, read_hello, read_reply
+
+class Clock:
+    # Stands in for the time module inside tlex.protocol.
+    def __init__(self, wall=1700000000.0, mono=1000.0):
+        self.wall = wall
+        self.mono = mono
+
+    def time(self):
+        return self.wall
+
+    def monotonic(self):
+        return self.mono
+
+    def advance(self, seconds):
+        self.wall += seconds
+        self.mono += seconds
+
+def feed(read, data, *args):
+    # Runs read against a stream holding exactly data.
+    async def main():
+        conn = asyncio.StreamReader()
+        conn.feed_data(data)
+        conn.feed_eof()
+        return await read(conn, *args)
+
+    return asyncio.run(main())
+
+def parse_hello(data, passwd, cache):
+    # Strips MAGIC the way the server does before calling read_hello.
+    assert data.startswith(MAGIC)
+    return feed(read_hello, data[len(MAGIC):], passwd, cache)
+
+class HelloTest(unittest.TestCase):
+    def test_round_trip(self):
+        for host in ('example.com', '192.0.2.1', '2001:db8::1', ''):
+            data, nonce = build_hello('pw', host, 8443, FLAG_MUX)
+            hello = parse_hello(data, 'pw', ReplayCache())
+            self.assertEqual((hello.host, hello.port, hello.nonce), (host, 8443, nonce))
+            self.assertTrue(hello.mux)
+            self.assertFalse(hello.pool)
+
+    def test_pool_flag(self):
+        data, _ = build_hello('pw', '', 0, FLAG_POOL)
+        self.assertTrue(parse_hello(data, 'pw', ReplayCache()).pool)
+
+    def test_wrong_password(self):
+        data, _ = build_hello('pw', 'example.com', 443)
+        self.assertIsNone(parse_hello(data, 'other', ReplayCache()))
+
+    def test_tampered_target(self):
+        data, _ = build_hello('pw', 'example.com', 443)
+        data = data.replace(b'example.com', b'example.org')
+        self.assertIsNone(parse_hello(data, 'pw', ReplayCache()))
+
+    def test_replay(self):
+        cache = ReplayCache()
+        data, _ = build_hello('pw', 'example.com', 443)
+        self.assertIsNotNone(parse_hello(data, 'pw', cache))
+        self.assertIsNone(parse_hello(data, 'pw', cache))
+
+    def test_clock_skew(self):
+        clock = Clock()
+        with mock.patch.object(protocol, 'time', clock):
+            data, _ = build_hello('pw', 'example.com', 443)
+            clock.advance(MAX_CLOCK_SKEW + 1)
+            self.assertIsNone(parse_hello(data, 'pw', ReplayCache()))
+
+    def test_truncated(self):
+        data, _ = build_hello('pw', 'example.com', 443)
+        with self.assertRaises(asyncio.IncompleteReadError):
+            parse_hello(data[:-1], 'pw', ReplayCache())
+
+class ReplyTest(unittest.TestCase):
+    def read(self, data, passwd='pw', nonce=bytes(16)):
+        return feed(read_reply, data, passwd, nonce)
+
+    def test_round_trip(self):
+        nonce = bytes(range(16))
+        for status in (STATUS_OK, STATUS_UDP):
+            self.assertEqual(self.read(build_reply('pw', nonce, status), nonce=nonce), status)
+
+    def test_bad_mac(self):
+        self.assertIsNone(self.read(build_reply('other', bytes(16), STATUS_OK)))
+        self.assertIsNone(self.read(build_reply('pw', bytes(range(16)), STATUS_OK)))
+
+    def test_reject(self):
+        self.assertEqual(self.read(REJECT), STATUS_REJECTED)
+
+    def test_v1_server(self):
+        with self.assertRaises(ConnectionRefusedError):
+            self.read(REJECT_V1)
+
+class ReplayCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(protocol, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_entries_expire_after_twice_the_skew(self):
+        cache = ReplayCache()
+        self.assertTrue(cache.check(b'a', self.clock.wall))
+        self.clock.advance(2 * MAX_CLOCK_SKEW - 1)
+        self.assertTrue(cache.check(b'b', self.clock.wall))
+        self.assertEqual(list(cache.seen), [b'a', b'b'])
+        self.clock.advance(1)
+        self.assertTrue(cache.check(b'c', self.clock.wall))
+        self.assertEqual(list(cache.seen), [b'b', b'c'])
+
+    def test_full_cache_evicts_oldest(self):
+        cache = ReplayCache(max_size=2)
+        for nonce in (b'a', b'b', b'c'):
+            self.assertTrue(cache.check(nonce, self.clock.wall))
+        self.assertEqual(list(cache.seen), [b'b', b'c'])
+        self.assertFalse(cache.check(b'c', self.clock.wall))
+
+    def test_skew_in_either_direction(self):
+        cache = ReplayCache()
+        self.assertFalse(cache.check(b'a', self.clock.wall + MAX_CLOCK_SKEW + 1))
+        self.assertFalse(cache.check(b'b', self.clock.wall - MAX_CLOCK_SKEW - 1))
+        self.assertTrue(cache.check(b'c', self.clock.wall - MAX_CLOCK_SKEW))
+        self.assertEqual(list(cache.seen), [b'c'])
+
+if __name__ == '__main__':
+    unittest.main()
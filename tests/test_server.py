@@ -0,0 +1,76 @@
+import asyncio
+import socket
+import threading
+import time
+import unittest
+from tlex.mux import encode_target
+from tlex.server import TunnelServer
+
+def start_echo():
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            with conn:
+                while data := conn.recv(65536):
+                    conn.sendall(data)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener
+
+class V1HandshakeTest(unittest.TestCase):
+    # v1 clients send the password as soon as they connect, and pooled or
+    # probing ones send nothing else until later; that must not look like a
+    # client that never finished its handshake.
+    def setUp(self):
+        self.echo = start_echo()
+
+    def tearDown(self):
+        self.echo.close()
+
+    def start_server(self, passwd):
+        server = TunnelServer('127.0.0.1', 0, None, None, passwd, False, 'plain', handshake_timeout=0.5, auth_penalty=30)
+        server.setup()
+        threading.Thread(target=lambda: asyncio.run(server.serve()), daemon=True).start()
+        self.addCleanup(server.stop)
+        while server.metrics is None:
+            time.sleep(0.01)
+        return server
+
+    def check_idle_v1_client(self, passwd):
+        server = self.start_server(passwd)
+        conn = socket.create_connection(server.listener.getsockname())
+        conn.settimeout(3)
+        with conn:
+            conn.sendall(passwd.encode('utf-8'))
+            time.sleep(1)
+            conn.sendall(encode_target('127.0.0.1', self.echo.getsockname()[1]))
+            self.assertEqual(conn.recv(len(passwd)) if passwd else b'', passwd.encode('utf-8'))
+            conn.sendall(b'ping')
+            self.assertEqual(conn.recv(4), b'ping')
+        self.assertEqual(server.admission.sources['127.0.0.1'].failures, 0)
+
+    def test_short_password(self):
+        self.check_idle_v1_client('pw')
+
+    def test_one_byte_password(self):
+        self.check_idle_v1_client('p')
+
+    def test_empty_password(self):
+        self.check_idle_v1_client('')
+
+    def test_silent_client_is_penalised(self):
+        server = self.start_server('password')
+        conn = socket.create_connection(server.listener.getsockname())
+        conn.settimeout(3)
+        with conn:
+            self.assertEqual(conn.recv(1), b'')
+        self.assertEqual(server.admission.sources['127.0.0.1'].failures, 1)
+        self.assertEqual(server.metrics.snapshot().get('handshake_timeouts_total'), 1)
+
+if __name__ == '__main__':
+    unittest.main()
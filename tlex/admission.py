@@ -0,0 +1,97 @@
+import asyncio
+import threading
+import time
+from tlex.logs import Throttle
+
+# Penalties double with each failed handshake in a row, up to the maximum;
+# a source that stays clean for FORGET_AFTER seconds starts over.
+FORGET_AFTER = 600
+# Sources tracked at once; beyond this, idle ones are pruned on admit.
+MAX_SOURCES = 65536
+PRUNE_INTERVAL = 60
+
+class Source:
+    __slots__ = ('active', 'rate', 'failures', 'blocked_until', 'last_failure')
+
+    def __init__(self, rate):
+        self.active = 0
+        self.rate = rate
+        self.failures = 0
+        self.blocked_until = 0
+        self.last_failure = 0
+
+class AdmissionControl:
+    # Decides at accept time, before any TLS work, whether a connection gets
+    # a slot. admit() returns None or the reason for turning it away.
+    # Workers each keep their own, so per-source limits apply per process.
+    def __init__(self, max_connections=1024, max_per_source=0, rate_per_source=0, auth_penalty=1, max_auth_penalty=300):
+        self.max_connections = max_connections
+        self.max_per_source = max_per_source
+        self.rate_per_source = rate_per_source
+        self.auth_penalty = auth_penalty
+        self.max_auth_penalty = max_auth_penalty
+        self.active = 0
+        self.sources = {}
+        # SSH authentication reports failures from executor threads.
+        self.lock = threading.Lock()
+
+    def source(self, ip):
+        source = self.sources.get(ip)
+        if source is None:
+            if len(self.sources) >= MAX_SOURCES:
+                self.prune()
+            source = self.sources[ip] = Source(Throttle(self.rate_per_source) if self.rate_per_source else None)
+        return source
+
+    def admit(self, ip):
+        now = time.monotonic()
+        with self.lock:
+            if self.active >= self.max_connections:
+                return 'saturated'
+            source = self.source(ip)
+            if source.blocked_until > now:
+                return 'auth_penalty'
+            if self.max_per_source and source.active >= self.max_per_source:
+                return 'source_limit'
+            if source.rate and not source.rate.allow():
+                return 'source_rate'
+            source.active += 1
+            self.active += 1
+        return None
+
+    def release(self, ip):
+        with self.lock:
+            self.active -= 1
+            source = self.sources.get(ip)
+            if source:
+                source.active -= 1
+
+    def auth_failed(self, ip):
+        if not self.auth_penalty:
+            return
+        now = time.monotonic()
+        with self.lock:
+            source = self.source(ip)
+            if now - source.last_failure > FORGET_AFTER:
+                source.failures = 0
+            source.failures += 1
+            source.last_failure = now
+            source.blocked_until = now + min(self.auth_penalty * 2 ** (source.failures - 1), self.max_auth_penalty)
+
+    def auth_succeeded(self, ip):
+        with self.lock:
+            source = self.sources.get(ip)
+            if source:
+                source.failures = 0
+
+    def prune(self):
+        now = time.monotonic()
+        for ip, source in list(self.sources.items()):
+            if source.active == 0 and source.blocked_until <= now and now - source.last_failure > FORGET_AFTER:
+                del self.sources[ip]
+
+    async def prune_loop(self):
+        while True:
+            await asyncio.sleep(PRUNE_INTERVAL)
+            with self.lock:
+                self.prune()
@@ -0,0 +1,112 @@
+# tlex/balancer.py
+import asyncio
+import time
+from tlex.probe import parse_target
+from tlex.utils import logger
+
+POLICIES = ('latency', 'least_conn', 'round_robin')
+# Weight of the newest sample in the smoothed round-trip time.
+RTT_ALPHA = 0.3
+MAX_EJECT_DOUBLINGS = 4
+
+class Endpoint:
+    def __init__(self, host, port, weight=1):
+        self.host = host
+        self.port = port
+        self.weight = max(weight, 1)
+        self.active = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+        self.rtt = None
+        self.current_weight = 0
+
+    @property
+    def name(self):
+        return f"{self.host}:{self.port}"
+
+    def available(self, now):
+        return self.ejected_until <= now
+
+def parse_endpoint(item, default_port=443):
+    # Accepts "host[:port]", [host, port, weight] or {"host", "port", "weight"}.
+    if isinstance(item, str):
+        return Endpoint(*parse_target(item, default_port))
+    if isinstance(item, dict):
+        return Endpoint(item['host'], int(item.get('port', default_port)), int(item.get('weight', 1)))
+    return Endpoint(item[0], int(item[1]) if len(item) > 1 else default_port, int(item[2]) if len(item) > 2 else 1)
+
+class Balancer:
+    # Picks the server endpoint for each new connection. Endpoints that fail
+    # eject_after times in a row sit out eject_time (doubling on repeats)
+    # and come back on the first successful dial or health probe.
+    def __init__(self, endpoints, policy='latency', eject_after=3, eject_time=30):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown balance policy {policy!r}; expected one of {', '.join(POLICIES)}")
+        self.endpoints = endpoints
+        self.policy = policy
+        self.eject_after = eject_after
+        self.eject_time = eject_time
+
+    def pick(self, exclude=()):
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+        if not candidates:
+            return None
+        available = [endpoint for endpoint in candidates if endpoint.available(now)]
+        if not available:
+            # Everything is ejected: trying the one due back first beats refusing.
+            return min(candidates, key=lambda endpoint: endpoint.ejected_until)
+        if len(available) == 1:
+            return available[0]
+        if self.policy == 'least_conn':
+            return min(available, key=lambda endpoint: endpoint.active / endpoint.weight)
+        if self.policy == 'round_robin':
+            # Smooth weighted round-robin, as in nginx.
+            total = 0
+            for endpoint in available:
+                endpoint.current_weight += endpoint.weight
+                total += endpoint.weight
+            chosen = max(available, key=lambda endpoint: endpoint.current_weight)
+            chosen.current_weight -= total
+            return chosen
+        # Unmeasured endpoints go first so that they get measured.
+        return min(available, key=lambda endpoint: (endpoint.rtt or 0, endpoint.active))
+
+    def success(self, endpoint, rtt=None):
+        if endpoint.failures >= self.eject_after:
+            logger.info(f"Server {endpoint.name} re-admitted")
+        endpoint.failures = 0
+        endpoint.ejections = 0
+        endpoint.ejected_until = 0
+        if rtt is not None:
+            endpoint.rtt = rtt if endpoint.rtt is None else endpoint.rtt + RTT_ALPHA * (rtt - endpoint.rtt)
+
+    def failure(self, endpoint):
+        endpoint.failures += 1
+        now = time.monotonic()
+        # Failures while already ejected (health probes, failing open) do not
+        # extend the ejection; the next one after it expires doubles it.
+        if endpoint.failures >= self.eject_after and endpoint.available(now) and len(self.endpoints) > 1:
+            duration = self.eject_time * 2 ** min(endpoint.ejections, MAX_EJECT_DOUBLINGS)
+            endpoint.ejections += 1
+            endpoint.ejected_until = now + duration
+            logger.warning(f"Server {endpoint.name} ejected for {duration}s after {endpoint.failures} failures")
+
+    async def health_loop(self, probe, interval):
+        # probe(endpoint) connects and returns the setup time or raises.
+        async def check(endpoint):
+            # Whatever a probe raises counts against its endpoint; only
+            # cancellation may end the loop.
+            try:
+                self.success(endpoint, await probe(endpoint))
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                logger.debug(f"Health probe to {endpoint.name} failed: {e!r}")
+                self.failure(endpoint)
+            except Exception as e:
+                logger.warning(f"Health probe to {endpoint.name} failed unexpectedly: {e!r}")
+                self.failure(endpoint)
+
+        while True:
+            await asyncio.gather(*(check(endpoint) for endpoint in self.endpoints))
+            await asyncio.sleep(interval)
@@ -0,0 +1,427 @@
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tlex
+from tlex.utils import PipeHandler, AsyncSocket, open_connection
+
+CHUNK = 256 * 1024
+PROTOCOLS = ['plain', 'tls', 'ssh']
+PASSWD = 'tlex-bench'
+REQUEST_SIZE = 64
+REQUEST_TIMEOUT = 10
+# What each startup scenario has to import before it can serve traffic.
+STARTUP_SCENARIOS = {
+    'python': 'pass',
+    'cli': 'import tlex.main',
+    'serve_plain': "import tlex.supervisor; from tlex.config import TunnelConfig; TunnelConfig('server', {'protocol': 'plain', 'use_ssl': False}).build()",
+    'serve_tls': "import tlex.supervisor; from tlex.config import TunnelConfig; TunnelConfig('client', {'protocol': 'tls'}).build()",
+    'serve_ssh': "import tlex.supervisor; from tlex.config import TunnelConfig; TunnelConfig('client', {'protocol': 'ssh'}).build().create_ssh_connection()",
+    'tui': 'import tlex.tui',
+}
+# Appended to each scenario. ru_maxrss survives exec on Linux and would
+# report the benchmark's own size, so prefer the VmHWM of the new image.
+REPORT_RSS = '''
+import resource
+try:
+    print([line.split()[1] for line in open('/proc/self/status') if line.startswith('VmHWM')][0])
+except (OSError, IndexError):
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+# Metrics where a larger value is an improvement; all others are latencies.
+HIGHER_IS_BETTER = ('throughput_mbps', 'setup_rate', 'rate')
+
+def start_sink():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+
+    def drain(conn):
+        with conn:
+            while conn.recv(CHUNK):
+                pass
+
+    def serve():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=drain, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+def send_payload(port, total):
+    payload = b'\0' * CHUNK
+    with socket.create_connection(('127.0.0.1', port)) as conn:
+        sent = 0
+        while sent < total:
+            conn.sendall(payload)
+            sent += len(payload)
+
+async def relay_once(sink_port, total):
+    loop = asyncio.get_running_loop()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    listener.setblocking(False)
+    sender = threading.Thread(target=send_payload, args=(listener.getsockname()[1], total), daemon=True)
+    sender.start()
+    sock, _ = await loop.sock_accept(listener)
+    listener.close()
+    src = AsyncSocket(sock)
+    dst = await open_connection('127.0.0.1', sink_port)
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    pipe = PipeHandler.splice_pipe if PipeHandler.can_splice(src, dst) else PipeHandler.stream_pipe
+    await pipe(src, dst)
+    elapsed, cpu = time.perf_counter() - start, time.thread_time() - cpu_start
+    src.close()
+    dst.close()
+    return elapsed, cpu
+
+def bench_relay(total, splice):
+    use_splice = PipeHandler.use_splice
+    PipeHandler.use_splice = splice and use_splice
+    try:
+        elapsed, cpu = asyncio.run(relay_once(start_sink(), total))
+    finally:
+        PipeHandler.use_splice = use_splice
+    return {
+        'bench': 'relay',
+        'mode': 'splice' if splice and use_splice else 'copy',
+        'bytes': total,
+        'seconds': round(elapsed, 4),
+        'mbit_per_s': round(total * 8 / elapsed / 1e6, 1),
+        'relay_cpu_seconds': round(cpu, 4),
+    }
+
+def write_self_signed(directory):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256())
+    cert_file, key_file = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    with open(cert_file, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return cert_file, key_file
+
+async def echo_handler(reader, writer):
+    try:
+        while True:
+            data = await reader.read(CHUNK)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+def run_echo(listener):
+    async def serve():
+        server = await asyncio.start_server(echo_handler, sock=listener, limit=CHUNK)
+        await server.serve_forever()
+    asyncio.run(serve())
+
+def start_process(target, *args):
+    # Every component gets its own process so the load generator does not
+    # share an interpreter lock with the tunnel it is measuring.
+    process = multiprocessing.get_context('fork').Process(target=target, args=args, daemon=True)
+    process.start()
+    return process
+
+def start_tunnel(protocol, cert_file, key_file, client_options):
+    from tlex.server import TunnelServer
+    from tlex.client import TunnelClient
+    echo = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    echo.bind(('127.0.0.1', 0))
+    echo.listen(1024)
+    use_ssl = protocol == 'tls'
+    host_key_file = os.path.join(os.path.dirname(cert_file), 'ssh_host_key')
+    server = TunnelServer('127.0.0.1', 0, cert_file, key_file, PASSWD, use_ssl, protocol, backlog=1024, max_connections=4096, ssh_host_key_file=host_key_file)
+    server.setup()
+    server_port = server.listener.getsockname()[1]
+    client = TunnelClient('127.0.0.1', 0, '127.0.0.1', server_port, '127.0.0.1', echo.getsockname()[1], PASSWD, None, use_ssl, protocol, backlog=1024, max_connections=4096, **client_options)
+    client.setup()
+    processes = [start_process(run_echo, echo), start_process(server.run), start_process(client.run)]
+    local_port = client.listener.getsockname()[1]
+    for sock in (echo, server.listener, client.listener):
+        sock.close()
+    return local_port, processes
+
+def stop_tunnel(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+async def request(port, payload):
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(payload)
+        await writer.drain()
+        received = await reader.read(len(payload))
+        if not received:
+            raise ConnectionError("Tunnel closed before the first byte")
+        ttfb = time.perf_counter() - start
+        while len(received) < len(payload):
+            data = await reader.read(len(payload) - len(received))
+            if not data:
+                raise ConnectionError("Tunnel closed mid-response")
+            received += data
+        return ttfb, time.perf_counter() - start
+    finally:
+        writer.close()
+
+async def measure_throughput(port, total):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=CHUNK)
+    payload = b'\0' * CHUNK
+
+    async def send():
+        sent = 0
+        while sent < total:
+            writer.write(payload)
+            await writer.drain()
+            sent += len(payload)
+
+    async def receive():
+        received = 0
+        while received < total:
+            data = await reader.read(CHUNK)
+            if not data:
+                raise ConnectionError("Tunnel closed during transfer")
+            received += len(data)
+
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(asyncio.gather(send(), receive()), REQUEST_TIMEOUT + total / 1e6)
+    finally:
+        writer.close()
+    # Echoed bytes cross the tunnel twice; report the one-way payload rate.
+    return total * 8 / (time.perf_counter() - start) / 1e6
+
+async def measure_level(port, concurrency, duration, max_requests):
+    payload = os.urandom(REQUEST_SIZE)
+    latencies = []
+    errors = {}
+    deadline = time.perf_counter() + duration
+    budget = [max_requests]
+
+    async def worker():
+        while time.perf_counter() < deadline and budget[0] > 0:
+            budget[0] -= 1
+            try:
+                _, elapsed = await asyncio.wait_for(request(port, payload), REQUEST_TIMEOUT)
+                latencies.append(elapsed)
+            except (OSError, asyncio.TimeoutError) as e:
+                name = type(e).__name__
+                errors[name] = errors.get(name, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    level = {'concurrency': concurrency, 'requests': len(latencies), 'errors': errors, 'rate': round(len(latencies) / elapsed, 1)}
+    if latencies:
+        level['p50_ms'] = round(percentile(latencies, 0.5) * 1000, 3)
+        level['p99_ms'] = round(percentile(latencies, 0.99) * 1000, 3)
+    return level
+
+async def measure_single(port, total, samples):
+    payload = os.urandom(REQUEST_SIZE)
+    # The first request also proves the tunnel works before the timed runs.
+    await asyncio.wait_for(request(port, payload), REQUEST_TIMEOUT * 3)
+    ttfbs = []
+    for _ in range(samples):
+        ttfb, _ = await asyncio.wait_for(request(port, payload), REQUEST_TIMEOUT)
+        ttfbs.append(ttfb)
+    return {
+        'ttfb_ms': round(percentile(ttfbs, 0.5) * 1000, 3),
+        'throughput_mbps': round(await measure_throughput(port, total), 1),
+    }
+
+def run_on_tunnel(protocol, client_options, certs, measure, *args):
+    # Each measurement gets a fresh tunnel so earlier runs cannot skew it.
+    port, processes = start_tunnel(protocol, certs[0], certs[1], client_options)
+    try:
+        return asyncio.run(measure(port, *args))
+    finally:
+        stop_tunnel(processes)
+
+def bench_tunnel(protocol, total, levels, duration, samples, max_requests, client_options, certs):
+    try:
+        result = run_on_tunnel(protocol, client_options, certs, measure_single, total, samples)
+    except Exception as e:
+        return {'error': f"{type(e).__name__}: {e}"}
+    result['levels'] = [run_on_tunnel(protocol, client_options, certs, measure_level, concurrency, duration, max_requests) for concurrency in levels]
+    # Sequential connects with one worker are the connection setup rate.
+    result['setup_rate'] = next((level['rate'] for level in result['levels'] if level['concurrency'] == 1), None)
+    return result
+
+def launch(code, importtime=False):
+    # Runs code in a fresh interpreter against this source tree and returns
+    # wall time, peak RSS in KiB and stderr.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(tlex.__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code + REPORT_RSS]
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=root, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return elapsed, int(result.stdout.split()[-1]), result.stderr
+
+def parse_importtime(output, top):
+    total, modules = 0, []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        total += int(self_us)
+        if not name[1:].startswith(' '):
+            modules.append((int(cumulative_us), name.strip()))
+    modules.sort(reverse=True)
+    return total, [{'module': name, 'ms': round(us / 1000, 2)} for us, name in modules[:top]]
+
+def bench_startup(code, samples):
+    try:
+        # The first launch compiles bytecode; it is not a restart.
+        launch(code)
+        runs = [launch(code) for _ in range(samples)]
+        _, _, output = launch(code, importtime=True)
+    except Exception as e:
+        return {'error': f"{type(e).__name__}: {e}"}
+    import_us, top_imports = parse_importtime(output, 5)
+    return {
+        'startup_ms': round(statistics.median(elapsed for elapsed, _, _ in runs) * 1000, 2),
+        'import_ms': round(import_us / 1000, 2),
+        'rss_mb': round(statistics.median(rss for _, rss, _ in runs) / 1024, 1),
+        'top_imports': top_imports,
+    }
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def flatten(results):
+    metrics = {}
+    for protocol, result in results.items():
+        for key in ('ttfb_ms', 'throughput_mbps', 'setup_rate', 'startup_ms', 'import_ms', 'rss_mb'):
+            if result.get(key) is not None:
+                metrics[f"{protocol}.{key}"] = result[key]
+        for level in result.get('levels', []):
+            for key in ('rate', 'p50_ms', 'p99_ms'):
+                if key in level:
+                    metrics[f"{protocol}.c{level['concurrency']}.{key}"] = level[key]
+    return metrics
+
+def compare(baseline, current, threshold):
+    regressions = []
+    old, new = flatten(baseline['results']), flatten(current['results'])
+    for name, value in new.items():
+        if name not in old or not old[name]:
+            continue
+        change = (value - old[name]) / old[name]
+        if name.endswith(HIGHER_IS_BETTER):
+            change = -change
+        if change > threshold:
+            regressions.append({'metric': name, 'baseline': old[name], 'current': value, 'change': round(change, 3)})
+    for protocol, result in current['results'].items():
+        if 'error' in result and 'error' not in baseline['results'].get(protocol, {'error': None}):
+            regressions.append({'metric': f"{protocol}.error", 'baseline': None, 'current': result['error'], 'change': None})
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="T-LeX loopback benchmarks")
+    parser.add_argument("bench", choices=['relay', 'tunnel', 'startup'], help="Benchmark to run")
+    parser.add_argument("--mb", type=int, default=None, help="Megabytes to transfer (relay: 512, tunnel: 64)")
+    parser.add_argument("--protocols", default=','.join(PROTOCOLS), help="Comma-separated protocols for the tunnel bench")
+    parser.add_argument("--levels", default='1,10,100,1000', help="Comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=3, help="Seconds per concurrency level")
+    parser.add_argument("--max-requests", type=int, default=2000, help="Request cap per concurrency level")
+    parser.add_argument("--samples", type=int, default=20, help="Sequential requests for the TTFB median, or launches per startup scenario")
+    parser.add_argument("--scenarios", default=','.join(STARTUP_SCENARIOS), help="Comma-separated scenarios for the startup bench")
+    parser.add_argument("--mux", action='store_true', help="Run the client in multiplexed mode")
+    parser.add_argument("--pool-size", type=int, default=0, help="Client pre-dialed connection pool size")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="Baseline JSON from an earlier tunnel or startup run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change that counts as a regression")
+    args = parser.parse_args(argv)
+    if args.bench == 'relay':
+        results = [bench_relay((args.mb or 512) << 20, splice) for splice in (False, True)]
+    elif args.bench == 'startup':
+        results = {
+            'bench': 'startup',
+            'meta': {
+                'tlex': tlex.__version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                'samples': args.samples,
+            },
+            'results': {scenario: bench_startup(STARTUP_SCENARIOS[scenario], args.samples) for scenario in args.scenarios.split(',')},
+        }
+    else:
+        logging.disable(logging.INFO)
+        raise_fd_limit()
+        levels = [int(level) for level in args.levels.split(',')]
+        client_options = {'mux': args.mux, 'pool_size': args.pool_size}
+        results = {
+            'bench': 'tunnel',
+            'meta': {
+                'tlex': tlex.__version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                'mb': args.mb or 64,
+                'duration': args.duration,
+                'max_requests': args.max_requests,
+                'client_options': client_options,
+            },
+            'results': {},
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            certs = write_self_signed(directory)
+            for protocol in args.protocols.split(','):
+                results['results'][protocol] = bench_tunnel(protocol, (args.mb or 64) << 20, levels, args.duration, args.samples, args.max_requests, client_options, certs)
+    if args.compare and args.bench != 'relay':
+        with open(args.compare) as f:
+            results['regressions'] = compare(json.load(f), results, args.threshold)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if results and isinstance(results, dict) and results.get('regressions'):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,71 @@
 # tlex/client.py
 import socket
-import ssl
-import paramiko
 import subprocess
 import uuid
-from tlex.utils import PipeHandler, BUFFER_SIZE, logger, generate_x25519_keys, generate_wireguard_keys
+import asyncio
+import hmac
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tlex.utils import PipeHandler, AsyncSocket, IdleReaper, BUFFER_SIZE, SSH_WINDOW_SIZE, SSH_MAX_PACKET_SIZE, logger, open_connection, configure_socket, generate_x25519_keys, generate_wireguard_keys
+from tlex.mux import MuxSession, MUX_TARGET, MUX_VERSION, encode_target
+from tlex.pool import ConnectionPool
+from tlex.tls import create_client_context, SessionCache, DEFAULT_CIPHERS, KTLS_SUPPORTED
+from tlex.protocol import FLAG_MUX, FLAG_UDP, FLAG_POOL, CODEC_SHIFT, STATUS_OK, STATUS_UDP, STATUS_COMPRESSED, STATUS_REJECTED, MAX_EARLY_DATA, build_hello, read_reply
+from tlex.compress import CompressedConn, CODEC_IDS, choose_codec
+from tlex.udp import UdpForwarder
+from tlex.metrics import Metrics, MetricsServer, series_key
+from tlex.balancer import Balancer, Endpoint, parse_endpoint
+from tlex.logs import AccessLog
 
 class TunnelClient:
-    def __init__(self, local_host='127.0.0.1', local_port=8080, server_host='', server_port=443, remote_host='', remote_port=80, passwd='', ca_cert=None, use_ssl=True, protocol='tls'):
+    # Class-level defaults keep configs pickled by older versions loadable.
+    async_mode = True
+    backlog = 128
+    max_connections = 1024
+    connect_timeout = 30
+    mux = False
+    mux_connections = 1
+    pool_size = 0
+    pool_max_idle = 60
+    tls_resume = True
+    tls_ciphers = DEFAULT_CIPHERS
+    ecdh_curve = None
+    handshake_version = 2
+    metrics_port = None
+    metrics_host = '127.0.0.1'
+    ssh_username = 'tlex'
+    ssh_window_size = SSH_WINDOW_SIZE
+    ssh_max_packet_size = SSH_MAX_PACKET_SIZE
+    drain_timeout = 30
+    servers = None
+    balance = 'latency'
+    health_interval = 10
+    eject_after = 3
+    eject_time = 30
+    dial_timeout = 5
+    balancer = None
+    health_task = None
+    udp = False
+    udp_idle_timeout = 60
+    udp_sock = None
+    udp_forwarder = None
+    compression = None
+    log_level = None
+    log_rate = 10
+    log_summary_interval = 60
+    idle_timeout = 300
+    tcp_nodelay = True
+    tcp_keepalive = 60
+    socket_buffer = 0
+    ktls = False
+    reaper = None
+    codec = None
+
+    def __init__(self, local_host='127.0.0.1', local_port=8080, server_host='', server_port=443, remote_host='', remote_port=80, passwd='', ca_cert=None, use_ssl=True, protocol='tls', async_mode=True, backlog=128, max_connections=1024, connect_timeout=30, mux=False, mux_connections=1, pool_size=0, pool_max_idle=60, tls_resume=True, tls_ciphers=DEFAULT_CIPHERS, ecdh_curve=None, handshake_version=2, metrics_port=None, metrics_host='127.0.0.1', ssh_username='tlex', ssh_window_size=SSH_WINDOW_SIZE, ssh_max_packet_size=SSH_MAX_PACKET_SIZE, drain_timeout=30, servers=None, balance='latency', health_interval=10, eject_after=3, eject_time=30, dial_timeout=5, udp=False, udp_idle_timeout=60, compression=None, log_level=None, log_rate=10, log_summary_interval=60, idle_timeout=300, tcp_nodelay=True, tcp_keepalive=60, socket_buffer=0, ktls=False):
         self.local_host = local_host
         self.local_port = local_port
         self.server_host = server_host
@@ -18,19 +76,95 @@ class TunnelClient:
         self.ca_cert = ca_cert
         self.use_ssl = use_ssl
         self.protocol = protocol.lower()
-        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT) if protocol == 'tls' else None
-        if self.protocol == 'tls' and self.use_ssl:
-            if self.ca_cert:
-                self.context.load_verify_locations(self.ca_cert)
-                self.context.verify_mode = ssl.CERT_REQUIRED
-            else:
-                self.context.verify_mode = ssl.CERT_NONE
-                self.context.check_hostname = False
+        self.tls_resume = tls_resume
+        self.tls_ciphers = tls_ciphers
+        self.ecdh_curve = ecdh_curve
+        self.context = None
+        self.load_context()
+        self.tls_sessions = SessionCache()
+        self.handshake_version = handshake_version
+        self.server_version = None
+        self.async_mode = async_mode
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.mux = mux
+        self.mux_connections = mux_connections
+        self.pool_size = pool_size
+        self.pool_max_idle = pool_max_idle
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics = None
+        self.metrics_server = None
+        self.ssh_username = ssh_username
+        self.ssh_window_size = ssh_window_size
+        self.ssh_max_packet_size = ssh_max_packet_size
+        # Per-server SSH transports, keyed by endpoint; handle_ssh runs on
+        # executor threads, so creating one is done under ssh_lock.
+        self.ssh = {}
+        self.ssh_lock = threading.Lock()
+        self.drain_timeout = drain_timeout
+        # servers, when given, lists every endpoint as "host:port",
+        # [host, port, weight] or {"host", "port", "weight"}; server_host and
+        # server_port are then only a fallback.
+        self.servers = servers
+        self.balance = balance
+        self.health_interval = health_interval
+        self.eject_after = eject_after
+        self.eject_time = eject_time
+        self.dial_timeout = dial_timeout
+        self.balancer = self.create_balancer()
+        self.health_task = None
+        # udp also forwards UDP arriving on local_port to the same target.
+        self.udp = udp
+        self.udp_idle_timeout = udp_idle_timeout
+        self.udp_sock = None
+        self.udp_forwarder = None
+        # None, 'auto' or a codec name from tlex.compress.
+        self.compression = compression
+        self.log_level = log_level
+        self.log_rate = log_rate
+        self.log_summary_interval = log_summary_interval
+        self.access = None
+        # Same meaning as on TunnelServer.
+        self.idle_timeout = idle_timeout
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_keepalive = tcp_keepalive
+        self.socket_buffer = socket_buffer
+        self.ktls = ktls
+        self.reaper = None
+        self.codec = None
         self.listener = None
+        self.pool = None
         self.is_reverse = False
         self.process = None
+        self.loop = None
+        self.stopping = None
+
+    def create_balancer(self):
+        if self.servers:
+            endpoints = [parse_endpoint(item, self.server_port) for item in self.servers]
+            if not self.server_host:
+                self.server_host, self.server_port = endpoints[0].host, endpoints[0].port
+        else:
+            endpoints = [Endpoint(self.server_host, self.server_port)]
+        return Balancer(endpoints, self.balance, self.eject_after, self.eject_time)
+
+    def describe_servers(self):
+        if self.balancer is None or len(self.balancer.endpoints) == 1:
+            return f"{self.server_host}:{self.server_port}"
+        return f"{', '.join(endpoint.name for endpoint in self.balancer.endpoints)} ({self.balance})"
+
+    def load_context(self):
+        if self.protocol == 'tls' and self.use_ssl:
+            self.context = create_client_context(self.ca_cert, self.tls_ciphers, self.ecdh_curve, self.ktls)
 
     def setup(self):
+        # SSL contexts do not survive a round-trip through the config file.
+        self.load_context()
+        if self.ktls and self.context and not KTLS_SUPPORTED:
+            logger.warning("Kernel TLS needs Python 3.12 or newer; encrypting in user space")
+        self.create_access_log()
         try:
             if self.protocol in ['wireguard', 'vless']:
                 self.setup_advanced()
@@ -38,8 +172,14 @@ class TunnelClient:
                 self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 self.listener.bind((self.local_host, self.local_port))
-                self.listener.listen(5)
-            logger.info(f"Client listening locally on {self.local_host}:{self.local_port} forwarding to {self.remote_host}:{self.remote_port} via {self.server_host}:{self.server_port} (Protocol: {self.protocol.upper()}, SSL: {self.use_ssl})")
+                self.listener.listen(self.backlog)
+                if self.udp and self.protocol in ('tls', 'plain') and self.async_mode:
+                    self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    self.udp_sock.bind((self.local_host, self.local_port))
+                    logger.info(f"Forwarding UDP on {self.local_host}:{self.local_port} as well")
+                elif self.udp:
+                    logger.warning(f"UDP forwarding needs the async TLS or plain protocol; ignoring it for {self.protocol}")
+            logger.info(f"Client listening locally on {self.local_host}:{self.local_port} forwarding to {self.remote_host}:{self.remote_port} via {self.describe_servers()} (Protocol: {self.protocol.upper()}, SSL: {self.use_ssl})")
         except OSError as e:
             logger.error(f"Bind error: {e}. Port may be in use.")
             raise
@@ -121,47 +261,568 @@ AllowedIPs = 0.0.0.0/0
                 time.sleep(1)
         if not self.listener:
             self.setup()
+        if self.async_mode:
+            asyncio.run(self.serve())
+            return
         while True:
             try:
                 local_conn, addr = self.listener.accept()
-                logger.info(f"Accepted local connection from {addr}")
-                
-                server_sock_tmp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                server_sock_tmp.connect((self.server_host, self.server_port))
-                server_conn = server_sock_tmp
-                if self.protocol == 'tls' and self.use_ssl:
-                    server_conn = self.context.wrap_socket(server_sock_tmp, server_hostname=self.server_host)
-                elif self.protocol == 'ssh':
-                    client = paramiko.SSHClient()
-                    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    client.connect(self.server_host, self.server_port, username='user', password=self.passwd)  # Assume SSH auth
-                    server_conn = client.open_sftp()  # Or channel for tunnel
-                
-                server_conn.sendall(self.passwd.encode('utf-8'))
-                
-                host_bytes = self.remote_host.encode('utf-8')
-                host_len = len(host_bytes).to_bytes(1, 'big')
-                port_bytes = self.remote_port.to_bytes(2, 'big')
-                server_conn.sendall(host_len + host_bytes + port_bytes)
-                
-                resp = server_conn.recv(BUFFER_SIZE).decode('utf-8')
-                if resp != self.passwd:
-                    logger.warning("Association failed")
-                    local_conn.close()
-                    server_conn.close()
-                    continue
-                
-                PipeHandler.pipe_sockets(local_conn, server_conn)
-                
-                local_conn.close()
-                server_conn.close()
+                self.handle_blocking(local_conn, addr)
             except Exception as e:
                 logger.error(f"Error in client loop: {e}")
 
+    def create_access_log(self):
+        self.access = AccessLog(f"client {self.local_host}:{self.local_port}", self.log_level, self.log_rate, self.log_summary_interval)
+
+    def tune_socket(self, sock):
+        configure_socket(sock, self.tcp_nodelay, self.tcp_keepalive, self.socket_buffer)
+
+    def handle_blocking(self, local_conn, addr):
+        self.access.connection(addr, self.remote_host, self.remote_port, "Forwarding to")
+        self.tune_socket(local_conn)
+        if self.protocol == 'ssh':
+            self.handle_ssh(local_conn, addr)
+            return
+
+        server_sock_tmp = socket.create_connection((self.server_host, self.server_port), self.connect_timeout)
+        self.tune_socket(server_sock_tmp)
+        server_conn = server_sock_tmp
+        if self.protocol == 'tls' and self.use_ssl:
+            server_conn = self.context.wrap_socket(server_sock_tmp, server_hostname=self.server_host)
+
+        server_conn.sendall(self.passwd.encode('utf-8'))
+
+        host_bytes = self.remote_host.encode('utf-8')
+        host_len = len(host_bytes).to_bytes(1, 'big')
+        port_bytes = self.remote_port.to_bytes(2, 'big')
+        server_conn.sendall(host_len + host_bytes + port_bytes)
+
+        resp = server_conn.recv(BUFFER_SIZE).decode('utf-8')
+        if resp != self.passwd:
+            logger.warning("Association failed")
+            local_conn.close()
+            server_conn.close()
+            return
+        server_conn.settimeout(None)
+
+        PipeHandler.pipe_sockets(local_conn, server_conn)
+
+        local_conn.close()
+        server_conn.close()
+
+    def create_ssh_connection(self, endpoint):
+        # Imported here so only SSH tunnels pay for paramiko.
+        from tlex.ssh import SSHConnection
+        return SSHConnection(endpoint.host, endpoint.port, self.ssh_username, self.passwd, self.ssh_window_size, self.ssh_max_packet_size, self.connect_timeout)
+
+    def handle_ssh(self, local_conn, addr):
+        import paramiko
+        from tlex.ssh import relay_channel
+        start = time.perf_counter()
+        tried = set()
+        while True:
+            endpoint = self.balancer.pick(tried)
+            if endpoint is None:
+                if self.metrics:
+                    self.metrics.inc('connect_errors_total')
+                local_conn.close()
+                return
+            with self.ssh_lock:
+                connection = self.ssh.get(endpoint)
+                if connection is None:
+                    connection = self.ssh[endpoint] = self.create_ssh_connection(endpoint)
+            try:
+                chan = connection.open_channel(self.remote_host, self.remote_port, addr)
+                break
+            except (OSError, EOFError, paramiko.SSHException) as e:
+                self.access.error(addr, e, f"Error opening SSH channel via {endpoint.name} for local")
+                self.balancer.failure(endpoint)
+                tried.add(endpoint)
+        self.balancer.success(endpoint)
+        if self.metrics:
+            self.metrics.observe('connect_seconds', time.perf_counter() - start)
+        endpoint.active += 1
+        try:
+            relay_channel(local_conn, chan, self.metrics)
+        finally:
+            endpoint.active -= 1
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(self.max_connections)
+        self.connections = set()
+        self.session_tasks = set()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_connections) if self.protocol == 'ssh' else None
+        self.mux_sessions = []
+        self.mux_lock = asyncio.Lock()
+        self.mux_supported = self.mux and self.protocol != 'ssh'
+        self.server_version = None
+        self.codec = choose_codec(self.compression)
+        self.codecs_accepted = set()
+        self.codecs_declined = set()
+        self.metrics = Metrics()
+        self.reaper = IdleReaper(self.idle_timeout, self.metrics)
+        self.start_metrics_server()
+        self.start_health_checks()
+        self.ssh = {}
+        if self.pool_size > 0 and self.protocol != 'ssh':
+            self.pool = ConnectionPool(self.connect_pooled, self.pool_size, self.pool_max_idle)
+            self.pool.start()
+        self.listener.setblocking(False)
+        accept_task = asyncio.create_task(self.accept_loop())
+        summary_task = asyncio.create_task(self.access.summary_loop())
+        reaper_task = asyncio.create_task(self.reaper.run())
+        if self.udp_sock:
+            self.udp_forwarder = UdpForwarder(self.udp_sock, self.open_udp, self.udp_idle_timeout, self.metrics)
+            self.udp_forwarder.start()
+        await self.stopping.wait()
+        accept_task.cancel()
+        await asyncio.gather(accept_task, return_exceptions=True)
+        self.listener.close()
+        if self.udp_forwarder:
+            self.udp_forwarder.close()
+            self.udp_forwarder = self.udp_sock = None
+        if self.pool:
+            self.pool.close()
+        self.stop_health_checks()
+        if self.connections:
+            logger.info(f"Draining {len(self.connections)} connections (up to {self.drain_timeout}s)")
+            await asyncio.wait(set(self.connections), timeout=self.drain_timeout)
+        for task in list(self.connections):
+            task.cancel()
+        for session in self.mux_sessions:
+            session.close()
+        await asyncio.gather(*self.connections, *self.session_tasks, return_exceptions=True)
+        summary_task.cancel()
+        reaper_task.cancel()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        for connection in self.ssh.values():
+            connection.close()
+        self.ssh = {}
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    def start_health_checks(self):
+        if self.balancer is None:
+            self.balancer = self.create_balancer()
+        # SSH servers log every bare connect as a failed session, so SSH
+        # endpoints only come back when their ejection runs out.
+        if len(self.balancer.endpoints) > 1 and self.health_interval and self.protocol != 'ssh':
+            self.health_task = asyncio.create_task(self.balancer.health_loop(self.probe_endpoint, self.health_interval))
+
+    def stop_health_checks(self):
+        if self.health_task:
+            self.health_task.cancel()
+            self.health_task = None
+
+    async def probe_endpoint(self, endpoint):
+        # Connect (plus TLS handshake), authenticate like a pooled connection
+        # and hang up: servers penalise clients that leave before
+        # authenticating.
+        start = time.perf_counter()
+        conn = await asyncio.wait_for(open_connection(endpoint.host, endpoint.port), self.dial_timeout)
+        try:
+            if self.protocol == 'tls' and self.use_ssl:
+                await asyncio.wait_for(conn.start_tls(self.context, server_hostname=endpoint.host), self.dial_timeout)
+            rtt = time.perf_counter() - start
+            if self.version() == 1:
+                await conn.sendall(self.passwd.encode('utf-8'))
+            else:
+                await self.authenticate_pooled(conn)
+        except asyncio.IncompleteReadError as e:
+            # Admission resets, penalised sources and pre-v2 servers hang up.
+            raise ConnectionResetError(f"Server closed the connection during the health probe ({e})") from e
+        finally:
+            conn.close()
+        return rtt
+
+    def snapshot(self):
+        stats = self.metrics.snapshot() if self.metrics else {}
+        stats['connections_active'] = len(getattr(self, 'connections', ()))
+        if 'compression_payload_bytes_total' in stats:
+            stats['compression_saved_bytes'] = stats['compression_payload_bytes_total'] - stats['compression_wire_bytes_total']
+        if self.balancer and len(self.balancer.endpoints) > 1:
+            now = time.monotonic()
+            for endpoint in self.balancer.endpoints:
+                labels = {'endpoint': endpoint.name}
+                stats[series_key('endpoint_up', labels)] = int(endpoint.available(now))
+                stats[series_key('endpoint_active', labels)] = endpoint.active
+                stats[series_key('endpoint_ejections', labels)] = endpoint.ejections
+                if endpoint.rtt is not None:
+                    stats[series_key('endpoint_rtt_seconds', labels)] = round(endpoint.rtt, 6)
+        stats['tls_handshakes_total'] = self.tls_sessions.stats['handshakes']
+        stats['tls_resumed_total'] = self.tls_sessions.stats['resumed']
+        if self.pool:
+            stats.update({f"pool_{key}_total": value for key, value in self.pool.stats.items()})
+        return stats
+
+    def start_metrics_server(self):
+        if self.metrics_port is None:
+            return
+        try:
+            self.metrics_server = MetricsServer(self.metrics_host, self.metrics_port, self.snapshot, {'role': 'client', 'tunnel': f"{self.local_host}:{self.local_port}"})
+            self.metrics_server.start()
+        except OSError as e:
+            self.metrics_server = None
+            logger.error(f"Metrics endpoint bind error: {e}")
+
+    async def accept_loop(self):
+        while True:
+            await self.semaphore.acquire()
+            try:
+                sock, addr = await self.loop.sock_accept(self.listener)
+            except OSError as e:
+                self.semaphore.release()
+                logger.error(f"Accept error: {e}")
+                await asyncio.sleep(0.1)
+                continue
+            except BaseException:
+                self.semaphore.release()
+                raise
+            self.metrics.inc('connections_total')
+            self.tune_socket(sock)
+            task = asyncio.create_task(self.handle_connection(sock, addr))
+            self.connections.add(task)
+            task.add_done_callback(self.connection_done)
+
+    def connection_done(self, task):
+        self.connections.discard(task)
+        self.semaphore.release()
+
+    async def handle_connection(self, sock, addr):
+        self.access.record(self.remote_host, self.remote_port)
+        if self.protocol == 'ssh':
+            sock.setblocking(True)
+            try:
+                await self.loop.run_in_executor(self.executor, self.handle_ssh, sock, addr)
+            except Exception as e:
+                self.access.error(addr, e, "Error handling local")
+            finally:
+                sock.close()
+            return
+        local_conn = AsyncSocket(sock)
+        server_conn = None
+        endpoint = None
+        activity = None
+        try:
+            result = await self.open_tunnel(local_conn)
+            if result is None:
+                return
+            server_conn, nonce = result
+            endpoint = getattr(server_conn, 'endpoint', None)
+            if endpoint:
+                endpoint.active += 1
+            activity = self.reaper.track(local_conn, server_conn)
+            await asyncio.gather(
+                PipeHandler.pipe(local_conn, server_conn, self.metrics, 'upstream', activity),
+                self.downstream(server_conn, local_conn, nonce, activity)
+            )
+        except Exception as e:
+            self.access.error(addr, e, "Error handling local")
+        finally:
+            if activity:
+                self.reaper.release(activity)
+            if endpoint:
+                endpoint.active -= 1
+            local_conn.close()
+            if server_conn:
+                server_conn.close()
+
+    async def open_tunnel(self, local_conn):
+        start = time.perf_counter()
+        try:
+            result = None
+            if self.mux_supported:
+                result = await asyncio.wait_for(self.open_mux_stream(), self.connect_timeout)
+            if result is None and self.pool:
+                result = await asyncio.wait_for(self.open_pooled(local_conn), self.connect_timeout)
+            if result is None:
+                result = await asyncio.wait_for(self.dial(self.remote_host, self.remote_port, local_conn), self.connect_timeout)
+        except BaseException:
+            self.metrics.inc('connect_errors_total')
+            raise
+        if result is None:
+            self.metrics.inc('connect_errors_total')
+        else:
+            self.metrics.observe('connect_seconds', time.perf_counter() - start)
+        return result
+
+    async def downstream(self, server_conn, local_conn, nonce, activity=None):
+        # With 0-RTT handshakes the server's reply is checked here, while the
+        # upstream direction is already sending.
+        if nonce is not None:
+            compressed = isinstance(server_conn, CompressedConn)
+            raw_conn = server_conn.raw if compressed else server_conn
+            try:
+                status = await read_reply(raw_conn, self.passwd, nonce)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                status = None
+            if compressed and status == STATUS_OK:
+                self.decline_codec(raw_conn.endpoint, server_conn.codec_name)
+            if status != (STATUS_COMPRESSED if compressed else STATUS_OK):
+                if status == STATUS_REJECTED:
+                    logger.warning("Server rejected the handshake; check the password and the clock")
+                logger.warning(f"Association failed for {self.remote_host}:{self.remote_port} (status {status})")
+                self.metrics.inc('auth_failures_total' if status in (None, STATUS_REJECTED) else 'connect_errors_total')
+                server_conn.close()
+                local_conn.close()
+                return
+            self.remember_session(server_conn)
+        await PipeHandler.pipe(server_conn, local_conn, self.metrics, 'downstream', activity)
+
+    async def open_mux_stream(self):
+        # Up to mux_connections sessions per server; the balancer picks the
+        # server and the least busy of its sessions carries the stream.
+        endpoint = self.balancer.pick()
+        sessions = [session for session in self.mux_sessions if not session.closed]
+        if sum(session.endpoint is endpoint for session in sessions) < self.mux_connections:
+            async with self.mux_lock:
+                sessions = [session for session in self.mux_sessions if not session.closed]
+                if sum(session.endpoint is endpoint for session in sessions) < self.mux_connections and self.mux_supported:
+                    session = await self.start_mux_session()
+                    if session:
+                        sessions.append(session)
+                        # Failover may have placed it on another server.
+                        endpoint = session.endpoint
+            self.mux_sessions = sessions
+        if not sessions:
+            return None
+        session = min(sessions, key=lambda s: (s.endpoint is not endpoint, len(s.streams)))
+        stream = session.open_stream(self.remote_host, self.remote_port)
+        stream.endpoint = session.endpoint
+        return stream, None
+
+    async def start_mux_session(self):
+        server_conn = None
+        try:
+            result = await self.dial(*MUX_TARGET, flags=FLAG_MUX)
+            if result:
+                server_conn = result[0]
+                if self.version() == 1 and await server_conn.readexactly(1) != bytes([MUX_VERSION]):
+                    server_conn.close()
+                    server_conn = None
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if server_conn:
+                server_conn.close()
+            server_conn = None
+        if server_conn is None:
+            logger.warning("Server does not support multiplexing; using one connection per stream")
+            self.mux_supported = False
+            return None
+        session = MuxSession(server_conn, True)
+        session.endpoint = server_conn.endpoint
+        task = asyncio.create_task(session.run())
+        self.session_tasks.add(task)
+        task.add_done_callback(self.session_tasks.discard)
+        logger.info(f"Multiplexed session established to {session.endpoint.name}")
+        return session
+
+    async def open_pooled(self, local_conn):
+        server_conn = self.pool.acquire()
+        if server_conn is None:
+            return None
+        early = local_conn.recv_nowait(MAX_EARLY_DATA) if self.version() > 1 else b''
+        try:
+            return await self.open_target(server_conn, self.remote_host, self.remote_port, early)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.warning(f"Pooled connection to {server_conn.endpoint.name} failed: {e}")
+            self.balancer.failure(server_conn.endpoint)
+            local_conn.unread(early)
+            return None
+
+    def version(self):
+        # Never inferred from a dropped connection: falling back would send
+        # the password in the clear to anyone able to reset one.
+        return 1 if self.handshake_version == 1 else 2
+
+    async def dial(self, host, port, local_conn=None, flags=0):
+        tried = set()
+        while True:
+            server_conn = await self.connect_server(tried)
+            early = local_conn.recv_nowait(MAX_EARLY_DATA) if local_conn and self.version() > 1 else b''
+            try:
+                return await self.open_target(server_conn, host, port, early, flags)
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                if local_conn:
+                    local_conn.unread(early)
+                if self.server_version is None and self.version() > 1 and not isinstance(e, ConnectionRefusedError):
+                    logger.warning(f"Server {server_conn.endpoint.name} closed the connection during the handshake; servers older than handshake v2 need handshake_version=1")
+                # Dropped mid-handshake; the next server may do better.
+                self.balancer.failure(server_conn.endpoint)
+                tried.add(server_conn.endpoint)
+                if len(tried) >= len(self.balancer.endpoints):
+                    raise
+
+    async def connect_server(self, tried=None):
+        # Tries servers in balancer order until one connects. tried collects
+        # the failed ones, so a caller retrying a handshake moves on as well.
+        tried = set() if tried is None else tried
+        error = None
+        while True:
+            endpoint = self.balancer.pick(tried)
+            if endpoint is None:
+                raise error or ConnectionError("No servers left to try")
+            # A black-holed server must not use up the whole connect timeout.
+            timeout = self.dial_timeout if len(tried) + 1 < len(self.balancer.endpoints) else None
+            start = time.perf_counter()
+            try:
+                server_conn = await asyncio.wait_for(self.connect_endpoint(endpoint), timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning(f"Connecting to server {endpoint.name} failed: {e!r}")
+                self.balancer.failure(endpoint)
+                tried.add(endpoint)
+                error = e
+                continue
+            self.balancer.success(endpoint, time.perf_counter() - start)
+            server_conn.endpoint = endpoint
+            return server_conn
+
+    async def connect_endpoint(self, endpoint):
+        server_conn = await open_connection(endpoint.host, endpoint.port)
+        self.tune_socket(server_conn.sock)
+        try:
+            if self.protocol == 'tls' and self.use_ssl:
+                key = (endpoint.host, endpoint.port)
+                session = self.tls_sessions.get(key) if self.tls_resume else None
+                start = time.perf_counter()
+                await server_conn.start_tls(self.context, server_hostname=endpoint.host, session=session)
+                if self.metrics:
+                    self.metrics.observe('handshake_seconds', time.perf_counter() - start)
+                    if server_conn.ktls_send:
+                        self.metrics.inc('tls_ktls_total')
+                self.tls_sessions.record(server_conn.sock)
+            if self.version() == 1:
+                await server_conn.sendall(self.passwd.encode('utf-8'))
+        except BaseException:
+            server_conn.close()
+            raise
+        return server_conn
+
+    async def connect_pooled(self):
+        # Pooled connections authenticate when dialled (v1 ones send the
+        # password in connect_endpoint), so the server can tell them from
+        # clients that connect and never speak: it allows handshake_timeout
+        # for that, and pool_idle_timeout for the target afterwards.
+        server_conn = await self.connect_server()
+        if self.version() == 1:
+            return server_conn
+        try:
+            await self.authenticate_pooled(server_conn)
+        except BaseException:
+            server_conn.close()
+            raise
+        self.remember_session(server_conn)
+        return server_conn
+
+    async def authenticate_pooled(self, server_conn):
+        hello, nonce = build_hello(self.passwd, '', 0, FLAG_POOL)
+        await server_conn.sendall(hello)
+        status = await asyncio.wait_for(read_reply(server_conn, self.passwd, nonce), self.dial_timeout)
+        if status != STATUS_OK:
+            raise ConnectionError(f"Pooled connection refused (status {status})")
+        self.server_version = 2
+
+    async def open_udp(self):
+        result = await self.dial(self.remote_host, self.remote_port, flags=FLAG_UDP)
+        return result[0] if result else None
+
+    def offer_codec(self, endpoint, flags):
+        if self.codec is None or flags & FLAG_UDP or endpoint in self.codecs_declined:
+            return None
+        return self.codec
+
+    async def open_target(self, server_conn, host, port, early=b'', flags=0):
+        endpoint = getattr(server_conn, 'endpoint', None)
+        codec = self.offer_codec(endpoint, flags)
+        conn = server_conn
+        try:
+            if self.version() == 1:
+                if flags & FLAG_UDP:
+                    raise ConnectionError("UDP forwarding needs a handshake v2 server")
+                return await self.open_target_v1(server_conn, host, port)
+            hello, nonce = build_hello(self.passwd, host, port, flags | (CODEC_IDS[codec] << CODEC_SHIFT if codec else 0))
+            # Until a server has accepted the codec once, early data waits for
+            # its answer: a server that declines expects it uncompressed.
+            confirmed = codec is None or endpoint in self.codecs_accepted
+            if confirmed:
+                if codec:
+                    conn = CompressedConn(server_conn, codec, self.metrics)
+                await server_conn.sendall(hello + (conn.pack(early) if codec else early))
+                if early:
+                    self.metrics.inc('bytes_upstream_total', len(early))
+                if self.server_version == 2 and not flags & (FLAG_MUX | FLAG_UDP):
+                    return conn, nonce
+            else:
+                await server_conn.sendall(hello)
+            status = await read_reply(server_conn, self.passwd, nonce)
+        except BaseException:
+            server_conn.close()
+            raise
+        if codec and status == STATUS_COMPRESSED:
+            self.codecs_accepted.add(endpoint)
+            status = STATUS_OK
+        elif codec and status == STATUS_OK:
+            self.decline_codec(endpoint, codec)
+            if confirmed:
+                # Early data already went out compressed.
+                server_conn.close()
+                return None
+            codec = None
+        if status != (STATUS_UDP if flags & FLAG_UDP else STATUS_OK):
+            if flags & FLAG_UDP and status == STATUS_OK:
+                logger.warning("Server does not support UDP forwarding")
+            if status == STATUS_REJECTED:
+                logger.warning("Server rejected the handshake; check the password and the clock")
+            logger.warning(f"Association failed for {host}:{port} (status {status})")
+            if status in (None, STATUS_REJECTED):
+                self.metrics.inc('auth_failures_total')
+            server_conn.close()
+            return None
+        self.server_version = 2
+        self.remember_session(server_conn)
+        if not confirmed:
+            if codec:
+                conn = CompressedConn(server_conn, codec, self.metrics)
+            if early:
+                await conn.sendall(early)
+                self.metrics.inc('bytes_upstream_total', len(early))
+        return conn, None
+
+    def decline_codec(self, endpoint, codec):
+        # Stop offering it there; the server is not going to change its mind.
+        logger.info(f"Server {endpoint.name if endpoint else ''} declined {codec} compression")
+        self.codecs_accepted.discard(endpoint)
+        self.codecs_declined.add(endpoint)
+
+    async def open_target_v1(self, server_conn, host, port):
+        passwd = self.passwd.encode('utf-8')
+        await server_conn.sendall(encode_target(host, port))
+        resp = await server_conn.readexactly(len(passwd))
+        self.remember_session(server_conn)
+        if not hmac.compare_digest(resp, passwd):
+            logger.warning("Association failed")
+            self.metrics.inc('auth_failures_total')
+            server_conn.close()
+            return None
+        return server_conn, None
+
+    def remember_session(self, server_conn):
+        endpoint = getattr(server_conn, 'endpoint', None)
+        if self.tls_resume and endpoint:
+            self.tls_sessions.update((endpoint.host, endpoint.port), server_conn.sock)
+
     def stop(self):
         if self.protocol in ['wireguard', 'vless']:
             if self.process:
                 self.process.terminate()
-        if self.listener:
+        if self.loop and self.stopping and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            logger.info("Client stopped")
+        elif self.listener:
             self.listener.close()
-            logger.info("Client stopped")
\ No newline at end of file
+            if self.udp_sock:
+                self.udp_sock.close()
+            logger.info("Client stopped")
@@ -0,0 +1,201 @@
+import asyncio
+import importlib.util
+import struct
+import zlib
+from tlex.utils import logger
+
+# Frame on a compressed connection: kind (1) | length (4) | payload. Stored
+# frames bypass the codec, so either side may switch per frame.
+FRAME = struct.Struct('>BI')
+STORED, COMPRESSED = 0, 1
+# Largest input per frame; a frame never expands beyond this on the way in.
+MAX_FRAME_INPUT = 64 * 1024
+MAX_FRAME_SIZE = 2 * MAX_FRAME_INPUT
+# Each direction compresses SAMPLE_SIZE bytes and keeps going only if they
+# shrank below MAX_RATIO; otherwise it stores RETRY_AFTER bytes before
+# sampling again, since a connection may move on to other content.
+SAMPLE_SIZE = 64 * 1024
+MAX_RATIO = 0.9
+RETRY_AFTER = 4 * 1024 * 1024
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# 1 MiB history per direction keeps zstd memory bounded per connection.
+ZSTD_WINDOW_LOG = 20
+# Ids sent in the handshake flags; 'auto' takes the first one importable.
+CODEC_IDS = {'zlib': 1, 'zstd': 2, 'lz4': 3}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+PREFERENCE = ('zstd', 'lz4', 'zlib')
+MODULES = {'zstd': 'zstandard', 'lz4': 'lz4'}
+
+def codec_available(name):
+    if name not in CODEC_IDS:
+        return False
+    # find_spec checks without importing, so unused codecs cost nothing.
+    return name not in MODULES or importlib.util.find_spec(MODULES[name]) is not None
+
+def choose_codec(setting):
+    if not setting:
+        return None
+    if setting == 'auto':
+        return next(name for name in PREFERENCE if codec_available(name))
+    if not codec_available(setting):
+        logger.warning(f"Compression codec {setting!r} is not available; using zlib")
+        return 'zlib'
+    return setting
+
+class ZlibCodec:
+    def __init__(self):
+        self.compressor = zlib.compressobj(ZLIB_LEVEL)
+        self.decompressor = zlib.decompressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def decompress(self, data):
+        # One spare byte lets zlib consume the sync marker after a full frame.
+        out = self.decompressor.decompress(data, MAX_FRAME_INPUT + 1)
+        if len(out) > MAX_FRAME_INPUT or self.decompressor.unconsumed_tail:
+            raise ValueError("Compressed frame expands past the frame limit")
+        return out
+
+class ZstdCodec:
+    def __init__(self):
+        import zstandard
+        params = zstandard.ZstdCompressionParameters.from_level(ZSTD_LEVEL, window_log=ZSTD_WINDOW_LOG)
+        self.flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        self.compressor = zstandard.ZstdCompressor(compression_params=params).compressobj()
+        # decompressobj has no output bound, so output goes through write()
+        # below, which stops the decoder once a frame grows past the limit.
+        # A frame holds at most MAX_FRAME_INPUT bytes, so one write_size
+        # buffer always takes all of it.
+        self.decompressor = zstandard.ZstdDecompressor(max_window_size=1 << ZSTD_WINDOW_LOG).stream_writer(self, write_size=MAX_FRAME_INPUT + 1)
+        self.output = []
+        self.output_size = 0
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(self.flush_mode)
+
+    def write(self, data):
+        self.output_size += len(data)
+        if self.output_size > MAX_FRAME_INPUT:
+            raise ValueError("Compressed frame expands past the frame limit")
+        self.output.append(bytes(data))
+        return len(data)
+
+    def decompress(self, data):
+        self.output = []
+        self.output_size = 0
+        self.decompressor.write(data)
+        return b''.join(self.output)
+
+class Lz4Codec:
+    # Independent blocks: no history to keep, at some cost in ratio.
+    def __init__(self):
+        import lz4.block
+        self.block = lz4.block
+
+    def compress(self, data):
+        return self.block.compress(data)
+
+    def decompress(self, data):
+        # Blocks start with their uncompressed size (little-endian).
+        if int.from_bytes(data[:4], 'little') > MAX_FRAME_INPUT:
+            raise ValueError("Compressed frame expands past the frame limit")
+        return self.block.decompress(data)
+
+CODECS = {'zlib': ZlibCodec, 'zstd': ZstdCodec, 'lz4': Lz4Codec}
+
+class CompressedConn:
+    # Wraps a tunnel connection after a handshake that agreed on a codec and
+    # offers the same recv/send interface the relays use.
+    def __init__(self, conn, codec, metrics=None):
+        self.raw = conn
+        self.codec_name = codec
+        self.codec = CODECS[codec]()
+        self.metrics = metrics
+        self.buffer = bytearray()
+        self.enabled = True
+        self.sample_in = 0
+        self.sample_out = 0
+        self.stored = 0
+        # Both directions count, so either end reports the whole saving.
+        self.payload_key = metrics.counter('compression_payload_bytes_total') if metrics else None
+        self.wire_key = metrics.counter('compression_wire_bytes_total') if metrics else None
+
+    def __getattr__(self, name):
+        # sock, endpoint, is_alive, ... belong to the underlying connection.
+        return getattr(self.raw, name)
+
+    def encode(self, chunk):
+        if not self.enabled:
+            self.stored += len(chunk)
+            if self.stored < RETRY_AFTER:
+                return FRAME.pack(STORED, len(chunk)) + chunk
+            self.enabled = True
+            self.stored = 0
+        out = self.codec.compress(chunk)
+        self.sample_in += len(chunk)
+        self.sample_out += len(out)
+        if self.sample_in >= SAMPLE_SIZE:
+            if self.sample_out > self.sample_in * MAX_RATIO:
+                logger.debug(f"Data does not compress ({self.sample_out}/{self.sample_in} bytes); storing")
+                self.enabled = False
+            self.sample_in = self.sample_out = 0
+        return FRAME.pack(COMPRESSED, len(out)) + out
+
+    def pack(self, data):
+        view = memoryview(data)
+        frames = b''.join(self.encode(view[offset:offset + MAX_FRAME_INPUT]) for offset in range(0, len(view), MAX_FRAME_INPUT))
+        if self.metrics:
+            self.metrics.add(self.payload_key, len(view))
+            self.metrics.add(self.wire_key, len(frames))
+        return frames
+
+    async def sendall(self, data):
+        await self.raw.sendall(self.pack(data))
+
+    async def drain(self):
+        await self.raw.drain()
+
+    async def read_frame(self):
+        try:
+            header = await self.raw.readexactly(FRAME.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise ConnectionResetError("Compressed stream ended mid-frame")
+            return False
+        kind, length = FRAME.unpack(header)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Compressed frame of {length} bytes exceeds the limit")
+        payload = await self.raw.readexactly(length)
+        if kind == COMPRESSED:
+            payload = self.codec.decompress(payload)
+        self.buffer += payload
+        if self.metrics:
+            self.metrics.add(self.payload_key, len(payload))
+            self.metrics.add(self.wire_key, FRAME.size + length)
+        return True
+
+    async def recv(self, size):
+        while not self.buffer:
+            if not await self.read_frame():
+                return b''
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def recv_into(self, view):
+        data = await self.recv(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    async def readexactly(self, size):
+        while len(self.buffer) < size:
+            if not await self.read_frame():
+                raise asyncio.IncompleteReadError(bytes(self.buffer), size)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        self.raw.close()
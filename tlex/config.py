@@ -0,0 +1,291 @@
+# tlex/config.py
+import contextlib
+import fcntl
+import importlib
+import json
+import os
+import uuid
+from tlex.utils import logger
+
+CONFIG_FILE = os.path.expanduser('~/tlex_configs.json')
+SCHEMA_VERSION = 2
+
+STR = (str,)
+OPT_STR = (str, type(None))
+INT = (int,)
+OPT_INT = (int, type(None))
+NUM = (int, float)
+BOOL = (bool,)
+OPT_LIST = (list, type(None))
+
+SERVER_OPTIONS = {
+    'async_mode': BOOL,
+    'backlog': INT,
+    'max_connections': INT,
+    'handshake_timeout': NUM,
+    'allow_mux': BOOL,
+    'max_streams': INT,
+    'pool_idle_timeout': NUM,
+    'tls_tickets': INT,
+    'tls_ciphers': STR,
+    'ecdh_curve': OPT_STR,
+    'connect_timeout': NUM,
+    'happy_eyeballs_delay': NUM,
+    'dns_cache_ttl': NUM,
+    'dns_negative_ttl': NUM,
+    'dns_cache_size': INT,
+    'drain_timeout': NUM,
+    'metrics_port': OPT_INT,
+    'metrics_host': STR,
+    'ssh_host_key_file': OPT_STR,
+    'ssh_window_size': INT,
+    'ssh_max_packet_size': INT,
+    'allow_udp': BOOL,
+    'udp_idle_timeout': NUM,
+    'udp_max_sessions': INT,
+    'compression': BOOL,
+    'max_connections_per_ip': INT,
+    'connection_rate_per_ip': NUM,
+    'auth_penalty': NUM,
+    'max_auth_penalty': NUM,
+    'log_level': OPT_STR,
+    'log_rate': NUM,
+    'log_summary_interval': NUM,
+    'idle_timeout': NUM,
+    'tcp_nodelay': BOOL,
+    'tcp_keepalive': NUM,
+    'socket_buffer': INT,
+    'ktls': BOOL,
+}
+
+CLIENT_OPTIONS = {
+    'async_mode': BOOL,
+    'backlog': INT,
+    'max_connections': INT,
+    'connect_timeout': NUM,
+    'mux': BOOL,
+    'mux_connections': INT,
+    'pool_size': INT,
+    'pool_max_idle': NUM,
+    'tls_resume': BOOL,
+    'tls_ciphers': STR,
+    'ecdh_curve': OPT_STR,
+    'handshake_version': INT,
+    'metrics_port': OPT_INT,
+    'metrics_host': STR,
+    'ssh_username': STR,
+    'ssh_window_size': INT,
+    'ssh_max_packet_size': INT,
+    'drain_timeout': NUM,
+    'servers': OPT_LIST,
+    'balance': STR,
+    'health_interval': NUM,
+    'eject_after': INT,
+    'eject_time': NUM,
+    'dial_timeout': NUM,
+    'udp': BOOL,
+    'udp_idle_timeout': NUM,
+    'compression': OPT_STR,
+    'log_level': OPT_STR,
+    'log_rate': NUM,
+    'log_summary_interval': NUM,
+    'idle_timeout': NUM,
+    'tcp_nodelay': BOOL,
+    'tcp_keepalive': NUM,
+    'socket_buffer': INT,
+    'ktls': BOOL,
+}
+
+# kind -> (module, class, field types). Records hold only these plain
+# values; the class is imported and built when the tunnel is started.
+KINDS = {
+    'server': ('tlex.server', 'TunnelServer', {
+        'listen_host': STR, 'listen_port': INT, 'cert_file': OPT_STR, 'key_file': OPT_STR, 'passwd': STR,
+        'use_ssl': BOOL, 'protocol': STR, 'workers': INT, **SERVER_OPTIONS,
+    }),
+    'client': ('tlex.client', 'TunnelClient', {
+        'local_host': STR, 'local_port': INT, 'server_host': STR, 'server_port': INT, 'remote_host': STR,
+        'remote_port': INT, 'passwd': STR, 'ca_cert': OPT_STR, 'use_ssl': BOOL, 'protocol': STR, **CLIENT_OPTIONS,
+    }),
+    'reverse_server': ('tlex.reverse', 'ReverseTunnelServer', {
+        'listen_host': STR, 'listen_port': INT, 'cert_file': OPT_STR, 'key_file': OPT_STR, 'passwd': STR,
+        'use_ssl': BOOL, 'public_host': STR, 'public_port': INT, 'backhaul_timeout': NUM, **SERVER_OPTIONS,
+    }),
+    'reverse_client': ('tlex.reverse', 'ReverseTunnelClient', {
+        'server_host': STR, 'server_port': INT, 'local_host': STR, 'local_port': INT, 'passwd': STR,
+        'ca_cert': OPT_STR, 'use_ssl': BOOL, 'pool_min': INT, 'pool_max': INT, 'max_streams': INT,
+        **{name: types for name, types in CLIENT_OPTIONS.items() if name not in ('udp', 'udp_idle_timeout', 'compression')},
+    }),
+}
+
+class ConfigError(ValueError):
+    pass
+
+def validate(kind, options):
+    if kind not in KINDS:
+        raise ConfigError(f"Unknown tunnel kind {kind!r}")
+    fields = KINDS[kind][2]
+    for name, value in options.items():
+        types = fields.get(name)
+        if types is None:
+            raise ConfigError(f"Unknown option {name!r} for {kind}")
+        # bool is an int subclass, so only accept it where a bool is expected.
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise ConfigError(f"Option {name!r} for {kind} must be {'/'.join(t.__name__ for t in types)}, not {type(value).__name__}")
+
+def kind_of(tunnel):
+    for kind, (module, class_name, fields) in KINDS.items():
+        if type(tunnel).__module__ == module and type(tunnel).__name__ == class_name:
+            return kind
+    raise ConfigError(f"Cannot store {type(tunnel).__name__} configs")
+
+class TunnelConfig:
+    # A plain, validated record; nothing is imported, bound or generated
+    # until build() is called.
+    def __init__(self, kind, options=None, id=None):
+        self.kind = kind
+        self.options = dict(options or {})
+        self.id = id or uuid.uuid4().hex[:8]
+        validate(self.kind, self.options)
+
+    @classmethod
+    def from_tunnel(cls, tunnel, id=None):
+        kind = kind_of(tunnel)
+        options = {name: getattr(tunnel, name) for name in KINDS[kind][2] if hasattr(tunnel, name)}
+        return cls(kind, options, id)
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict) or not isinstance(data.get('options', {}), dict):
+            raise ConfigError(f"Malformed tunnel record: {data!r}")
+        return cls(data.get('kind'), data.get('options'), data.get('id'))
+
+    def to_dict(self):
+        return {'id': self.id, 'kind': self.kind, 'options': self.options}
+
+    def key(self):
+        # Equal keys mean the same settings, so a running tunnel can be kept.
+        return json.dumps([self.kind, self.options], sort_keys=True)
+
+    @property
+    def protocol(self):
+        if 'protocol' in self.options:
+            return self.options['protocol'].lower()
+        if self.kind.startswith('reverse'):
+            return 'tls' if self.options.get('use_ssl', True) else 'plain'
+        return 'tls'
+
+    @property
+    def port(self):
+        return self.options.get('listen_port', self.options.get('local_port'))
+
+    def describe(self):
+        return f"{KINDS[self.kind][1]} {self.protocol.upper()} :{self.port}"
+
+    def build(self):
+        module, class_name, fields = KINDS[self.kind]
+        return getattr(importlib.import_module(module), class_name)(**self.options)
+
+def migrate_legacy(data):
+    # Files written before schema versions hold jsonpickled tunnel objects.
+    import jsonpickle
+    objects = jsonpickle.decode(data if isinstance(data, str) else json.dumps(data))
+    if not isinstance(objects, list):
+        objects = [objects]
+    configs = []
+    for obj in objects:
+        try:
+            configs.append(TunnelConfig.from_tunnel(obj))
+        except ConfigError as e:
+            logger.error(f"Skipping legacy tunnel config: {e}")
+    return configs
+
+class ConfigStore:
+    # Tunnel records indexed by id. Every change is a locked
+    # read-modify-write that replaces the file atomically, so readers such
+    # as the supervisor never see a half-written file.
+    def __init__(self, path=None):
+        self.path = path or CONFIG_FILE
+        self.configs = {}
+
+    def load(self, strict=False):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {'version': SCHEMA_VERSION, 'tunnels': []}
+        except Exception as e:
+            if strict:
+                raise
+            logger.error(f"Config load error: {e}")
+            data = {'version': SCHEMA_VERSION, 'tunnels': []}
+        configs = {}
+        if isinstance(data, dict) and 'version' in data:
+            if data['version'] > SCHEMA_VERSION:
+                raise ConfigError(f"{self.path} was written by a newer version (schema {data['version']})")
+            for record in data.get('tunnels', []):
+                try:
+                    config = TunnelConfig.from_dict(record)
+                except ConfigError as e:
+                    if strict:
+                        raise
+                    logger.error(f"Skipping tunnel config: {e}")
+                    continue
+                configs[config.id] = config
+        else:
+            logger.info(f"Migrating legacy config file {self.path}")
+            try:
+                configs = {config.id: config for config in migrate_legacy(data)}
+            except Exception as e:
+                if strict:
+                    raise
+                logger.error(f"Config load error: {e}")
+        self.configs = configs
+        return list(configs.values())
+
+    def get(self, id):
+        return self.configs.get(id)
+
+    def save(self):
+        data = {'version': SCHEMA_VERSION, 'tunnels': [config.to_dict() for config in self.configs.values()]}
+        import tempfile
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.tlex_configs.', dir=directory)
+        try:
+            # mkstemp creates the file 0600, which also keeps passwords private.
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+            raise
+
+    @contextlib.contextmanager
+    def update(self):
+        # Serialises writers (TUI sessions, scripts) on a side lock file.
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.load(strict=True)
+                yield self.configs
+                self.save()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def add(self, config):
+        with self.update() as configs:
+            configs[config.id] = config
+        return config.id
+
+    def replace(self, config):
+        with self.update() as configs:
+            if config.id not in configs:
+                raise KeyError(config.id)
+            configs[config.id] = config
+
+    def remove(self, id):
+        with self.update() as configs:
+            return configs.pop(id, None)
@@ -0,0 +1,207 @@
+import asyncio
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+# Same object as tlex.utils.logger; this module must not import tlex.utils.
+logger = logging.getLogger('tlex.utils')
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+# Records waiting for the writer thread; beyond this they are dropped, so a
+# stalled disk or terminal never blocks the event loop.
+MAX_QUEUE = 10000
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUPS = 3
+# Distinct targets counted per summary; the rest are lumped together.
+MAX_TARGETS = 1024
+TOP_TARGETS = 5
+# Fields passed through extra= that the JSON formatter keeps.
+FIELDS = ('tunnel', 'client', 'target', 'summary')
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for field in FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogWriter:
+    # Log calls only format the record and enqueue it; a thread does the
+    # writing. Forked workers get a writer of their own.
+    def __init__(self, level='INFO', json_format=False, path=None):
+        self.level = level
+        self.json_format = json_format
+        self.path = path
+        self.handler = None
+        self.listener = None
+
+    def start(self):
+        if self.path:
+            output = logging.handlers.RotatingFileHandler(self.path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+        else:
+            output = logging.StreamHandler()
+        output.setFormatter(JsonFormatter() if self.json_format else logging.Formatter(FORMAT))
+        self.handler = DroppingQueueHandler(queue.Queue(MAX_QUEUE))
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.level.upper() if isinstance(self.level, str) else self.level)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, output)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+
+    def restart_in_child(self):
+        # The parent's writer thread does not exist after fork.
+        self.listener = None
+        self.start()
+
+writer = None
+
+def setup_logging(level='INFO', json_format=False, path=None):
+    global writer
+    if writer:
+        writer.stop()
+    else:
+        atexit.register(lambda: writer and writer.stop())
+        os.register_at_fork(after_in_child=lambda: writer and writer.restart_in_child())
+    writer = LogWriter(level, json_format, path)
+    writer.start()
+    return writer
+
+def parse_level(level):
+    if level is None or isinstance(level, int):
+        return level or logging.NOTSET
+    return logging.getLevelName(level.upper())
+
+class Throttle:
+    # Token bucket: allow() is true for up to rate calls per second, with
+    # bursts of up to burst.
+    def __init__(self, rate=10, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate * 2, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.suppressed = 0
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.suppressed += 1
+        return False
+
+class AccessLog:
+    # Per-tunnel connection log. Lines are only built when the tunnel's level
+    # and rate limit let them through; everything is counted and reported
+    # every summary_interval seconds as connections/s and top targets.
+    def __init__(self, tunnel, level=None, rate=10, summary_interval=60):
+        self.tunnel = tunnel
+        self.level = parse_level(level)
+        self.throttle = Throttle(rate) if rate else None
+        self.summary_interval = summary_interval
+        self.lock = threading.Lock()
+        self.reset(time.monotonic())
+
+    def reset(self, now):
+        self.started = now
+        self.connections = 0
+        self.errors = Counter()
+        self.targets = Counter()
+        if self.throttle:
+            self.throttle.suppressed = 0
+
+    def enabled(self, level):
+        return level >= self.level and logger.isEnabledFor(level)
+
+    def allow(self, level):
+        return self.enabled(level) and self.throttle is not None and self.throttle.allow()
+
+    def count(self, host, port):
+        self.connections += 1
+        if host is not None:
+            key = (host, port)
+            if key in self.targets or len(self.targets) < MAX_TARGETS:
+                self.targets[key] += 1
+        self.maybe_summarize()
+
+    def connection(self, addr, host=None, port=None, action="Connected to remote"):
+        with self.lock:
+            self.count(host, port)
+            allowed = self.allow(logging.INFO)
+        if not allowed:
+            return
+        if host is None:
+            logger.info(f"{action} for {addr}", extra={'tunnel': self.tunnel, 'client': str(addr)})
+        else:
+            logger.info(f"{action} {host}:{port} for {addr}", extra={'tunnel': self.tunnel, 'client': str(addr), 'target': f"{host}:{port}"})
+
+    def record(self, host, port):
+        # Counted for the summary only, without a line of its own.
+        with self.lock:
+            self.count(host, port)
+
+    def error(self, addr, error, action="Error handling"):
+        with self.lock:
+            self.errors[type(error).__name__] += 1
+            allowed = self.allow(logging.ERROR)
+            self.maybe_summarize()
+        if allowed:
+            logger.error(f"{action} {addr}: {error}", extra={'tunnel': self.tunnel, 'client': str(addr)})
+
+    async def summary_loop(self):
+        # Flushes the summary of a tunnel that has gone quiet.
+        while self.summary_interval:
+            await asyncio.sleep(self.summary_interval)
+            with self.lock:
+                self.maybe_summarize()
+
+    def maybe_summarize(self):
+        now = time.monotonic()
+        if not self.summary_interval or now - self.started < self.summary_interval:
+            return
+        if (self.connections or self.errors) and self.enabled(logging.INFO):
+            elapsed = now - self.started
+            top = self.targets.most_common(TOP_TARGETS)
+            summary = {
+                'seconds': round(elapsed, 1),
+                'connections': self.connections,
+                'rate': round(self.connections / elapsed, 2),
+                'errors': dict(self.errors),
+                'suppressed': self.throttle.suppressed if self.throttle else 0,
+                'top_targets': {f"{host}:{port}": count for (host, port), count in top},
+            }
+            targets = ', '.join(f"{target} ({count})" for target, count in summary['top_targets'].items())
+            logger.info(f"[{self.tunnel}] {self.connections} connections ({summary['rate']}/s), {sum(self.errors.values())} errors, {summary['suppressed']} lines suppressed in {summary['seconds']}s; top targets: {targets or 'none'}", extra={'tunnel': self.tunnel, 'summary': summary})
+        self.reset(now)
@@ -1,17 +1,29 @@
 # tlex/main.py
 import argparse
 import sys
-from tlex.tui import tui_loop, console
 
 def main():
     parser = argparse.ArgumentParser(description="T-LeX: Professional Tunnel Tool")
-    parser.add_argument("command", choices=['run'], nargs='?', default=None, help="Command: 'run' to launch TUI")
+    parser.add_argument("command", choices=['run', 'serve'], nargs='?', default=None, help="Command: 'run' to launch TUI, 'serve' to run all saved tunnels headless")
     parser.add_argument("--interactive", action="store_true", help="Run interactive TUI")
+    parser.add_argument("--config", help="Config file for 'serve' (default ~/tlex_configs.json)")
+    parser.add_argument("--reload-interval", type=float, default=2, help="Seconds between config change checks for 'serve'")
+    parser.add_argument("--log-level", default='INFO', help="Global log level (tunnels may set a stricter log_level of their own)")
+    parser.add_argument("--log-json", action="store_true", help="Write log records as JSON lines")
+    parser.add_argument("--log-file", help="Write logs to a rotating file instead of stderr")
     args = parser.parse_args()
-    if args.command == 'run' or args.interactive or len(sys.argv) == 1:
+    from tlex.logs import setup_logging
+    setup_logging(args.log_level, args.log_json, args.log_file)
+    # The TUI and the tunnel backends are imported only by the command that
+    # needs them; 'serve' restarts under systemd and should start fast.
+    if args.command == 'serve':
+        from tlex.supervisor import TunnelSupervisor
+        TunnelSupervisor(args.config, args.reload_interval).run()
+    elif args.command == 'run' or args.interactive or len(sys.argv) == 1:
+        from tlex.tui import tui_loop
         tui_loop()
     else:
-        console.print("[yellow]Use 'tlex run' for TUI or --interactive.[/yellow]")
+        print("Use 'tlex run' for TUI or --interactive.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
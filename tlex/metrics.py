@@ -0,0 +1,167 @@
+import bisect
+import threading
+from tlex.utils import logger
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PREFIX = 'tlex'
+TYPES = {
+    'connections_total': ('counter', "Connections accepted"),
+    'connections_active': ('gauge', "Connections currently being handled"),
+    'handshake_seconds': ('histogram', "Time from accept until the tunnel handshake completed"),
+    'auth_failures_total': ('counter', "Handshakes rejected for a bad password or token"),
+    'handshake_timeouts_total': ('counter', "Connections that did not authenticate within handshake_timeout"),
+    'handshake_errors_total': ('counter', "Connections that failed or hung up before authenticating, by exception type"),
+    'admission_rejected_total': ('counter', "Connections reset at accept, by reason (saturated, source_limit, source_rate, auth_penalty)"),
+    'connect_seconds': ('histogram', "Time to open the next hop (target on the server, tunnel on the client)"),
+    'connect_errors_total': ('counter', "Failed attempts to open the next hop"),
+    'bytes_upstream_total': ('counter', "Bytes relayed from the tunnel client towards the target"),
+    'bytes_downstream_total': ('counter', "Bytes relayed from the target back to the tunnel client"),
+    'relay_errors_total': ('counter', "Relay errors by exception type"),
+    'idle_reaped_total': ('counter', "Relays closed after idle_timeout seconds without traffic"),
+    'tls_handshakes_total': ('counter', "TLS handshakes completed"),
+    'tls_resumed_total': ('counter', "TLS handshakes that resumed a session"),
+    'tls_ktls_total': ('counter', "TLS connections whose records the kernel encrypts (kTLS)"),
+    'pool_hits_total': ('counter', "Connections served from the pre-dialed pool"),
+    'pool_misses_total': ('counter', "Connections dialed because the pool was empty"),
+    'pool_expired_total': ('counter', "Pooled connections dropped as idle or dead"),
+    'pool_dial_errors_total': ('counter', "Failed pool refills"),
+    'dns_hits_total': ('counter', "Resolver cache hits"),
+    'dns_misses_total': ('counter', "Resolver cache misses"),
+    'dns_negative_hits_total': ('counter', "Resolver hits on cached failures"),
+    'dns_errors_total': ('counter', "Failed lookups"),
+    'dns_evictions_total': ('counter', "Resolver cache evictions"),
+    'dns_resolve_seconds_total': ('counter', "Time spent in lookups"),
+    'workers_alive': ('gauge', "Worker processes currently running"),
+    'worker_restarts_total': ('counter', "Worker processes restarted after exiting"),
+    'udp_sessions_active': ('gauge', "UDP source addresses with a live session"),
+    'udp_dropped_total': ('counter', "Datagrams dropped on a full queue or a failed association"),
+    'compression_payload_bytes_total': ('counter', "Bytes relayed through compressed connections, before compression"),
+    'compression_wire_bytes_total': ('counter', "Bytes those connections took on the wire"),
+    'compression_saved_bytes': ('gauge', "Payload minus wire bytes on compressed connections"),
+    'endpoint_up': ('gauge', "1 if the server endpoint is in rotation, 0 while ejected"),
+    'endpoint_active': ('gauge', "Tunnel connections open through the server endpoint"),
+    'endpoint_ejections': ('gauge', "Consecutive ejections of the server endpoint"),
+    'endpoint_rtt_seconds': ('gauge', "Smoothed connect (and TLS handshake) time to the server endpoint"),
+}
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    return ','.join(f'{key}="{escape(value)}"' for key, value in labels.items())
+
+def series_key(name, labels):
+    return f"{name}{{{format_labels(labels)}}}" if labels else name
+
+def base_name(key):
+    name = key.split('{', 1)[0]
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and TYPES.get(name[:-len(suffix)], ('',))[0] == 'histogram':
+            return name[:-len(suffix)]
+    return name
+
+class Metrics:
+    # Values live in a plain dict keyed by series ("name" or 'name{k="v"}'),
+    # so a snapshot is one dict copy and snapshots from workers add up.
+    def __init__(self):
+        self.values = {}
+        self.histograms = {}
+        self.keys = {}
+
+    def key(self, name, labels):
+        cache_key = (name, tuple(labels.items()))
+        key = self.keys.get(cache_key)
+        if key is None:
+            key = self.keys[cache_key] = series_key(name, labels)
+        return key
+
+    def counter(self, name, **labels):
+        # Hot paths resolve the series key once and then call add().
+        key = self.key(name, labels)
+        self.values.setdefault(key, 0)
+        return key
+
+    def add(self, key, value=1):
+        self.values[key] += value
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = (name, labels, [0] * (len(LATENCY_BUCKETS) + 2))
+        # The last slot accumulates the sum of observations.
+        histogram[2][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[2][-1] += value
+
+    def snapshot(self):
+        stats = dict(self.values)
+        for name, labels, counts in list(self.histograms.values()):
+            counts = list(counts)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                stats[series_key(f"{name}_bucket", {**labels, 'le': bound})] = cumulative
+            stats[series_key(f"{name}_sum", labels)] = counts[-1]
+            stats[series_key(f"{name}_count", labels)] = cumulative
+        return stats
+
+def render(stats, labels=None):
+    # labels are attached to every series, e.g. role and tunnel address.
+    common = format_labels(labels or {})
+    grouped = {}
+    for key, value in stats.items():
+        grouped.setdefault(base_name(key), []).append((key, value))
+    lines = []
+    for name in sorted(grouped):
+        kind, help_text = TYPES.get(name, ('untyped', None))
+        if help_text:
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+        for key, value in grouped[name]:
+            series, _, rest = key.partition('{')
+            inner = ','.join(part for part in (common, rest[:-1]) if part)
+            lines.append(f"{PREFIX}_{series}{{{inner}}} {value}" if inner else f"{PREFIX}_{series} {value}")
+    return '\n'.join(lines) + '\n'
+
+class MetricsServer:
+    # A small threaded HTTP server so scraping never waits on the tunnel's
+    # event loop (or on the supervisor loop in multi-worker mode).
+    def __init__(self, host, port, collect, labels=None):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        self.collect = collect
+        self.labels = labels
+        metrics_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = render(metrics_server.collect(), metrics_server.labels).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='tlex-metrics', daemon=True).start()
+        host, port = self.httpd.server_address[:2]
+        logger.info(f"Metrics available at http://{host}:{port}/metrics")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,242 @@
+import asyncio
+import struct
+from tlex.utils import logger
+
+# Frame: type (1) | stream id (4) | payload length (4) | payload
+HEADER = struct.Struct('>BII')
+OPEN, DATA, FIN, RST, WINDOW = range(1, 6)
+MUX_VERSION = 1
+# A target of ('', 0) in the legacy header asks the server to switch the
+# connection to multiplexed framing; old servers fail to dial it and close.
+MUX_TARGET = ('', 0)
+INITIAL_WINDOW = 256 * 1024
+MAX_FRAME = 16 * 1024
+# OPEN carries a length-prefixed host and a port; nothing else has a payload
+# bigger than a window increment.
+MAX_CONTROL_FRAME = 1 + 255 + 2
+HIGH_WATER = 1024 * 1024
+
+def encode_target(host, port):
+    host_bytes = host.encode('utf-8')
+    return len(host_bytes).to_bytes(1, 'big') + host_bytes + port.to_bytes(2, 'big')
+
+def decode_target(payload):
+    # Raises ValueError for a truncated target or a host that is not UTF-8.
+    if not payload or len(payload) != payload[0] + 3:
+        raise ValueError(f"Malformed mux target of {len(payload)} bytes")
+    host_len = payload[0]
+    host = bytes(payload[1:1 + host_len]).decode('utf-8')
+    port = int.from_bytes(payload[1 + host_len:3 + host_len], 'big')
+    return host, port
+
+class MuxStream:
+    def __init__(self, session, stream_id):
+        self.session = session
+        self.stream_id = stream_id
+        self.buffer = bytearray()
+        self.readable = asyncio.Event()
+        self.window_open = asyncio.Event()
+        self.window_open.set()
+        self.send_window = INITIAL_WINDOW
+        self.consumed = 0
+        self.eof = False
+        self.fin_sent = False
+        self.reset = False
+        self.closed = False
+
+    def feed_data(self, data):
+        if len(self.buffer) + len(data) > INITIAL_WINDOW:
+            logger.warning(f"Mux stream {self.stream_id} exceeded its flow-control window")
+            self.close()
+            return
+        self.buffer += data
+        self.readable.set()
+
+    def feed_eof(self):
+        self.eof = True
+        self.readable.set()
+
+    def feed_window(self, increment):
+        self.send_window += increment
+        self.window_open.set()
+
+    def feed_reset(self):
+        self.reset = True
+        self.eof = True
+        self.readable.set()
+        self.window_open.set()
+
+    async def recv(self, size):
+        while not self.buffer and not self.eof:
+            self.readable.clear()
+            await self.readable.wait()
+        if not self.buffer:
+            return b''
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.consumed += len(data)
+        if self.consumed >= INITIAL_WINDOW // 2 and not self.eof:
+            self.session.send_frame(WINDOW, self.stream_id, self.consumed.to_bytes(4, 'big'))
+            self.consumed = 0
+        return data
+
+    async def recv_into(self, view):
+        data = await self.recv(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    async def drain(self):
+        await self.session.drain()
+
+    async def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            if self.reset or self.closed or self.fin_sent:
+                raise ConnectionResetError(f"Mux stream {self.stream_id} is closed")
+            if self.send_window == 0:
+                self.window_open.clear()
+                await self.window_open.wait()
+                continue
+            size = min(len(view), self.send_window, MAX_FRAME)
+            self.send_window -= size
+            self.session.send_frame(DATA, self.stream_id, view[:size])
+            view = view[size:]
+            await self.session.drain()
+
+    def write_eof(self):
+        if not (self.fin_sent or self.reset or self.closed):
+            self.fin_sent = True
+            self.session.send_frame(FIN, self.stream_id)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not (self.reset or (self.fin_sent and self.eof)):
+            self.session.send_frame(RST, self.stream_id)
+        self.feed_reset()
+        self.session.streams.pop(self.stream_id, None)
+
+class MuxSession:
+    def __init__(self, conn, client_side, open_handler=None, max_streams=1024):
+        self.conn = conn
+        self.client_side = client_side
+        self.open_handler = open_handler
+        self.max_streams = max_streams
+        self.streams = {}
+        self.handlers = set()
+        self.next_id = 1 if client_side else 2
+        self.outgoing = []
+        self.pending = 0
+        self.has_outgoing = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.closed = False
+        self.writer_task = None
+
+    def send_frame(self, type_, stream_id, payload=b''):
+        if self.closed:
+            return
+        self.outgoing.append(HEADER.pack(type_, stream_id, len(payload)))
+        if payload:
+            self.outgoing.append(bytes(payload))
+        self.pending += HEADER.size + len(payload)
+        if self.pending > HIGH_WATER:
+            self.writable.clear()
+        self.has_outgoing.set()
+
+    async def drain(self):
+        if not self.writable.is_set():
+            await self.writable.wait()
+        if self.closed:
+            raise ConnectionResetError("Mux session closed")
+
+    async def write_loop(self):
+        try:
+            while not self.closed:
+                await self.has_outgoing.wait()
+                self.has_outgoing.clear()
+                while self.outgoing:
+                    data = b''.join(self.outgoing)
+                    self.outgoing.clear()
+                    await self.conn.sendall(data)
+                    self.pending -= len(data)
+                    if self.pending <= HIGH_WATER // 2:
+                        self.writable.set()
+        except Exception as e:
+            logger.error(f"Mux write error: {e}")
+            self.close()
+
+    def open_stream(self, host, port):
+        if self.closed:
+            raise ConnectionResetError("Mux session closed")
+        stream = MuxStream(self, self.next_id)
+        self.next_id += 2
+        self.streams[stream.stream_id] = stream
+        self.send_frame(OPEN, stream.stream_id, encode_target(host, port))
+        return stream
+
+    async def run(self):
+        self.writer_task = asyncio.create_task(self.write_loop())
+        try:
+            while not self.closed:
+                type_, stream_id, length = HEADER.unpack(await self.conn.readexactly(HEADER.size))
+                if length > (MAX_FRAME if type_ == DATA else MAX_CONTROL_FRAME) or (type_ == WINDOW and length != 4):
+                    logger.warning(f"Mux frame of type {type_} with bad length {length}; closing session")
+                    break
+                payload = await self.conn.readexactly(length) if length else b''
+                self.dispatch(type_, stream_id, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            # Closing the session from outside (e.g. a drain) aborts the read.
+            if not self.closed:
+                logger.error(f"Mux read error: {e}")
+        finally:
+            self.close()
+            await asyncio.gather(self.writer_task, *self.handlers, return_exceptions=True)
+
+    def dispatch(self, type_, stream_id, payload):
+        stream = self.streams.get(stream_id)
+        if type_ == OPEN:
+            # The peer opens streams from its own half of the id space only;
+            # anything else would collide with streams opened on this side.
+            if self.open_handler is None or stream is not None or stream_id % 2 == self.next_id % 2 or len(self.streams) >= self.max_streams:
+                self.send_frame(RST, stream_id)
+                return
+            try:
+                host, port = decode_target(payload)
+            except ValueError as e:
+                logger.warning(f"Mux stream {stream_id} refused: {e}")
+                self.send_frame(RST, stream_id)
+                return
+            stream = MuxStream(self, stream_id)
+            self.streams[stream_id] = stream
+            task = asyncio.create_task(self.open_handler(stream, host, port))
+            self.handlers.add(task)
+            task.add_done_callback(self.handlers.discard)
+        elif stream is None:
+            if type_ != RST:
+                self.send_frame(RST, stream_id)
+        elif type_ == DATA:
+            stream.feed_data(payload)
+        elif type_ == FIN:
+            stream.feed_eof()
+        elif type_ == WINDOW:
+            stream.feed_window(int.from_bytes(payload, 'big'))
+        elif type_ == RST:
+            stream.feed_reset()
+            self.streams.pop(stream_id, None)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for stream in list(self.streams.values()):
+            stream.feed_reset()
+        self.streams.clear()
+        for task in self.handlers:
+            task.cancel()
+        self.has_outgoing.set()
+        self.writable.set()
+        self.conn.close()
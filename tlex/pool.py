@@ -0,0 +1,87 @@
+import asyncio
+import time
+from collections import deque
+from tlex.utils import logger
+
+class ConnectionPool:
+    def __init__(self, dial, size, max_idle=60, max_backoff=30):
+        self.dial = dial
+        self.size = size
+        self.max_idle = max_idle
+        self.max_backoff = max_backoff
+        self.idle = deque()
+        self.connecting = 0
+        self.backoff = 0
+        self.wakeup = asyncio.Event()
+        self.fillers = set()
+        self.task = None
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'dial_errors': 0}
+
+    def start(self):
+        self.task = asyncio.create_task(self.maintain())
+
+    def acquire(self):
+        now = time.monotonic()
+        self.wakeup.set()
+        while self.idle:
+            conn, created = self.idle.popleft()
+            if now - created > self.max_idle or not conn.is_alive():
+                self.stats['expired'] += 1
+                conn.close()
+                continue
+            self.stats['hits'] += 1
+            return conn
+        self.stats['misses'] += 1
+        return None
+
+    def expire(self):
+        now = time.monotonic()
+        alive = deque()
+        for conn, created in self.idle:
+            if now - created > self.max_idle or not conn.is_alive():
+                self.stats['expired'] += 1
+                conn.close()
+            else:
+                alive.append((conn, created))
+        self.idle = alive
+
+    async def maintain(self):
+        while True:
+            self.expire()
+            while len(self.idle) + self.connecting < self.size:
+                self.connecting += 1
+                task = asyncio.create_task(self.fill())
+                self.fillers.add(task)
+                task.add_done_callback(self.fillers.discard)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.max_idle / 2)
+            except asyncio.TimeoutError:
+                pass
+
+    async def fill(self):
+        try:
+            conn = await self.dial()
+            self.idle.append((conn, time.monotonic()))
+            self.backoff = 0
+        except Exception as e:
+            self.stats['dial_errors'] += 1
+            self.backoff = min(max(self.backoff * 2, 0.5), self.max_backoff)
+            logger.warning(f"Pool dial failed: {e}; retrying in {self.backoff}s")
+            await asyncio.sleep(self.backoff)
+        finally:
+            self.connecting -= 1
+            self.wakeup.set()
+
+    def clear(self):
+        while self.idle:
+            conn, _ = self.idle.popleft()
+            conn.close()
+        self.wakeup.set()
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+        for task in self.fillers:
+            task.cancel()
+        self.clear()
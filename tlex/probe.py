@@ -0,0 +1,202 @@
+# tlex/probe.py
+import asyncio
+import socket
+import time
+from tlex.protocol import FLAG_POOL, STATUS_OK, build_hello, read_reply
+from tlex.tls import create_client_context
+from tlex.utils import AsyncSocket, logger
+
+DEFAULT_SAMPLES = 10
+# Samples to one target start this far apart, so they see the path over a
+# short window rather than as a single burst.
+SAMPLE_INTERVAL = 0.05
+THROUGHPUT_BYTES = 256 * 1024
+# Shorter responses finish inside slow start and say nothing about bandwidth.
+MIN_THROUGHPUT_BYTES = 32 * 1024
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        'p50': round(percentile(values, 0.5) * 1000, 2),
+        'p95': round(percentile(values, 0.95) * 1000, 2),
+        'min': round(min(values) * 1000, 2),
+    }
+
+def jitter(values):
+    # Mean difference between consecutive samples, as in RFC 3550.
+    if len(values) < 2:
+        return 0
+    return round(sum(abs(b - a) for a, b in zip(values, values[1:])) / (len(values) - 1) * 1000, 2)
+
+def parse_target(target, default_port=443):
+    target = target.strip()
+    if target.startswith('['):
+        host, _, rest = target[1:].partition(']')
+        return host, int(rest[1:]) if rest.startswith(':') else default_port
+    if target.count(':') == 1:
+        host, port = target.split(':')
+        return host, int(port)
+    return target, default_port
+
+def score(result):
+    # Lower is better: tail setup latency, inflated by the share of attempts
+    # that failed to connect or to finish the TLS handshake.
+    if result.get('connect_ms') is None:
+        return float('inf')
+    latency = result['connect_ms']['p95'] + (result['tls_ms']['p95'] if result.get('tls_ms') else 0)
+    failed = result['loss'] + result.get('tls_failures', 0) / result['samples']
+    return latency / max(1 - failed, 0.01)
+
+def best_path(results):
+    usable = [result for result in results if result.get('connect_ms') is not None]
+    return min(usable, key=score) if usable else None
+
+class PathProber:
+    # Probes candidate endpoints with concurrent TCP connects and TLS
+    # handshakes, plus one short transfer, and caches the summaries.
+    # With passwd set the targets are tlex servers, which penalise clients
+    # that hang up before authenticating: every sample then sends a pooled
+    # hello, and there is no page to fetch for the transfer.
+    def __init__(self, samples=DEFAULT_SAMPLES, timeout=3, tls=True, throughput=True, concurrency=32, cache_ttl=300, passwd=None):
+        self.samples = samples
+        self.timeout = timeout
+        self.tls = tls
+        self.throughput = throughput and passwd is None
+        self.concurrency = concurrency
+        self.cache_ttl = cache_ttl
+        self.passwd = passwd
+        self.cache = {}
+        self.context = create_client_context() if tls else None
+        self.semaphore = None
+
+    def run(self, targets):
+        return asyncio.run(self.probe_all(targets))
+
+    async def probe_all(self, targets):
+        return list(await asyncio.gather(*(self.probe(host, port) for host, port in targets)))
+
+    async def probe(self, host, port):
+        key = (host, port)
+        cached = self.cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        result = {'host': host, 'port': port, 'samples': self.samples, 'probed_at': round(time.time(), 3)}
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            # Resolve once so name lookups do not count as connect time.
+            infos = await asyncio.wait_for(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            result.update({'error': f"{type(e).__name__}: {e}", 'loss': 1.0, 'connect_ms': None, 'tls_ms': None})
+            return result
+        result['dns_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        family, _, _, _, addr = infos[0]
+        result['address'] = addr[0]
+        server_hostname = None if host == addr[0] else host
+        samples = await asyncio.gather(*(self.sample(family, addr, server_hostname, i * SAMPLE_INTERVAL) for i in range(self.samples)))
+        connects = [connect for connect, _, _ in samples if connect is not None]
+        handshakes = [handshake for _, handshake, _ in samples if handshake is not None]
+        errors = {}
+        for _, _, error in samples:
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+        result.update({
+            'loss': round(1 - len(connects) / self.samples, 3),
+            'errors': errors,
+            'connect_ms': summarize(connects),
+            'jitter_ms': jitter(connects),
+            'tls_ms': summarize(handshakes),
+            # Connected but the handshake failed: a sign of TLS filtering.
+            'tls_failures': len(connects) - len(handshakes) if self.tls else 0,
+        })
+        if self.throughput and connects and (handshakes or not self.tls):
+            result['throughput_mbps'] = await self.measure_throughput(family, addr, host, server_hostname)
+        self.cache[key] = (time.monotonic() + self.cache_ttl, result)
+        logger.info(f"Probed {host}:{port}: loss {result['loss']:.0%}, connect {result['connect_ms']}, TLS {result['tls_ms']}")
+        return result
+
+    async def connect(self, family, addr):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, addr), self.timeout)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def sample(self, family, addr, server_hostname, delay):
+        # Returns (connect seconds, handshake seconds, error name).
+        await asyncio.sleep(delay)
+        async with self.semaphore:
+            start = time.perf_counter()
+            try:
+                sock = await self.connect(family, addr)
+            except (OSError, asyncio.TimeoutError) as e:
+                return None, None, type(e).__name__
+            connect = time.perf_counter() - start
+            conn = AsyncSocket(sock)
+            handshake = None
+            try:
+                if self.tls:
+                    start = time.perf_counter()
+                    try:
+                        await asyncio.wait_for(conn.start_tls(self.context, server_hostname=server_hostname), self.timeout)
+                    except (OSError, asyncio.TimeoutError) as e:
+                        return connect, None, f"TLS {type(e).__name__}"
+                    handshake = time.perf_counter() - start
+                if self.passwd is not None:
+                    return connect, handshake, await self.authenticate(conn)
+                return connect, handshake, None
+            finally:
+                conn.close()
+
+    async def authenticate(self, conn):
+        try:
+            hello, nonce = build_hello(self.passwd, '', 0, FLAG_POOL)
+            await conn.sendall(hello)
+            status = await asyncio.wait_for(read_reply(conn, self.passwd, nonce), self.timeout)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            return f"Hello {type(e).__name__}"
+        return None if status == STATUS_OK else f"Hello status {status}"
+
+    async def measure_throughput(self, family, addr, host, server_hostname):
+        # Fetches the front page, which works against the HTTPS sites tunnels
+        # usually sit behind; None when the peer sends too little.
+        async with self.semaphore:
+            conn = None
+            try:
+                conn = AsyncSocket(await self.connect(family, addr))
+                if self.tls:
+                    await asyncio.wait_for(conn.start_tls(self.context, server_hostname=server_hostname), self.timeout)
+                await conn.sendall(f"GET / HTTP/1.1\r\nHost: {host}\r\nAccept: */*\r\nConnection: close\r\n\r\n".encode('ascii'))
+                received, first, last = 0, None, None
+                deadline = time.perf_counter() + self.timeout
+                while received < THROUGHPUT_BYTES:
+                    try:
+                        data = await asyncio.wait_for(conn.recv(65536), max(deadline - time.perf_counter(), 0.001))
+                    except asyncio.TimeoutError:
+                        break
+                    if not data:
+                        break
+                    last = time.perf_counter()
+                    # Timing from the first chunk excludes the server's think time.
+                    if first is None:
+                        first = last
+                    else:
+                        received += len(data)
+            except (OSError, asyncio.TimeoutError):
+                return None
+            finally:
+                if conn:
+                    conn.close()
+        if received < MIN_THROUGHPUT_BYTES:
+            return None
+        return round(received * 8 / (last - first) / 1e6, 2)
@@ -0,0 +1,162 @@
+import hashlib
+import hmac
+import ipaddress
+import os
+import struct
+import time
+from collections import OrderedDict
+
+# Handshake v2 (client -> server), all integers big-endian:
+#   magic (3) | version (1) | flags (1) | timestamp (8) | nonce (16)
+#   | atyp (1) | address | port (2) | hmac-sha256 over everything before (32)
+# followed directly by stream data (early data). The server answers with
+#   version (1) | status (1) | hmac-sha256(passwd, b'reply' + nonce + status)[:16]
+# or, for a hello it does not accept, with REJECT.
+# v1 clients start with the raw password, which never begins with NUL.
+MAGIC = b'\x00TL'
+VERSION = 2
+FLAG_MUX = 1
+# Set by reverse-tunnel clients offering the connection as backhaul.
+FLAG_REVERSE = 2
+# Asks for a UDP association (see tlex.udp) instead of a TCP stream.
+FLAG_UDP = 4
+# Bits 3-4 offer a compression codec (ids in tlex.compress); 0 means none.
+CODEC_SHIFT = 3
+CODEC_MASK = 3 << CODEC_SHIFT
+# Sent by pooled connections as soon as they are dialled, with an empty
+# target: the server only authenticates and answers. The hello with the
+# real target follows on the same connection once it is used.
+FLAG_POOL = 32
+ATYP_IPV4, ATYP_DOMAIN, ATYP_IPV6 = 1, 3, 4
+STATUS_OK, STATUS_CONNECT_FAILED, STATUS_REFUSED = 0, 1, 2
+# Servers that predate FLAG_UDP ignore it and answer STATUS_OK after a TCP
+# connect, so UDP associations are confirmed with a status of their own.
+STATUS_UDP = 3
+# Likewise, STATUS_COMPRESSED accepts the offered codec; STATUS_OK declines it.
+STATUS_COMPRESSED = 4
+# A hello with a bad MAC, a stale timestamp or a replayed nonce is answered
+# with REJECT, which is unsigned and always the same: it only tells the
+# client that the server speaks v2 and turned the hello down. Servers that
+# only speak v1 (blocking mode) send REJECT_V1 instead.
+STATUS_REJECTED = 5
+FIXED = struct.Struct('>BBQ16s')
+MAC_SIZE = 32
+REPLY_MAC_SIZE = 16
+REPLY_SIZE = 2 + REPLY_MAC_SIZE
+REJECT = bytes([VERSION, STATUS_REJECTED]) + bytes(REPLY_MAC_SIZE)
+REJECT_V1 = bytes([1, STATUS_REJECTED]) + bytes(REPLY_MAC_SIZE)
+MAX_CLOCK_SKEW = 120
+MAX_EARLY_DATA = 16 * 1024
+
+class Hello:
+    def __init__(self, version, host, port, flags=0, nonce=None):
+        self.version = version
+        self.host = host
+        self.port = port
+        self.flags = flags
+        self.nonce = nonce
+
+    @property
+    def mux(self):
+        return bool(self.flags & FLAG_MUX)
+
+    @property
+    def reverse(self):
+        return bool(self.flags & FLAG_REVERSE)
+
+    @property
+    def udp(self):
+        return bool(self.flags & FLAG_UDP)
+
+    @property
+    def pool(self):
+        return bool(self.flags & FLAG_POOL)
+
+    @property
+    def codec(self):
+        return (self.flags & CODEC_MASK) >> CODEC_SHIFT
+
+class ReplayCache:
+    # Nonces in arrival order. A hello accepted now carries a timestamp no
+    # later than now + MAX_CLOCK_SKEW, so it can be replayed for at most
+    # twice the skew; older entries are dropped from the front as they age.
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.seen = OrderedDict()
+
+    def check(self, nonce, timestamp):
+        if abs(time.time() - timestamp) > MAX_CLOCK_SKEW or nonce in self.seen:
+            return False
+        now = time.monotonic()
+        while self.seen and next(iter(self.seen.values())) <= now:
+            self.seen.popitem(last=False)
+        # Only hellos with a valid MAC get here, so the cache fills up from
+        # real load; past max_size the oldest nonce goes rather than the
+        # new client.
+        if len(self.seen) >= self.max_size:
+            self.seen.popitem(last=False)
+        self.seen[nonce] = now + 2 * MAX_CLOCK_SKEW
+        return True
+
+def sign(passwd, data, size=MAC_SIZE):
+    return hmac.new(passwd.encode('utf-8'), data, hashlib.sha256).digest()[:size]
+
+def encode_address(host, port):
+    try:
+        ip = ipaddress.ip_address(host)
+        atyp = ATYP_IPV4 if ip.version == 4 else ATYP_IPV6
+        address = bytes([atyp]) + ip.packed
+    except ValueError:
+        host_bytes = host.encode('idna') if host else b''
+        address = bytes([ATYP_DOMAIN, len(host_bytes)]) + host_bytes
+    return address + port.to_bytes(2, 'big')
+
+async def read_address(conn):
+    atyp_bytes = await conn.readexactly(1)
+    atyp = atyp_bytes[0]
+    if atyp == ATYP_IPV4:
+        raw = await conn.readexactly(4)
+        host = str(ipaddress.IPv4Address(raw))
+    elif atyp == ATYP_IPV6:
+        raw = await conn.readexactly(16)
+        host = str(ipaddress.IPv6Address(raw))
+    elif atyp == ATYP_DOMAIN:
+        length = await conn.readexactly(1)
+        raw = length + await conn.readexactly(length[0])
+        host = raw[1:].decode('idna')
+    else:
+        raise ValueError(f"Unknown address type {atyp}")
+    port_bytes = await conn.readexactly(2)
+    return host, int.from_bytes(port_bytes, 'big'), atyp_bytes + raw + port_bytes
+
+def build_hello(passwd, host, port, flags=0):
+    nonce = os.urandom(16)
+    data = MAGIC + FIXED.pack(VERSION, flags, int(time.time()), nonce) + encode_address(host, port)
+    return data + sign(passwd, data), nonce
+
+async def read_hello(conn, passwd, replay_cache):
+    # The caller has already consumed MAGIC.
+    fixed = await conn.readexactly(FIXED.size)
+    version, flags, timestamp, nonce = FIXED.unpack(fixed)
+    if version != VERSION:
+        raise ValueError(f"Unsupported handshake version {version}")
+    host, port, address = await read_address(conn)
+    mac = await conn.readexactly(MAC_SIZE)
+    if not hmac.compare_digest(mac, sign(passwd, MAGIC + fixed + address)):
+        return None
+    if not replay_cache.check(nonce, timestamp):
+        return None
+    return Hello(VERSION, host, port, flags, nonce)
+
+def build_reply(passwd, nonce, status):
+    return bytes([VERSION, status]) + sign(passwd, b'reply' + nonce + bytes([status]), REPLY_MAC_SIZE)
+
+async def read_reply(conn, passwd, nonce):
+    reply = await conn.readexactly(REPLY_SIZE)
+    if reply[0] != VERSION:
+        raise ConnectionRefusedError(f"Server only speaks handshake v{reply[0]}; set handshake_version={reply[0]} to use it")
+    if reply == REJECT:
+        return STATUS_REJECTED
+    if not hmac.compare_digest(reply, build_reply(passwd, nonce, reply[1])):
+        return None
+    return reply[1]
@@ -0,0 +1,139 @@
+import asyncio
+import ipaddress
+import socket
+import time
+from collections import OrderedDict
+from tlex.utils import AsyncSocket, logger
+
+def interleave(infos):
+    # RFC 8305 section 4: alternate address families, preferring the first one returned.
+    families = OrderedDict()
+    for info in infos:
+        families.setdefault(info[0], []).append(info)
+    ordered = []
+    queues = list(families.values())
+    while queues:
+        for queue in queues:
+            ordered.append(queue.pop(0))
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+async def connect_happy_eyeballs(infos, delay=0.25):
+    loop = asyncio.get_running_loop()
+
+    async def attempt(info):
+        family, type_, proto, _, addr = info
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, addr)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    remaining = iter(interleave(infos))
+    next_info = next(remaining, None)
+    pending = set()
+    errors = []
+    winner = None
+    try:
+        while winner is None and (next_info is not None or pending):
+            if next_info is not None:
+                pending.add(asyncio.create_task(attempt(next_info)))
+                next_info = next(remaining, None)
+            done, pending = await asyncio.wait(pending, timeout=delay if next_info is not None else None, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    task.result().close()
+    finally:
+        for task in pending:
+            task.cancel()
+    if winner is None:
+        raise errors[0] if errors else OSError("No addresses to connect to")
+    return winner
+
+class Resolver:
+    def __init__(self, ttl=300, negative_ttl=30, max_size=1024, connect_timeout=10, happy_eyeballs_delay=0.25):
+        # getaddrinfo does not expose record TTLs, so ttl is an upper bound
+        # on how long an answer is reused.
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        self.cache = OrderedDict()
+        self.inflight = {}
+        self.stats = {'hits': 0, 'misses': 0, 'negative_hits': 0, 'errors': 0, 'evictions': 0, 'resolve_seconds': 0.0}
+
+    def hit_rate(self):
+        hits = self.stats['hits'] + self.stats['negative_hits']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
+
+    def avg_resolve_ms(self):
+        misses = self.stats['misses']
+        return self.stats['resolve_seconds'] * 1000 / misses if misses else 0.0
+
+    async def resolve(self, host, port):
+        try:
+            ip = ipaddress.ip_address(host)
+            family = socket.AF_INET if ip.version == 4 else socket.AF_INET6
+            return [(family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', (host, port))]
+        except ValueError:
+            pass
+        entry = self.cache.get(host)
+        if entry is not None:
+            expires, infos, error = entry
+            if expires > time.monotonic():
+                self.cache.move_to_end(host)
+                if error is not None:
+                    self.stats['negative_hits'] += 1
+                    raise error
+                self.stats['hits'] += 1
+                return [info[:4] + ((info[4][0], port) + info[4][2:],) for info in infos]
+            del self.cache[host]
+        if host not in self.inflight:
+            self.inflight[host] = asyncio.ensure_future(self.lookup(host))
+        infos = await asyncio.shield(self.inflight[host])
+        return [info[:4] + ((info[4][0], port) + info[4][2:],) for info in infos]
+
+    async def lookup(self, host):
+        loop = asyncio.get_running_loop()
+        self.stats['misses'] += 1
+        start = time.monotonic()
+        try:
+            infos = await loop.getaddrinfo(host, 0, type=socket.SOCK_STREAM)
+            self.store(host, self.ttl, infos, None)
+            return infos
+        except socket.gaierror as e:
+            self.stats['errors'] += 1
+            self.store(host, self.negative_ttl, None, e)
+            raise
+        finally:
+            self.stats['resolve_seconds'] += time.monotonic() - start
+            self.inflight.pop(host, None)
+
+    def store(self, host, ttl, infos, error):
+        if ttl <= 0:
+            return
+        self.cache[host] = (time.monotonic() + ttl, infos, error)
+        self.cache.move_to_end(host)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    async def open_connection(self, host, port):
+        async def connect():
+            infos = await self.resolve(host, port)
+            return await connect_happy_eyeballs(infos, self.happy_eyeballs_delay)
+        try:
+            sock = await asyncio.wait_for(connect(), self.connect_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Connect to {host}:{port} timed out after {self.connect_timeout}s")
+            raise TimeoutError(f"Connect to {host}:{port} timed out")
+        return AsyncSocket(sock)
@@ -1,5 +1,16 @@
-from sshtunnel import SSHTunnelForwarder
-from tlex.utils import logger
+import asyncio
+import socket
+import time
+from collections import deque
+from tlex.utils import PipeHandler, AsyncSocket, IdleReaper, logger, open_connection
+from tlex.server import TunnelServer
+from tlex.client import TunnelClient
+from tlex.mux import MuxSession, MUX_TARGET
+from tlex.metrics import Metrics
+from tlex.protocol import FLAG_MUX, FLAG_REVERSE, STATUS_OK, STATUS_REFUSED, build_hello, read_reply
+
+# Sent by the public node on an idle backhaul connection when it hands it a user.
+ACTIVATE = b'\x01'
 
 class ReverseTunnel:
     def __init__(self, server, port, username, remote_port):
@@ -10,6 +21,7 @@ class ReverseTunnel:
         self.tunnel = None
 
     def start(self):
+        from sshtunnel import SSHTunnelForwarder
         self.tunnel = SSHTunnelForwarder(
             (self.server, self.port),
             ssh_username=self.username,
@@ -23,3 +35,302 @@ class ReverseTunnel:
         if self.tunnel:
             self.tunnel.stop()
             logger.info("Reverse tunnel stopped!")
+
+class ReverseTunnelServer(TunnelServer):
+    # Public node: users connect to public_port and are handed to backhaul
+    # connections that the inner node dialed out ahead of time.
+    public_host = '0.0.0.0'
+    public_port = 8080
+    backhaul_timeout = 10
+
+    def __init__(self, listen_host='0.0.0.0', listen_port=443, cert_file=None, key_file=None, passwd='', use_ssl=True, public_host='0.0.0.0', public_port=8080, backhaul_timeout=10, **kwargs):
+        if kwargs.pop('workers', 1) > 1:
+            logger.warning("Reverse tunnels run in a single process; ignoring workers")
+        super().__init__(listen_host, listen_port, cert_file, key_file, passwd, use_ssl, 'tls' if use_ssl else 'plain', **kwargs)
+        self.is_reverse = True
+        self.public_host = public_host
+        self.public_port = public_port
+        self.backhaul_timeout = backhaul_timeout
+        self.public_listener = None
+
+    def setup(self):
+        super().setup()
+        try:
+            self.public_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.public_listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.public_listener.bind((self.public_host, self.public_port))
+            self.public_listener.listen(self.backlog)
+            logger.info(f"Reverse tunnel exposed on {self.public_host}:{self.public_port}")
+        except OSError as e:
+            logger.error(f"Bind error: {e}. Public port may be in use or invalid host.")
+            self.listener.close()
+            raise
+
+    async def serve(self):
+        self.idle = deque()
+        self.waiters = deque()
+        self.sessions = []
+        self.public_listener.setblocking(False)
+        try:
+            await super().serve()
+        finally:
+            self.public_listener.close()
+            while self.idle:
+                conn, _ = self.idle.popleft()
+                conn.close()
+
+    async def accept_loop(self):
+        try:
+            await asyncio.gather(super().accept_loop(), super().accept_loop(self.public_listener, self.handle_public), self.expire_loop())
+        finally:
+            self.public_listener.close()
+
+    def snapshot(self):
+        stats = super().snapshot()
+        stats['backhaul_idle'] = len(getattr(self, 'idle', ()))
+        stats['backhaul_sessions'] = len(getattr(self, 'sessions', ()))
+        return stats
+
+    async def handle_connection(self, sock, addr):
+        conn = AsyncSocket(sock)
+        parked = False
+        start = time.perf_counter()
+        try:
+            hello = await self.accept_handshake(conn, addr)
+            if hello is None:
+                return
+            self.metrics.observe('handshake_seconds', time.perf_counter() - start)
+            if not hello.reverse:
+                logger.warning(f"Forward tunnel client {addr} connected to a reverse server")
+                if hello.version > 1:
+                    await conn.sendall(self.reply(hello, STATUS_REFUSED))
+                return
+            await conn.sendall(self.reply(hello))
+            if hello.mux:
+                session = MuxSession(conn, True, None, self.max_streams)
+                self.sessions.append(session)
+                self.access.connection(addr, action="Multiplexed backhaul session started")
+                try:
+                    await session.run()
+                finally:
+                    self.sessions.remove(session)
+                return
+            self.offer(conn)
+            parked = True
+        except asyncio.IncompleteReadError:
+            logger.debug(f"Backhaul connection from {addr} closed during handshake")
+        except Exception as e:
+            self.access.error(addr, e, "Error handling backhaul")
+        finally:
+            if not parked:
+                conn.close()
+
+    def offer(self, conn):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(conn)
+                return
+        self.idle.append((conn, time.monotonic()))
+
+    async def acquire(self):
+        while self.idle:
+            conn, _ = self.idle.popleft()
+            if conn.is_alive():
+                return conn
+            conn.close()
+        self.metrics.inc('backhaul_waits_total')
+        waiter = self.loop.create_future()
+        self.waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter, self.backhaul_timeout)
+        except asyncio.TimeoutError:
+            self.metrics.inc('backhaul_timeouts_total')
+            raise TimeoutError(f"No backhaul connection within {self.backhaul_timeout}s")
+
+    async def expire_loop(self):
+        # Idle backhaul is closed here, never by the inner node, so a
+        # connection cannot be handed out while the other side drops it.
+        while True:
+            await asyncio.sleep(max(self.pool_idle_timeout / 4, 1))
+            now = time.monotonic()
+            alive = deque()
+            for conn, parked_at in self.idle:
+                if now - parked_at > self.pool_idle_timeout or not conn.is_alive():
+                    conn.close()
+                else:
+                    alive.append((conn, parked_at))
+            self.idle = alive
+
+    async def handle_public(self, sock, addr):
+        user_conn = AsyncSocket(sock)
+        backhaul = None
+        start = time.perf_counter()
+        try:
+            sessions = [session for session in self.sessions if not session.closed]
+            if sessions:
+                session = min(sessions, key=lambda s: len(s.streams))
+                backhaul = session.open_stream(*MUX_TARGET)
+            else:
+                backhaul = await self.acquire()
+                await backhaul.sendall(ACTIVATE)
+            self.metrics.observe('connect_seconds', time.perf_counter() - start)
+            self.access.connection(addr, action="Public connection handed to backhaul")
+            await PipeHandler.relay(user_conn, backhaul, self.metrics, self.reaper)
+        except Exception as e:
+            self.metrics.inc('connect_errors_total')
+            self.access.error(addr, e, "Error handling public")
+        finally:
+            user_conn.close()
+            if backhaul:
+                backhaul.close()
+
+    def stop(self):
+        super().stop()
+        if self.public_listener and not self.loop:
+            self.public_listener.close()
+
+class ReverseTunnelClient(TunnelClient):
+    # Inner node: keeps authenticated connections open to the public node and
+    # bridges each one that gets activated to the local service.
+    pool_min = 4
+    pool_max = 64
+    max_streams = 1024
+
+    def __init__(self, server_host='', server_port=443, local_host='127.0.0.1', local_port=80, passwd='', ca_cert=None, use_ssl=True, pool_min=4, pool_max=64, max_streams=1024, **kwargs):
+        super().__init__(local_host, local_port, server_host, server_port, local_host, local_port, passwd, ca_cert, use_ssl, 'tls' if use_ssl else 'plain', **kwargs)
+        self.is_reverse = True
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self.max_streams = max_streams
+
+    def setup(self):
+        # Nothing listens on this side; the service is only reached outbound.
+        self.load_context()
+        self.create_access_log()
+        logger.info(f"Reverse client exposing {self.local_host}:{self.local_port} via {self.describe_servers()} (SSL: {self.use_ssl}, mux: {self.mux})")
+
+    def run(self):
+        self.setup()
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.connections = set()
+        self.metrics = Metrics()
+        self.reaper = IdleReaper(self.idle_timeout, self.metrics)
+        self.start_metrics_server()
+        self.start_health_checks()
+        self.server_version = 2
+        self.idle = 0
+        self.connecting = 0
+        self.target = self.pool_min
+        self.activations = 0
+        self.backoff = 0
+        self.wakeup = asyncio.Event()
+        maintain_task = asyncio.create_task(self.maintain())
+        summary_task = asyncio.create_task(self.access.summary_loop())
+        reaper_task = asyncio.create_task(self.reaper.run())
+        await self.stopping.wait()
+        maintain_task.cancel()
+        summary_task.cancel()
+        reaper_task.cancel()
+        self.stop_health_checks()
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(maintain_task, *self.connections, return_exceptions=True)
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    def snapshot(self):
+        stats = super().snapshot()
+        stats['backhaul_idle'] = getattr(self, 'idle', 0)
+        stats['backhaul_target'] = getattr(self, 'target', 0)
+        return stats
+
+    async def maintain(self):
+        last = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now - last >= 1:
+                # Keep twice the last second's activations idle, within bounds.
+                rate = self.activations / (now - last)
+                self.target = min(self.pool_max, max(self.pool_min, int(rate * 2 + 0.5)))
+                self.activations = 0
+                last = now
+            wanted = self.mux_connections if self.mux else self.target
+            while self.idle + self.connecting < wanted:
+                self.connecting += 1
+                task = asyncio.create_task(self.backhaul())
+                self.connections.add(task)
+                task.add_done_callback(self.connections.discard)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def backhaul(self):
+        conn = None
+        try:
+            conn = await asyncio.wait_for(self.connect_server(), self.connect_timeout)
+            hello, nonce = build_hello(self.passwd, *MUX_TARGET, FLAG_REVERSE | (FLAG_MUX if self.mux else 0))
+            await conn.sendall(hello)
+            status = await asyncio.wait_for(read_reply(conn, self.passwd, nonce), self.connect_timeout)
+            if status != STATUS_OK:
+                raise ConnectionError(f"Backhaul refused (status {status})")
+            self.remember_session(conn)
+            self.backoff = 0
+        except Exception as e:
+            if conn:
+                conn.close()
+            self.metrics.inc('connect_errors_total')
+            self.backoff = min(max(self.backoff * 2, 0.5), 30)
+            logger.warning(f"Backhaul dial failed: {e}; retrying in {self.backoff}s")
+            await asyncio.sleep(self.backoff)
+            return
+        finally:
+            self.connecting -= 1
+            self.wakeup.set()
+        if self.mux:
+            self.idle += 1
+            try:
+                await MuxSession(conn, False, self.handle_stream, self.max_streams).run()
+            finally:
+                self.idle -= 1
+                self.wakeup.set()
+            return
+        self.idle += 1
+        try:
+            signal = await conn.readexactly(len(ACTIVATE))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            conn.close()
+            return
+        finally:
+            self.idle -= 1
+            self.wakeup.set()
+        if signal != ACTIVATE:
+            logger.warning("Unexpected data on idle backhaul connection")
+            conn.close()
+            return
+        self.activations += 1
+        await self.handle_stream(conn)
+
+    async def handle_stream(self, backhaul, host=None, port=None):
+        local_conn = None
+        start = time.perf_counter()
+        try:
+            local_conn = await asyncio.wait_for(open_connection(self.local_host, self.local_port), self.connect_timeout)
+            self.tune_socket(local_conn.sock)
+            self.metrics.observe('connect_seconds', time.perf_counter() - start)
+            self.access.record(self.local_host, self.local_port)
+            await PipeHandler.relay(backhaul, local_conn, self.metrics, self.reaper)
+        except Exception as e:
+            self.metrics.inc('connect_errors_total')
+            self.access.error(f"{self.local_host}:{self.local_port}", e, "Error reaching local service")
+        finally:
+            backhaul.close()
+            if local_conn:
+                local_conn.close()
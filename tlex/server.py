@@ -1,13 +1,75 @@
 # tlex/server.py
 import socket
-import ssl
-import paramiko
 import subprocess
 import uuid
-from tlex.utils import PipeHandler, BUFFER_SIZE, logger, generate_x25519_keys, generate_wireguard_keys
+import asyncio
+import hmac
+import json
+import os
+import random
+import threading
+import functools
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tlex.utils import PipeHandler, AsyncSocket, IdleReaper, BUFFER_SIZE, SSH_WINDOW_SIZE, SSH_MAX_PACKET_SIZE, logger, configure_socket, generate_x25519_keys, generate_wireguard_keys
+from tlex.mux import MuxSession, MUX_TARGET, MUX_VERSION
+from tlex.tls import create_server_context, DEFAULT_CIPHERS, KTLS_SUPPORTED
+from tlex.resolver import Resolver
+from tlex.metrics import Metrics, MetricsServer
+from tlex.protocol import Hello, ReplayCache, MAGIC, FLAG_MUX, STATUS_OK, STATUS_CONNECT_FAILED, STATUS_REFUSED, STATUS_UDP, STATUS_COMPRESSED, REJECT, REJECT_V1, read_hello, build_reply
+from tlex.udp import UdpAssociation
+from tlex.compress import CompressedConn, CODEC_NAMES, codec_available
+from tlex.logs import AccessLog
+from tlex.admission import AdmissionControl
 
 class TunnelServer:
-    def __init__(self, listen_host='0.0.0.0', listen_port=443, cert_file=None, key_file=None, passwd='', use_ssl=True, protocol='tls'):
+    # Class-level defaults keep configs pickled by older versions loadable.
+    async_mode = True
+    backlog = 128
+    max_connections = 1024
+    # Every client, pooled or not, must authenticate within handshake_timeout
+    # (v1 clients: send the password). Only then may a pooled connection
+    # idle for up to pool_idle_timeout before sending its target.
+    handshake_timeout = 30
+    allow_mux = True
+    max_streams = 1024
+    pool_idle_timeout = 300
+    tls_tickets = 2
+    tls_ciphers = DEFAULT_CIPHERS
+    ecdh_curve = None
+    connect_timeout = 10
+    happy_eyeballs_delay = 0.25
+    dns_cache_ttl = 300
+    dns_negative_ttl = 30
+    dns_cache_size = 1024
+    workers = 1
+    drain_timeout = 30
+    metrics_port = None
+    metrics_host = '127.0.0.1'
+    ssh_host_key_file = None
+    ssh_window_size = SSH_WINDOW_SIZE
+    ssh_max_packet_size = SSH_MAX_PACKET_SIZE
+    allow_udp = True
+    udp_idle_timeout = 60
+    udp_max_sessions = 1024
+    compression = True
+    log_level = None
+    log_rate = 10
+    log_summary_interval = 60
+    idle_timeout = 300
+    tcp_nodelay = True
+    tcp_keepalive = 60
+    socket_buffer = 0
+    ktls = False
+    max_connections_per_ip = 0
+    connection_rate_per_ip = 0
+    auth_penalty = 1
+    max_auth_penalty = 300
+    reaper = None
+    admission = None
+
+    def __init__(self, listen_host='0.0.0.0', listen_port=443, cert_file=None, key_file=None, passwd='', use_ssl=True, protocol='tls', async_mode=True, backlog=128, max_connections=1024, handshake_timeout=30, allow_mux=True, max_streams=1024, pool_idle_timeout=300, tls_tickets=2, tls_ciphers=DEFAULT_CIPHERS, ecdh_curve=None, connect_timeout=10, happy_eyeballs_delay=0.25, dns_cache_ttl=300, dns_negative_ttl=30, dns_cache_size=1024, workers=1, drain_timeout=30, metrics_port=None, metrics_host='127.0.0.1', ssh_host_key_file=None, ssh_window_size=SSH_WINDOW_SIZE, ssh_max_packet_size=SSH_MAX_PACKET_SIZE, allow_udp=True, udp_idle_timeout=60, udp_max_sessions=1024, compression=True, log_level=None, log_rate=10, log_summary_interval=60, idle_timeout=300, tcp_nodelay=True, tcp_keepalive=60, socket_buffer=0, ktls=False, max_connections_per_ip=0, connection_rate_per_ip=0, auth_penalty=1, max_auth_penalty=300):
         self.listen_host = listen_host
         self.listen_port = listen_port
         self.cert_file = cert_file
@@ -16,23 +78,94 @@ class TunnelServer:
         self.use_ssl = use_ssl
         self.protocol = protocol.lower()
         self.context = None
-        self.ssh_host_key = paramiko.RSAKey.generate(2048) if protocol == 'ssh' else None
-        if self.protocol == 'tls' and self.use_ssl:
-            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            self.context.load_cert_chain(certfile=self.cert_file, keyfile=self.key_file)
+        # Loaded (or created) on first run instead of generating a key per start.
+        self.ssh_host_key = None
+        self.ssh_host_key_file = ssh_host_key_file
+        self.ssh_window_size = ssh_window_size
+        self.ssh_max_packet_size = ssh_max_packet_size
+        self.tls_tickets = tls_tickets
+        self.tls_ciphers = tls_ciphers
+        self.ecdh_curve = ecdh_curve
+        self.tls_stats = {'handshakes': 0, 'resumed': 0, 'ktls': 0}
+        self.connect_timeout = connect_timeout
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        self.dns_cache_ttl = dns_cache_ttl
+        self.dns_negative_ttl = dns_negative_ttl
+        self.dns_cache_size = dns_cache_size
+        self.resolver = None
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.supervisor = None
+        self.accepted = 0
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics = None
+        self.metrics_server = None
+        self.load_context()
+        self.async_mode = async_mode
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.handshake_timeout = handshake_timeout
+        self.allow_mux = allow_mux
+        self.max_streams = max_streams
+        self.pool_idle_timeout = pool_idle_timeout
+        self.allow_udp = allow_udp
+        self.udp_idle_timeout = udp_idle_timeout
+        self.udp_max_sessions = udp_max_sessions
+        # Accept codecs offered by clients (any this host can import).
+        self.compression = compression
+        # Per-connection lines: level, lines per second (0 for none), and
+        # seconds between summaries (0 for none).
+        self.log_level = log_level
+        self.log_rate = log_rate
+        self.log_summary_interval = log_summary_interval
+        self.access = None
+        # Relays idle this long are closed (0 keeps them open); tcp_keepalive
+        # is the idle time in seconds before keepalive probes, socket_buffer
+        # a fixed SO_RCVBUF/SO_SNDBUF size (0 leaves the kernel default).
+        self.idle_timeout = idle_timeout
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_keepalive = tcp_keepalive
+        self.socket_buffer = socket_buffer
+        # Hand TLS record encryption to the kernel where it can take it.
+        self.ktls = ktls
+        # Admission: concurrent connections and new connections per second
+        # allowed from one address (0 for no limit), and the seconds a
+        # source is locked out after a failed handshake, doubling per
+        # failure in a row up to max_auth_penalty (0 for no lockout).
+        self.max_connections_per_ip = max_connections_per_ip
+        self.connection_rate_per_ip = connection_rate_per_ip
+        self.auth_penalty = auth_penalty
+        self.max_auth_penalty = max_auth_penalty
+        self.reaper = None
+        self.admission = None
         self.listener = None
         self.is_reverse = False
         self.process = None
+        self.loop = None
+        self.stopping = None
+
+    def load_context(self):
+        if self.protocol == 'tls' and self.use_ssl:
+            self.context = create_server_context(self.cert_file, self.key_file, self.tls_tickets, self.tls_ciphers, self.ecdh_curve, self.ktls)
 
     def setup(self):
+        # SSL contexts do not survive a round-trip through the config file,
+        # and reloading here also picks up renewed certificates.
+        self.load_context()
+        if self.ktls and self.context and not KTLS_SUPPORTED:
+            logger.warning("Kernel TLS needs Python 3.12 or newer; encrypting in user space")
+        self.access = AccessLog(f"server {self.listen_host}:{self.listen_port}", self.log_level, self.log_rate, self.log_summary_interval)
         try:
             if self.protocol in ['wireguard', 'vless']:
                 self.setup_advanced()
             else:
                 self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if self.workers > 1:
+                    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
                 self.listener.bind((self.listen_host, self.listen_port))
-                self.listener.listen(5)
+                self.listener.listen(self.backlog)
             logger.info(f"Server listening on {self.listen_host}:{self.listen_port} (Protocol: {self.protocol.upper()}, SSL: {self.use_ssl})")
         except OSError as e:
             logger.error(f"Bind error: {e}. Port may be in use or invalid host.")
@@ -97,56 +230,449 @@ ListenPort = {self.listen_port}
             logger.info(f"{self.protocol.upper()} tunnel active. Use client to connect.")
             while True:
                 time.sleep(1)  # Keep running
+        if self.protocol == 'ssh':
+            self.load_ssh_host_key()
+        if self.async_mode and self.workers > 1:
+            from tlex.workers import WorkerSupervisor
+            # Workers bind their own SO_REUSEPORT listeners; a socket left
+            # open here would get a share of connections nobody accepts.
+            if self.listener:
+                self.listener.close()
+                self.listener = None
+            self.supervisor = WorkerSupervisor(self, self.workers, self.drain_timeout)
+            self.start_metrics_server(self.supervisor.stats)
+            try:
+                self.supervisor.run()
+            finally:
+                self.stop_metrics_server()
+            return
         if not self.listener:
             self.setup()
+        if self.async_mode:
+            asyncio.run(self.serve())
+            return
         while True:
             try:
                 client_sock_tmp, addr = self.listener.accept()
-                logger.info(f"Accepted connection from {addr}")
-                client_conn = client_sock_tmp
-                if self.protocol == 'tls' and self.use_ssl:
-                    client_conn = self.context.wrap_socket(client_sock_tmp, server_side=True)
-                elif self.protocol == 'ssh':
-                    transport = paramiko.Transport(client_sock_tmp)
-                    transport.add_server_key(self.ssh_host_key)
-                    transport.start_server(server=paramiko.ServerInterface())
-                    client_conn = transport.accept(20)
-                    if client_conn is None:
-                        continue
-                
-                recv_pass = client_conn.recv(BUFFER_SIZE).decode('utf-8')
-                if recv_pass != self.passwd:
-                    logger.warning("Invalid password")
-                    client_conn.close()
-                    continue
-                
-                host_len_bytes = client_conn.recv(1)
-                if len(host_len_bytes) == 0:
-                    client_conn.close()
-                    continue
-                host_len = int.from_bytes(host_len_bytes, 'big')
-                host_bytes = client_conn.recv(host_len)
-                port_bytes = client_conn.recv(2)
-                host = host_bytes.decode('utf-8')
-                port = int.from_bytes(port_bytes, 'big')
-                
-                remote_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                remote_sock.connect((host, port))
-                logger.info(f"Connected to remote {host}:{port}")
-                
-                client_conn.sendall(self.passwd.encode('utf-8'))
-                
-                PipeHandler.pipe_sockets(client_conn, remote_sock)
-                
-                remote_sock.close()
-                client_conn.close()
+                self.handle_blocking(client_sock_tmp, addr)
             except Exception as e:
                 logger.error(f"Error in server loop: {e}")
 
+    def tune_socket(self, sock):
+        configure_socket(sock, self.tcp_nodelay, self.tcp_keepalive, self.socket_buffer)
+
+    def handle_blocking(self, client_sock_tmp, addr):
+        self.tune_socket(client_sock_tmp)
+        if self.protocol == 'ssh':
+            self.handle_ssh(client_sock_tmp, addr)
+            return
+        # A client that never sends its password must not hold the loop.
+        client_sock_tmp.settimeout(self.handshake_timeout)
+        client_conn = client_sock_tmp
+        if self.protocol == 'tls' and self.use_ssl:
+            client_conn = self.context.wrap_socket(client_sock_tmp, server_side=True)
+
+        recv_pass = client_conn.recv(BUFFER_SIZE)
+        if recv_pass.startswith(MAGIC):
+            logger.warning(f"Handshake v2 client {addr} refused: blocking mode only speaks v1")
+            client_conn.sendall(REJECT_V1)
+            client_conn.close()
+            return
+        if recv_pass.decode('utf-8') != self.passwd:
+            logger.warning("Invalid password")
+            client_conn.close()
+            return
+
+        host_len_bytes = client_conn.recv(1)
+        if len(host_len_bytes) == 0:
+            client_conn.close()
+            return
+        host_len = int.from_bytes(host_len_bytes, 'big')
+        host_bytes = client_conn.recv(host_len)
+        port_bytes = client_conn.recv(2)
+        host = host_bytes.decode('utf-8')
+        port = int.from_bytes(port_bytes, 'big')
+
+        remote_sock = socket.create_connection((host, port), self.connect_timeout)
+        self.tune_socket(remote_sock)
+        self.access.connection(addr, host, port)
+
+        client_conn.sendall(self.passwd.encode('utf-8'))
+        client_conn.settimeout(None)
+        remote_sock.settimeout(None)
+
+        PipeHandler.pipe_sockets(client_conn, remote_sock)
+
+        remote_sock.close()
+        client_conn.close()
+
+    def load_ssh_host_key(self):
+        # Backends are imported on first use, so plain and TLS tunnels
+        # start without loading paramiko.
+        from tlex.ssh import load_host_key
+        if self.ssh_host_key is None:
+            self.ssh_host_key = load_host_key(self.ssh_host_key_file)
+
+    def handle_ssh(self, sock, addr):
+        import paramiko
+        from tlex.ssh import SSHServerInterface
+        auth_failed = functools.partial(self.admission.auth_failed, addr[0]) if self.admission else None
+        interface = SSHServerInterface(self.passwd, self.metrics, auth_failed)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(sock, default_window_size=self.ssh_window_size, default_max_packet_size=self.ssh_max_packet_size)
+        transport.add_server_key(self.ssh_host_key)
+        channels = []
+        try:
+            transport.start_server(server=interface)
+            while transport.is_active() and not (self.stopping and self.stopping.is_set()):
+                chan = transport.accept(1)
+                if chan is None:
+                    continue
+                host, port = interface.destinations.pop(chan.get_id())
+                thread = threading.Thread(target=self.handle_ssh_channel, args=(chan, host, port, addr), daemon=True)
+                thread.start()
+                channels = [t for t in channels if t.is_alive()] + [thread]
+            for thread in channels:
+                thread.join()
+        except (OSError, EOFError, paramiko.SSHException) as e:
+            logger.debug(f"SSH session from {addr} ended: {e}")
+        finally:
+            transport.close()
+
+    def handle_ssh_channel(self, chan, host, port, addr):
+        from tlex.ssh import relay_channel
+        start = time.perf_counter()
+        try:
+            remote_sock = socket.create_connection((host, port), self.connect_timeout)
+        except OSError as e:
+            self.access.error(addr, e, f"Error in SSH channel to {host}:{port} for")
+            if self.metrics:
+                self.metrics.inc('connect_errors_total')
+            chan.close()
+            return
+        if self.metrics:
+            self.metrics.observe('connect_seconds', time.perf_counter() - start)
+        self.access.connection(addr, host, port)
+        self.tune_socket(remote_sock)
+        remote_sock.settimeout(None)
+        relay_channel(remote_sock, chan, self.metrics, upstream=False)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.admission = AdmissionControl(self.max_connections, self.max_connections_per_ip, self.connection_rate_per_ip, self.auth_penalty, self.max_auth_penalty)
+        self.connections = set()
+        self.replay_cache = ReplayCache()
+        self.resolver = Resolver(self.dns_cache_ttl, self.dns_negative_ttl, self.dns_cache_size, self.connect_timeout, self.happy_eyeballs_delay)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_connections) if self.protocol == 'ssh' else None
+        if self.protocol == 'ssh':
+            self.load_ssh_host_key()
+        self.metrics = Metrics()
+        self.reaper = IdleReaper(self.idle_timeout, self.metrics)
+        # Workers report to the supervisor, which serves the combined endpoint.
+        if self.workers <= 1:
+            self.start_metrics_server(self.snapshot)
+        self.listener.setblocking(False)
+        accept_task = asyncio.create_task(self.accept_loop())
+        summary_task = asyncio.create_task(self.access.summary_loop())
+        reaper_task = asyncio.create_task(self.reaper.run())
+        prune_task = asyncio.create_task(self.admission.prune_loop())
+        await self.stopping.wait()
+        accept_task.cancel()
+        await asyncio.gather(accept_task, return_exceptions=True)
+        self.listener.close()
+        if self.connections:
+            logger.info(f"Draining {len(self.connections)} connections (up to {self.drain_timeout}s)")
+            await asyncio.wait(set(self.connections), timeout=self.drain_timeout)
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        summary_task.cancel()
+        reaper_task.cancel()
+        prune_task.cancel()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        if self.workers <= 1:
+            self.stop_metrics_server()
+
+    def snapshot(self):
+        stats = self.metrics.snapshot() if self.metrics else {}
+        stats.update({
+            'connections_total': self.accepted,
+            'connections_active': len(getattr(self, 'connections', ())),
+            'tls_handshakes_total': self.tls_stats['handshakes'],
+            'tls_resumed_total': self.tls_stats['resumed'],
+            'tls_ktls_total': self.tls_stats.get('ktls', 0),
+        })
+        if self.resolver:
+            stats.update({f"dns_{key}_total": value for key, value in self.resolver.stats.items()})
+        if 'compression_payload_bytes_total' in stats:
+            stats['compression_saved_bytes'] = stats['compression_payload_bytes_total'] - stats['compression_wire_bytes_total']
+        return stats
+
+    def start_metrics_server(self, collect):
+        if self.metrics_port is None:
+            return
+        try:
+            self.metrics_server = MetricsServer(self.metrics_host, self.metrics_port, collect, {'role': 'server', 'tunnel': f"{self.listen_host}:{self.listen_port}"})
+            self.metrics_server.start()
+        except OSError as e:
+            self.metrics_server = None
+            logger.error(f"Metrics endpoint bind error: {e}")
+
+    def stop_metrics_server(self):
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    async def accept_loop(self, listener=None, handler=None):
+        listener = listener or self.listener
+        handler = handler or self.handle_connection
+        while True:
+            try:
+                sock, addr = await self.loop.sock_accept(listener)
+            except OSError as e:
+                logger.error(f"Accept error: {e}")
+                await asyncio.sleep(0.1)
+                continue
+            self.accepted += 1
+            # Connections are turned away here, before a TLS handshake is
+            # spent on them, rather than left to time out in the backlog.
+            reason = self.admission.admit(addr[0])
+            if reason:
+                self.reject(sock, addr, reason)
+                continue
+            self.tune_socket(sock)
+            task = asyncio.create_task(handler(sock, addr))
+            self.connections.add(task)
+            task.add_done_callback(functools.partial(self.connection_done, addr[0]))
+
+    def connection_done(self, ip, task):
+        self.connections.discard(task)
+        self.admission.release(ip)
+
+    def reject(self, sock, addr, reason):
+        # Reset rather than close: no TIME_WAIT is left behind on this side.
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except OSError:
+            pass
+        sock.close()
+        self.metrics.inc('admission_rejected_total', reason=reason)
+        logger.debug(f"Rejected connection from {addr}: {reason}")
+
+    async def handle_connection(self, sock, addr):
+        if self.protocol == 'ssh':
+            sock.setblocking(True)
+            try:
+                await self.loop.run_in_executor(self.executor, self.handle_ssh, sock, addr)
+            except Exception as e:
+                self.access.error(addr, e)
+            finally:
+                sock.close()
+            return
+        client_conn = AsyncSocket(sock)
+        remote_conn = None
+        start = time.perf_counter()
+        try:
+            hello = await self.accept_handshake(client_conn, addr)
+            if hello is None:
+                return
+            self.metrics.observe('handshake_seconds', time.perf_counter() - start)
+            if hello.reverse:
+                logger.warning(f"Reverse tunnel client {addr} connected to a forward server")
+                await client_conn.sendall(self.reply(hello, STATUS_REFUSED))
+                return
+            if hello.udp:
+                if not self.allow_udp:
+                    await client_conn.sendall(self.reply(hello, STATUS_REFUSED))
+                    return
+                await self.handle_udp(client_conn, hello, addr)
+                return
+            codec = self.accept_codec(hello)
+            if hello.mux:
+                if not self.allow_mux:
+                    if hello.version > 1:
+                        await client_conn.sendall(self.reply(hello, STATUS_REFUSED))
+                    return
+                await client_conn.sendall(self.reply(hello, STATUS_COMPRESSED if codec else STATUS_OK))
+                self.access.connection(addr, action="Multiplexed session started")
+                session_conn = CompressedConn(client_conn, codec, self.metrics) if codec else client_conn
+                await MuxSession(session_conn, False, functools.partial(self.handle_mux_stream, addr=addr), self.max_streams).run()
+                return
+            try:
+                remote_conn = await self.connect_remote(hello.host, hello.port)
+            except OSError:
+                if hello.version > 1:
+                    await client_conn.sendall(self.reply(hello, STATUS_CONNECT_FAILED))
+                raise
+            self.access.connection(addr, hello.host, hello.port)
+            await client_conn.sendall(self.reply(hello, STATUS_COMPRESSED if codec else STATUS_OK))
+            if codec:
+                client_conn = CompressedConn(client_conn, codec, self.metrics)
+            await PipeHandler.relay(client_conn, remote_conn, self.metrics, self.reaper)
+        except asyncio.IncompleteReadError:
+            logger.debug(f"Connection from {addr} closed before sending a target")
+        except Exception as e:
+            self.access.error(addr, e)
+        finally:
+            client_conn.close()
+            if remote_conn:
+                remote_conn.close()
+
+    async def handle_mux_stream(self, stream, host, port, addr=None):
+        remote_conn = None
+        try:
+            remote_conn = await self.connect_remote(host, port)
+            self.access.record(host, port)
+            await PipeHandler.relay(stream, remote_conn, self.metrics, self.reaper)
+        except Exception as e:
+            self.access.error(addr, e, f"Error in mux stream to {host}:{port} for")
+        finally:
+            stream.close()
+            if remote_conn:
+                remote_conn.close()
+
+    def accept_codec(self, hello):
+        name = CODEC_NAMES.get(hello.codec)
+        return name if name and self.compression and codec_available(name) else None
+
+    async def handle_udp(self, client_conn, hello, addr):
+        try:
+            infos = await self.resolver.resolve(hello.host, hello.port)
+        except OSError:
+            self.metrics.inc('connect_errors_total')
+            await client_conn.sendall(self.reply(hello, STATUS_CONNECT_FAILED))
+            raise
+        family, _, _, _, address = infos[0]
+        await client_conn.sendall(self.reply(hello, STATUS_UDP))
+        self.access.connection(addr, hello.host, hello.port, "UDP association to")
+        await UdpAssociation(client_conn, family, address, self.udp_idle_timeout, self.udp_max_sessions, self.metrics).run()
+
+    async def connect_remote(self, host, port):
+        start = time.perf_counter()
+        try:
+            remote_conn = await self.resolver.open_connection(host, port)
+        except OSError:
+            self.metrics.inc('connect_errors_total')
+            raise
+        self.tune_socket(remote_conn.sock)
+        self.metrics.observe('connect_seconds', time.perf_counter() - start)
+        return remote_conn
+
+    async def accept_handshake(self, client_conn, addr=None):
+        # Returns the client's hello, or None once the client has been turned
+        # away. Until it proves it knows the password, anything that goes
+        # wrong (a TLS error, a timeout, hanging up) counts against its
+        # address just like a wrong password: scanners fail in all of these
+        # ways.
+        try:
+            hello = await self.authenticate_client(client_conn)
+        except asyncio.TimeoutError:
+            self.metrics.inc('handshake_timeouts_total')
+            self.handshake_failed(addr, TimeoutError(f"no handshake within {self.handshake_timeout}s"))
+            return None
+        except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+            self.metrics.inc('handshake_errors_total', type=type(e).__name__)
+            self.handshake_failed(addr, e)
+            return None
+        if hello is None:
+            self.metrics.inc('auth_failures_total')
+            self.handshake_failed(addr)
+            return None
+        if addr and self.admission:
+            self.admission.auth_succeeded(addr[0])
+        try:
+            if hello.pool:
+                # Only a pooled connection that has authenticated may stay
+                # idle for pool_idle_timeout before sending its target.
+                await client_conn.sendall(self.reply(hello))
+                magic = await asyncio.wait_for(client_conn.readexactly(len(MAGIC)), self.pool_idle_timeout)
+                if magic != MAGIC:
+                    raise ValueError("Pooled connection sent no handshake")
+                hello = await self.read_hello(client_conn)
+            elif hello.version == 1:
+                host, port = await asyncio.wait_for(self.read_target(client_conn), self.pool_idle_timeout)
+                hello = Hello(1, host, port, FLAG_MUX if (host, port) == MUX_TARGET else 0)
+        except asyncio.TimeoutError:
+            logger.debug(f"Pooled connection from {addr} sent no target within {self.pool_idle_timeout}s")
+            return None
+        return hello
+
+    async def authenticate_client(self, client_conn):
+        if self.protocol == 'tls' and self.use_ssl:
+            await asyncio.wait_for(client_conn.start_tls(self.context, server_side=True), self.handshake_timeout)
+            self.tls_stats['handshakes'] += 1
+            if client_conn.sock.session_reused:
+                self.tls_stats['resumed'] += 1
+            if client_conn.ktls_send:
+                self.tls_stats['ktls'] = self.tls_stats.get('ktls', 0) + 1
+        # With no password every client authenticates, so a silent one is
+        # just an idle pooled v1 connection.
+        magic = await asyncio.wait_for(self.read_magic(client_conn), self.handshake_timeout if self.passwd else self.pool_idle_timeout)
+        if magic == MAGIC:
+            return await self.read_hello(client_conn)
+        client_conn.unread(magic)
+        if not await asyncio.wait_for(self.authenticate(client_conn), self.handshake_timeout):
+            return None
+        # v1 clients send their target after the password; it may come
+        # later if the connection is pooled.
+        return Hello(1, None, None)
+
+    async def read_magic(self, client_conn):
+        # Stops at the first byte that differs from MAGIC: v1 clients start
+        # with the password (or, if it is empty, the target), which may be
+        # shorter than MAGIC and followed by nothing until the pool uses it.
+        data = b''
+        while len(data) < len(MAGIC) and MAGIC.startswith(data):
+            data += await client_conn.readexactly(1)
+        return data
+
+    def handshake_failed(self, addr, error=None):
+        if error is not None:
+            if isinstance(error, asyncio.IncompleteReadError) and not error.partial:
+                logger.debug(f"Connection from {addr} closed before the handshake")
+            else:
+                self.access.error(addr, error, "Handshake failed for")
+        if addr and self.admission:
+            self.admission.auth_failed(addr[0])
+
+    async def read_hello(self, client_conn):
+        hello = await asyncio.wait_for(read_hello(client_conn, self.passwd, self.replay_cache), self.handshake_timeout)
+        if hello is None:
+            logger.warning("Invalid handshake token")
+            await client_conn.sendall(REJECT)
+        return hello
+
+    async def authenticate(self, client_conn):
+        passwd = self.passwd.encode('utf-8')
+        recv_pass = await client_conn.readexactly(len(passwd))
+        if not hmac.compare_digest(recv_pass, passwd):
+            logger.warning("Invalid password")
+            return False
+        return True
+
+    async def read_target(self, client_conn):
+        host_len = int.from_bytes(await client_conn.readexactly(1), 'big')
+        host = (await client_conn.readexactly(host_len)).decode('utf-8')
+        port = int.from_bytes(await client_conn.readexactly(2), 'big')
+        return host, port
+
+    def reply(self, hello, status=STATUS_OK):
+        if hello.version == 1:
+            return self.passwd.encode('utf-8') + (bytes([MUX_VERSION]) if hello.mux else b'')
+        return build_reply(self.passwd, hello.nonce, status)
+
     def stop(self):
         if self.protocol in ['wireguard', 'vless']:
             if self.process:
                 self.process.terminate()
-        if self.listener:
+        if self.supervisor:
+            self.supervisor.stop()
+            logger.info("Server stopped")
+        elif self.loop and self.stopping and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            logger.info("Server stopped")
+        elif self.listener:
             self.listener.close()
-            logger.info("Server stopped")
\ No newline at end of file
+            logger.info("Server stopped")
@@ -0,0 +1,165 @@
+import hmac
+import os
+import socket
+import threading
+import time
+import paramiko
+from tlex.utils import logger, SSH_WINDOW_SIZE, SSH_MAX_PACKET_SIZE
+
+DEFAULT_HOST_KEY_FILE = os.path.expanduser('~/tlex_ssh_host_key')
+CHUNK = 32 * 1024
+
+def load_host_key(path=None):
+    path = path or DEFAULT_HOST_KEY_FILE
+    if os.path.exists(path):
+        for key_class in (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey):
+            try:
+                return key_class.from_private_key_file(path)
+            except paramiko.SSHException:
+                continue
+        raise paramiko.SSHException(f"Unsupported host key in {path}")
+    # ECDSA generation takes milliseconds, unlike a 2048-bit RSA key.
+    key = paramiko.ECDSAKey.generate()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        key.write_private_key(f)
+    logger.info(f"Generated SSH host key {key.fingerprint} in {path}")
+    return key
+
+def copy(src, dst, shutdown, metrics=None, direction='upstream'):
+    bytes_key = metrics.counter(f"bytes_{direction}_total") if metrics else None
+    try:
+        while True:
+            data = src.recv(CHUNK)
+            if not data:
+                break
+            dst.sendall(data)
+            if bytes_key:
+                metrics.add(bytes_key, len(data))
+    except (OSError, EOFError, paramiko.SSHException) as e:
+        logger.debug(f"SSH relay error: {e}")
+        if metrics:
+            metrics.inc('relay_errors_total', type=type(e).__name__)
+    finally:
+        try:
+            shutdown()
+        except (OSError, EOFError):
+            pass
+
+def relay_channel(sock, chan, metrics=None, upstream=True):
+    # Channels are blocking file-likes, so each direction gets its own thread.
+    # upstream says whether sock -> chan travels towards the target.
+    directions = ('upstream', 'downstream') if upstream else ('downstream', 'upstream')
+    thread = threading.Thread(target=copy, args=(sock, chan, chan.shutdown_write, metrics, directions[0]), daemon=True)
+    thread.start()
+    copy(chan, sock, lambda: sock.shutdown(socket.SHUT_WR), metrics, directions[1])
+    thread.join()
+    chan.close()
+    sock.close()
+
+class SSHServerInterface(paramiko.ServerInterface):
+    def __init__(self, passwd, metrics=None, auth_failed=None):
+        self.passwd = passwd.encode('utf-8')
+        self.metrics = metrics
+        self.auth_failed = auth_failed
+        self.destinations = {}
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if hmac.compare_digest(password.encode('utf-8'), self.passwd):
+            return paramiko.AUTH_SUCCESSFUL
+        logger.warning("Invalid password")
+        if self.metrics:
+            self.metrics.inc('auth_failures_total')
+        if self.auth_failed:
+            self.auth_failed()
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'direct-tcpip':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.destinations[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+class SSHConnection:
+    # One authenticated transport per server; every local connection becomes
+    # a direct-tcpip channel on it. Reconnects on demand with backoff.
+    def __init__(self, host, port, username, passwd, window_size=SSH_WINDOW_SIZE, max_packet_size=SSH_MAX_PACKET_SIZE, connect_timeout=30, keepalive=30, max_backoff=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.passwd = passwd
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self.max_backoff = max_backoff
+        self.transport = None
+        self.lock = threading.Lock()
+        self.backoff = 0
+        self.retry_at = 0
+        self.error = None
+        self.host_key = None
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(sock, default_window_size=self.window_size, default_max_packet_size=self.max_packet_size)
+        try:
+            transport.start_client(timeout=self.connect_timeout)
+            key = transport.get_remote_server_key()
+            if self.host_key is not None and key != self.host_key:
+                logger.warning(f"SSH host key for {self.host}:{self.port} changed to {key.fingerprint}")
+            self.host_key = key
+            transport.auth_password(self.username, self.passwd)
+        except BaseException:
+            transport.close()
+            raise
+        transport.set_keepalive(self.keepalive)
+        logger.info(f"SSH transport established to {self.host}:{self.port} (host key {key.fingerprint})")
+        return transport
+
+    def ensure_transport(self):
+        with self.lock:
+            if self.transport and self.transport.is_active():
+                return self.transport
+            if self.transport:
+                logger.warning(f"SSH transport to {self.host}:{self.port} lost; reconnecting")
+                self.transport.close()
+                self.transport = None
+            if time.monotonic() < self.retry_at:
+                raise self.error
+            try:
+                self.transport = self.connect()
+                self.backoff = 0
+            except (OSError, paramiko.SSHException) as e:
+                self.backoff = min(max(self.backoff * 2, 0.5), self.max_backoff)
+                self.retry_at = time.monotonic() + self.backoff
+                self.error = e
+                logger.warning(f"SSH connect to {self.host}:{self.port} failed: {e}; retrying in {self.backoff}s")
+                raise
+            return self.transport
+
+    def open_channel(self, host, port, origin):
+        for attempt in range(2):
+            transport = self.ensure_transport()
+            try:
+                return transport.open_channel('direct-tcpip', (host, port), origin, timeout=self.connect_timeout)
+            except paramiko.ChannelException:
+                raise
+            except (EOFError, paramiko.SSHException):
+                # The transport died between the check and the open; redial once.
+                if attempt:
+                    raise
+                transport.close()
+
+    def close(self):
+        with self.lock:
+            if self.transport:
+                self.transport.close()
+                self.transport = None
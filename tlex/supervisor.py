@@ -0,0 +1,139 @@
+import asyncio
+import os
+import signal
+import time
+from tlex.config import ConfigStore
+from tlex.utils import logger
+
+MAX_RESTART_DELAY = 30
+# A tunnel that stays up this long is considered healthy again.
+STABLE_UPTIME = 60
+
+class ManagedTunnel:
+    def __init__(self, record):
+        # The tunnel object is only built once the task starts it.
+        self.record = record
+        self.name = record.describe()
+        self.config = None
+        self.task = None
+        self.serving = False
+        self.removed = False
+
+    def holds_ports(self):
+        listeners = (getattr(self.config, 'listener', None), getattr(self.config, 'public_listener', None))
+        return self.serving and any(sock is not None and sock.fileno() != -1 for sock in listeners)
+
+class TunnelSupervisor:
+    # Runs every saved tunnel on one event loop, reloading the config file
+    # when it changes and draining on SIGTERM.
+    def __init__(self, config_file=None, reload_interval=2):
+        self.store = ConfigStore(config_file)
+        self.reload_interval = reload_interval
+        self.tunnels = {}
+        self.mtime = None
+        self.stopping = None
+        self.reload_requested = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.reload_requested = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, self.stopping.set)
+        loop.add_signal_handler(signal.SIGINT, self.stopping.set)
+        loop.add_signal_handler(signal.SIGHUP, self.reload_requested.set)
+        await self.reload()
+        while not self.stopping.is_set():
+            waiters = [asyncio.ensure_future(self.stopping.wait()), asyncio.ensure_future(self.reload_requested.wait())]
+            await asyncio.wait(waiters, timeout=self.reload_interval, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+            if self.stopping.is_set():
+                break
+            if self.reload_requested.is_set() or self.config_changed():
+                self.reload_requested.clear()
+                await self.reload()
+        logger.info(f"Stopping {len(self.tunnels)} tunnels")
+        for tunnel in self.tunnels.values():
+            self.stop_tunnel(tunnel)
+        await asyncio.gather(*(tunnel.task for tunnel in self.tunnels.values()), return_exceptions=True)
+        self.tunnels.clear()
+
+    def file_version(self):
+        # Updates replace the file, so the inode changes even when two
+        # writes land within the filesystem's timestamp resolution.
+        try:
+            st = os.stat(self.store.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_ino
+
+    def config_changed(self):
+        return self.file_version() != self.mtime
+
+    async def reload(self):
+        self.mtime = self.file_version()
+        try:
+            records = self.store.load(strict=True)
+        except Exception as e:
+            # Hand-edited files can be broken; the next change triggers another reload.
+            logger.error(f"Config load error: {e}; keeping the current tunnels")
+            return
+        wanted = {}
+        for record in records:
+            if record.protocol in ('wireguard', 'vless'):
+                logger.warning(f"Skipping {record.describe()}: external tunnels are not run headless")
+                continue
+            wanted[record.key()] = record
+        removed = [self.tunnels.pop(key) for key in list(self.tunnels) if key not in wanted]
+        for tunnel in removed:
+            logger.info(f"Config removed or changed; draining {tunnel.name}")
+            self.stop_tunnel(tunnel)
+        # Let replaced tunnels release their ports before their successors bind.
+        deadline = time.monotonic() + 1
+        while any(tunnel.holds_ports() for tunnel in removed) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        for key, record in wanted.items():
+            if key not in self.tunnels:
+                tunnel = ManagedTunnel(record)
+                tunnel.task = asyncio.create_task(self.run_tunnel(tunnel))
+                self.tunnels[key] = tunnel
+        logger.info(f"Running {len(self.tunnels)} tunnels")
+
+    def stop_tunnel(self, tunnel):
+        tunnel.removed = True
+        if tunnel.serving:
+            tunnel.config.stopping.set()
+        else:
+            tunnel.task.cancel()
+
+    async def run_tunnel(self, tunnel):
+        delay = 0.5
+        while not tunnel.removed:
+            started = time.monotonic()
+            try:
+                if tunnel.config is None:
+                    tunnel.config = tunnel.record.build()
+                    if getattr(tunnel.config, 'workers', 1) > 1:
+                        logger.warning(f"{tunnel.name}: workers are not used under the supervisor")
+                        tunnel.config.workers = 1
+                config = tunnel.config
+                config.listener = None
+                config.setup()
+                tunnel.serving = True
+                logger.info(f"Started {tunnel.name}")
+                await config.serve()
+            except Exception as e:
+                logger.error(f"{tunnel.name} failed: {e}")
+            finally:
+                tunnel.serving = False
+                if tunnel.config and tunnel.config.listener:
+                    tunnel.config.listener.close()
+            if tunnel.removed:
+                break
+            delay = 0.5 if time.monotonic() - started > STABLE_UPTIME else min(delay * 2, MAX_RESTART_DELAY)
+            logger.warning(f"Restarting {tunnel.name} in {delay}s")
+            await asyncio.sleep(delay)
+        logger.info(f"Stopped {tunnel.name}")
@@ -0,0 +1,75 @@
+import socket
+import ssl
+
+# AEAD suites with ECDHE only; AES-GCM first for CPUs with AES-NI, then
+# ChaCha20 for those without. TLS 1.3 suites are left to OpenSSL.
+DEFAULT_CIPHERS = 'ECDHE+AESGCM:ECDHE+CHACHA20'
+# Kernel TLS needs Python 3.12+ (OpenSSL built with kTLS) and the Linux tls
+# module; OpenSSL quietly stays in user space when either is missing.
+KTLS_SUPPORTED = hasattr(ssl, 'OP_ENABLE_KTLS')
+SOL_TLS = getattr(socket, 'SOL_TLS', 282)
+TLS_TX = getattr(socket, 'TLS_TX', 1)
+
+def tune_context(context, ciphers=DEFAULT_CIPHERS, ecdh_curve=None, ktls=False):
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.options |= ssl.OP_NO_COMPRESSION
+    # Tunnels half-close with a TCP FIN (AsyncSocket.write_eof); OpenSSL 3
+    # would otherwise fail the connection for writing back after it.
+    context.options |= getattr(ssl, 'OP_IGNORE_UNEXPECTED_EOF', 0)
+    if ciphers:
+        context.set_ciphers(ciphers)
+    if ecdh_curve:
+        context.set_ecdh_curve(ecdh_curve)
+    if ktls and KTLS_SUPPORTED:
+        context.options |= ssl.OP_ENABLE_KTLS
+    return context
+
+def ktls_send_active(sock):
+    # The kernel only answers for TLS_TX once OpenSSL has handed it the
+    # send keys; a 4-byte buffer returns just the version and cipher.
+    try:
+        sock.getsockopt(SOL_TLS, TLS_TX, 4)
+        return True
+    except OSError:
+        return False
+
+def create_server_context(cert_file, key_file, num_tickets=2, ciphers=DEFAULT_CIPHERS, ecdh_curve=None, ktls=False):
+    context = tune_context(ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER), ciphers, ecdh_curve, ktls)
+    context.load_cert_chain(certfile=cert_file, keyfile=key_file)
+    context.options |= ssl.OP_NO_RENEGOTIATION
+    if num_tickets > 0:
+        context.num_tickets = num_tickets
+    else:
+        context.options |= ssl.OP_NO_TICKET
+    return context
+
+def create_client_context(ca_cert=None, ciphers=DEFAULT_CIPHERS, ecdh_curve=None, ktls=False):
+    context = tune_context(ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT), ciphers, ecdh_curve, ktls)
+    if ca_cert:
+        context.load_verify_locations(ca_cert)
+        context.verify_mode = ssl.CERT_REQUIRED
+    else:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+class SessionCache:
+    def __init__(self):
+        self.sessions = {}
+        self.stats = {'handshakes': 0, 'resumed': 0}
+
+    def get(self, key):
+        return self.sessions.get(key)
+
+    def update(self, key, sock):
+        if not isinstance(sock, ssl.SSLSocket):
+            return
+        session = sock.session
+        # TLS 1.3 tickets arrive after the handshake; only keep usable ones.
+        if session is not None and session.has_ticket:
+            self.sessions[key] = session
+
+    def record(self, sock):
+        self.stats['handshakes'] += 1
+        if sock.session_reused:
+            self.stats['resumed'] += 1
@@ -10,13 +10,19 @@ from rich.progress import Progress
 from tlex.server import TunnelServer
 from tlex.client import TunnelClient
 from tlex.reverse import ReverseTunnelServer, ReverseTunnelClient
-from tlex.utils import ConfigManager, logger, test_connection, suggest_protocol
+from tlex.config import ConfigStore, TunnelConfig
+from tlex.probe import PathProber, parse_target, best_path, score
+from tlex.utils import logger, suggest_protocol
 import subprocess
 import threading
 import os
 import random
 
 console = Console()
+store = ConfigStore()
+prober = PathProber()
+# Tunnels started from this session, by config id, so they can be stopped.
+running = {}
 
 def show_logo():
     logo_text = Text()
@@ -61,20 +67,26 @@ def setup_tunnel():
     is_server = Confirm.ask("Is this for Server (Outside Iran)? (y/n)", default=True)
     is_reverse = Confirm.ask("Reverse Tunnel? (y/n)", default=False)
     use_ssl = Confirm.ask("Use SSL? (y/n)", default=True)
-    server_host = Prompt.ask("Server Host/IP for test")
-    server_port = int(Prompt.ask("Server Port for test", default="443"))
+    targets = Prompt.ask("Server Host/IP for test (host[:port], comma-separated to compare)")
+    targets = [parse_target(target) for target in targets.split(',') if target.strip()]
+    passwd = Prompt.ask("Enter strong password")
+    # A client probes its own tlex servers, which would take bare connects
+    # for a scanner; the password lets every sample authenticate.
+    path_prober = prober if is_server else PathProber(tls=use_ssl, passwd=passwd)
     with Progress() as progress:
-        task = progress.add_task("[cyan]Testing connection...", total=100)
-        success, latency = test_connection(server_host, server_port)
+        task = progress.add_task("[cyan]Probing paths...", total=100)
+        results = path_prober.run(targets)
         progress.update(task, advance=100)
-    if success:
-        protocol = suggest_protocol(latency)
-        console.print(f"[green]Connection test successful! Latency: {latency}ms. Suggested protocol: {protocol.upper()}[/green]")
+    show_probe_results(results)
+    best = best_path(results)
+    server_host, server_port = (best['host'], best['port']) if best else targets[0]
+    if best:
+        protocol = suggest_protocol(best)
+        console.print(f"[green]Best path {server_host}:{server_port} (connect p95 {best['connect_ms']['p95']}ms, loss {best['loss']:.0%}). Suggested protocol: {protocol.upper()}[/green]")
         protocol = Prompt.ask("Protocol (tls/plain/ssh/wireguard/vless)", default=protocol)
     else:
         console.print("[red]Connection test failed. Using default TLS.[/red]")
         protocol = 'tls'
-    passwd = Prompt.ask("Enter strong password")
     if is_server:
         listen_host = Prompt.ask("Listen Host", default="0.0.0.0")
         listen_port = int(Prompt.ask("Listen Port (recommend 443 for camouflage)", default="443"))
@@ -87,24 +99,31 @@ def setup_tunnel():
         else:
             cert_file = key_file = None
         if is_reverse:
-            config = ReverseTunnelServer(listen_host, listen_port, cert_file, key_file, passwd, use_ssl)
+            public_port = int(Prompt.ask("Public Port for users", default="8080"))
+            config = ReverseTunnelServer(listen_host, listen_port, cert_file, key_file, passwd, use_ssl, public_port=public_port)
         else:
             config = TunnelServer(listen_host, listen_port, cert_file, key_file, passwd, use_ssl, protocol)
     else:
         local_host = Prompt.ask("Local Host", default="127.0.0.1")
         local_port = int(Prompt.ask("Local Port (e.g., 8080)", default="8080"))
-        server_host = Prompt.ask("Server Host/IP")
-        server_port = int(Prompt.ask("Server Port (e.g., 443)", default="443"))
+        server_host = Prompt.ask("Server Host/IP", default=server_host)
+        server_port = int(Prompt.ask("Server Port (e.g., 443)", default=str(server_port)))
         remote_host = Prompt.ask("Remote Target Host (e.g., google.com)")
         remote_port = int(Prompt.ask("Remote Target Port (e.g., 80)", default="80"))
         if use_ssl:
             ca_cert = Prompt.ask("CA Cert Path (optional)")
         else:
             ca_cert = None
+        servers = None
+        usable = sorted((result for result in results if result.get('connect_ms') is not None), key=score)
+        if len(usable) > 1 and Confirm.ask(f"Fail over across all {len(usable)} reachable servers? (y/n)", default=True):
+            servers = [f"[{result['host']}]:{result['port']}" if ':' in result['host'] else f"{result['host']}:{result['port']}" for result in usable]
         if is_reverse:
-            config = ReverseTunnelClient(server_host, server_port, local_host, local_port, passwd, ca_cert, use_ssl)
+            config = ReverseTunnelClient(server_host, server_port, local_host, local_port, passwd, ca_cert, use_ssl, servers=servers)
         else:
-            config = TunnelClient(local_host, local_port, server_host, server_port, remote_host, remote_port, passwd, ca_cert, use_ssl, protocol)
+            udp = protocol in ('tls', 'plain') and Confirm.ask("Forward UDP too (DNS, QUIC, games)? (y/n)", default=False)
+            compression = 'auto' if protocol in ('tls', 'plain') and Confirm.ask("Compress traffic (helps text on slow links)? (y/n)", default=False) else None
+            config = TunnelClient(local_host, local_port, server_host, server_port, remote_host, remote_port, passwd, ca_cert, use_ssl, protocol, servers=servers, udp=udp, compression=compression)
     try:
         config.setup()
     except OSError as e:
@@ -118,22 +137,37 @@ def setup_tunnel():
         else:
             config.local_port = new_port
         config.setup()
-    configs = ConfigManager.load_configs()
-    if not isinstance(configs, list):
-        configs = [configs] if configs else []
-    configs.append(config)
-    ConfigManager.save_configs(configs)
-    console.print("[green]Tunnel added successfully! ✅[/green]")
+    record = TunnelConfig.from_tunnel(config)
+    store.add(record)
+    console.print(f"[green]Tunnel {record.id} added successfully! ✅[/green]")
     if Confirm.ask("Start now (as daemon)?"):
         start_as_service(config)
     elif Confirm.ask("Start in foreground?"):
+        running[record.id] = config
         threading.Thread(target=config.run, daemon=True).start()
         console.print("[green]Tunnel started in foreground! Press Ctrl+C to stop.[/green]")
 
+def show_probe_results(results):
+    table = Table(title="Path Probe", box=box.ROUNDED, border_style="bold green")
+    for column in ("Target", "Loss", "Connect p50/p95", "Jitter", "TLS p50/p95", "Throughput"):
+        table.add_column(column)
+    for result in results:
+        connect, tls = result.get('connect_ms'), result.get('tls_ms')
+        throughput = result.get('throughput_mbps')
+        table.add_row(
+            f"{result['host']}:{result['port']}",
+            f"{result['loss']:.0%}",
+            f"{connect['p50']}/{connect['p95']} ms" if connect else result.get('error', "-"),
+            f"{result['jitter_ms']} ms" if connect else "-",
+            f"{tls['p50']}/{tls['p95']} ms" if tls else "-",
+            f"{throughput} Mbit/s" if throughput else "-",
+        )
+    console.print(table)
+
 def manage_tunnels():
     console.clear()
     show_logo()
-    configs = ConfigManager.load_configs()
+    configs = store.load()
     if not configs:
         console.print("[red]No tunnels configured! ⚠️[/red]")
         return
@@ -141,31 +175,36 @@ def manage_tunnels():
     table.add_column("ID", style="cyan")
     table.add_column("Type", style="magenta")
     table.add_column("Details", style="green")
-    for i, conf in enumerate(configs):
-        typ = "Server" if isinstance(conf, TunnelServer) or isinstance(conf, ReverseTunnelServer) else "Client"
-        rev = "Reverse" if conf.is_reverse else ""
-        ssl = "SSL" if conf.use_ssl else "No SSL"
-        port = conf.listen_port if hasattr(conf, 'listen_port') else conf.local_port
-        details = f"{typ} {rev} {ssl} - Port: {port}"
-        table.add_row(str(i), typ, details)
+    for conf in configs:
+        typ = "Server" if conf.kind.endswith('server') else "Client"
+        rev = "Reverse" if conf.kind.startswith('reverse') else ""
+        ssl = "SSL" if conf.options.get('use_ssl', True) else "No SSL"
+        details = f"{typ} {rev} {ssl} - Port: {conf.port}"
+        table.add_row(conf.id, typ, details)
     console.print(table)
     action = Prompt.ask("[bold blue]Action (start <id>, stop <id>, delete <id>, service <id>, back): [/bold blue]")
+    parts = action.split()
+    if len(parts) > 1 and store.get(parts[1]) is None:
+        show_error(f"No tunnel with ID {parts[1]}")
+        return
     if action.startswith("start"):
-        id_ = int(action.split()[1])
-        threading.Thread(target=configs[id_].run, daemon=True).start()
+        id_ = parts[1]
+        # Objects are only built here, when a tunnel is actually started.
+        running[id_] = store.get(id_).build()
+        threading.Thread(target=running[id_].run, daemon=True).start()
         console.print("[green]Started! ✅[/green]")
     elif action.startswith("stop"):
-        id_ = int(action.split()[1])
-        configs[id_].stop()
+        id_ = parts[1]
+        if id_ in running:
+            running.pop(id_).stop()
         console.print("[yellow]Stopped! 🛑[/yellow]")
     elif action.startswith("delete"):
-        id_ = int(action.split()[1])
-        del configs[id_]
-        ConfigManager.save_configs(configs)
+        id_ = parts[1]
+        store.remove(id_)
         console.print("[red]Deleted! ❌[/red]")
     elif action.startswith("service"):
-        id_ = int(action.split()[1])
-        start_as_service(configs[id_])
+        id_ = parts[1]
+        start_as_service(store.get(id_))
         console.print("[green]Installed as service (always active)! 🔄[/green]")
 
 def get_ssl(domain):
@@ -176,14 +215,16 @@ def get_ssl(domain):
         show_error(f"Error generating SSL: {e} ⚠️")
 
 def start_as_service(config):
-    service_name = f"tlex_tunnel_{id(config)}.service"
+    # One service runs every saved tunnel and picks up config changes itself.
+    service_name = "tlex.service"
     service_content = f"""
 [Unit]
 Description=T-LeX Tunnel Service
 After=network.target
 
 [Service]
-ExecStart=/usr/bin/python3 -m tlex.main --run-config {id(config)}  # Placeholder, implement if needed
+ExecStart=/usr/bin/python3 -m tlex.main serve --config {store.path}
+ExecReload=/bin/kill -HUP $MAINPID
 Restart=always
 User=root
 
@@ -0,0 +1,284 @@
+import asyncio
+import socket
+import struct
+import time
+from tlex.utils import BUFFER_SIZE, logger
+
+# UDP association: after the handshake both directions carry records of
+#   session id (4) | length (2) | datagram
+# where the client assigns one session id per local source address.
+RECORD = struct.Struct('>IH')
+MAX_DATAGRAM = 65507
+# Datagrams read per readiness callback, so a burst becomes one tunnel write.
+RECV_BATCH = 64
+# Datagrams are dropped rather than queued past this much unsent data.
+HIGH_WATER = 1024 * 1024
+# Datagrams held while the association is being dialed.
+MAX_PENDING = 256
+# Socket buffers sized for bursts; the kernel caps them at rmem_max/wmem_max.
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+def tune_socket(sock):
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        except OSError:
+            pass
+
+def read_datagrams(sock, handler, limit=RECV_BATCH):
+    for _ in range(limit):
+        try:
+            data, addr = sock.recvfrom(MAX_DATAGRAM)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            # ICMP errors (port unreachable) surface on the next read.
+            logger.debug(f"UDP receive error: {e}")
+            return
+        handler(data, addr)
+
+class DatagramChannel:
+    # Carries session-tagged datagrams over one tunnel connection. Records
+    # queued during a loop iteration are written with a single sendall.
+    def __init__(self, conn, handler, metrics=None, upstream=True):
+        self.conn = conn
+        self.handler = handler
+        self.metrics = metrics
+        self.sent_key = 'bytes_upstream_total' if upstream else 'bytes_downstream_total'
+        self.received_key = 'bytes_downstream_total' if upstream else 'bytes_upstream_total'
+        self.outgoing = []
+        self.pending = 0
+        self.has_outgoing = asyncio.Event()
+        self.closed = False
+
+    def send(self, session_id, data):
+        if self.closed or self.pending > HIGH_WATER:
+            if self.metrics:
+                self.metrics.inc('udp_dropped_total')
+            return
+        self.outgoing.append(RECORD.pack(session_id, len(data)))
+        self.outgoing.append(data)
+        self.pending += RECORD.size + len(data)
+        self.has_outgoing.set()
+
+    async def write_loop(self):
+        try:
+            while not self.closed:
+                await self.has_outgoing.wait()
+                self.has_outgoing.clear()
+                while self.outgoing:
+                    data = b''.join(self.outgoing)
+                    self.outgoing.clear()
+                    await self.conn.sendall(data)
+                    self.pending -= len(data)
+                    if self.metrics:
+                        self.metrics.inc(self.sent_key, len(data))
+        except Exception as e:
+            if not self.closed:
+                logger.error(f"UDP tunnel write error: {e}")
+            self.close()
+
+    async def run(self):
+        writer_task = asyncio.create_task(self.write_loop())
+        buffer = bytearray()
+        try:
+            while not self.closed:
+                data = await self.conn.recv(BUFFER_SIZE)
+                if not data:
+                    break
+                if self.metrics:
+                    self.metrics.inc(self.received_key, len(data))
+                buffer += data
+                offset = 0
+                while len(buffer) - offset >= RECORD.size:
+                    session_id, length = RECORD.unpack_from(buffer, offset)
+                    end = offset + RECORD.size + length
+                    if end > len(buffer):
+                        break
+                    self.handler(session_id, bytes(buffer[offset + RECORD.size:end]))
+                    offset = end
+                del buffer[:offset]
+        except ConnectionError:
+            pass
+        except Exception as e:
+            if not self.closed:
+                logger.error(f"UDP tunnel read error: {e}")
+        finally:
+            self.close()
+            await asyncio.gather(writer_task, return_exceptions=True)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.has_outgoing.set()
+        self.conn.close()
+
+class UdpForwarder:
+    # Client side: one local UDP socket, one tunnel connection shared by all
+    # sources, dialed on the first datagram and again after it drops.
+    def __init__(self, sock, dial, idle_timeout=60, metrics=None):
+        self.sock = sock
+        self.dial = dial
+        self.idle_timeout = idle_timeout
+        self.metrics = metrics
+        self.loop = None
+        self.sessions = {}
+        self.sources = {}
+        self.next_id = 1
+        self.channel = None
+        self.pending = []
+        self.connect_task = None
+        self.reap_task = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.sock.setblocking(False)
+        tune_socket(self.sock)
+        self.loop.add_reader(self.sock.fileno(), read_datagrams, self.sock, self.received)
+        self.reap_task = asyncio.create_task(self.reap_loop())
+
+    def received(self, data, addr):
+        session = self.sessions.get(addr)
+        if session is None:
+            session = self.sessions[addr] = [self.next_id, 0]
+            self.sources[self.next_id] = addr
+            self.next_id = self.next_id % 0xffffffff + 1
+        session[1] = time.monotonic()
+        if self.channel and not self.channel.closed:
+            self.channel.send(session[0], data)
+            return
+        if len(self.pending) < MAX_PENDING:
+            self.pending.append((session[0], data))
+        elif self.metrics:
+            self.metrics.inc('udp_dropped_total')
+        if self.connect_task is None:
+            self.connect_task = asyncio.create_task(self.connect())
+
+    def reply(self, session_id, data):
+        addr = self.sources.get(session_id)
+        if addr is None:
+            return
+        try:
+            self.sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            if self.metrics:
+                self.metrics.inc('udp_dropped_total')
+        except OSError as e:
+            logger.debug(f"UDP send to {addr} failed: {e}")
+
+    async def connect(self):
+        channel = None
+        try:
+            conn = await self.dial()
+            if conn is None:
+                raise ConnectionError("UDP association refused")
+            channel = self.channel = DatagramChannel(conn, self.reply, self.metrics)
+            for session_id, data in self.pending:
+                channel.send(session_id, data)
+        except Exception as e:
+            logger.warning(f"UDP association failed: {e}; dropped {len(self.pending)} datagrams")
+            if self.metrics:
+                self.metrics.inc('connect_errors_total')
+                self.metrics.inc('udp_dropped_total', len(self.pending))
+        finally:
+            self.pending = []
+            self.connect_task = None
+        if channel:
+            await channel.run()
+
+    async def reap_loop(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 4, 1))
+            cutoff = time.monotonic() - self.idle_timeout
+            for addr, (session_id, last_used) in list(self.sessions.items()):
+                if last_used < cutoff:
+                    del self.sessions[addr]
+                    del self.sources[session_id]
+            if self.metrics:
+                self.metrics.set('udp_sessions_active', len(self.sessions))
+            # Nothing left to carry: let the association go until the next datagram.
+            if not self.sessions and self.channel:
+                self.channel.close()
+                self.channel = None
+
+    def close(self):
+        if self.loop:
+            self.loop.remove_reader(self.sock.fileno())
+        for task in (self.connect_task, self.reap_task):
+            if task:
+                task.cancel()
+        if self.channel:
+            self.channel.close()
+        self.sock.close()
+
+class UdpAssociation:
+    # Server side: a connected UDP socket per client session, so replies come
+    # only from the target and map straight back to the session.
+    def __init__(self, conn, family, address, idle_timeout=60, max_sessions=1024, metrics=None):
+        self.family = family
+        self.address = address
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.metrics = metrics
+        self.loop = asyncio.get_running_loop()
+        self.sessions = {}
+        self.channel = DatagramChannel(conn, self.received, metrics, upstream=False)
+
+    def received(self, session_id, data):
+        session = self.sessions.get(session_id)
+        if session is None:
+            if len(self.sessions) >= self.max_sessions:
+                if self.metrics:
+                    self.metrics.inc('udp_dropped_total')
+                return
+            try:
+                session = self.open(session_id)
+            except OSError as e:
+                logger.warning(f"UDP session to {self.address} failed: {e}")
+                if self.metrics:
+                    self.metrics.inc('connect_errors_total')
+                return
+        session[1] = time.monotonic()
+        try:
+            session[0].send(data)
+        except (BlockingIOError, InterruptedError):
+            if self.metrics:
+                self.metrics.inc('udp_dropped_total')
+        except OSError as e:
+            logger.debug(f"UDP send to {self.address} failed: {e}")
+
+    def open(self, session_id):
+        sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            tune_socket(sock)
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        self.loop.add_reader(sock.fileno(), read_datagrams, sock, lambda data, addr: self.channel.send(session_id, data))
+        session = self.sessions[session_id] = [sock, 0]
+        return session
+
+    def close_session(self, session_id):
+        sock, _ = self.sessions.pop(session_id)
+        self.loop.remove_reader(sock.fileno())
+        sock.close()
+
+    async def reap_loop(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 4, 1))
+            cutoff = time.monotonic() - self.idle_timeout
+            for session_id, (sock, last_used) in list(self.sessions.items()):
+                if last_used < cutoff:
+                    self.close_session(session_id)
+
+    async def run(self):
+        reap_task = asyncio.create_task(self.reap_loop())
+        try:
+            await self.channel.run()
+        finally:
+            reap_task.cancel()
+            for session_id in list(self.sessions):
+                self.close_session(session_id)
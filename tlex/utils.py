@@ -1,25 +1,105 @@
 # tlex/utils.py
 import socket
 import ssl
-import threading
-import json
-import jsonpickle
 import os
 import logging
 import asyncio
 import time
-import random
 import subprocess
-from cryptography.hazmat.primitives.asymmetric import x25519
-from cryptography.hazmat.primitives import serialization
 import base64
+import errno
+from tlex.logs import Throttle
+from tlex.tls import ktls_send_active
 
 BUFFER_SIZE = 4096
+MAX_BUFFER_SIZE = 256 * 1024
+SPLICE_SIZE = 64 * 1024
+WRITE_HIGH_WATER = 256 * 1024
+WRITE_LOW_WATER = 64 * 1024
+# SSH defaults live here so tunnel configs can use them without loading paramiko.
+SSH_WINDOW_SIZE = 4 * 1024 * 1024
+SSH_MAX_PACKET_SIZE = 32 * 1024
+# Relay errors are counted in metrics; only a few per second are logged.
+PIPE_ERROR_RATE = 5
+# Keepalive probes start after a tunnel's tcp_keepalive idle seconds; a peer
+# that misses KEEPALIVE_PROBES of them, KEEPALIVE_INTERVAL apart, is dead.
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_PROBES = 6
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Handlers are installed by tlex.logs.setup_logging (see main).
 logger = logging.getLogger(__name__)
 
+def configure_socket(sock, nodelay=True, keepalive=60, buffer_size=0):
+    # TCP options for accepted and dialed sockets. Options the platform
+    # lacks are skipped; the connection works without them.
+    options = []
+    if nodelay:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+    if keepalive:
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        for name, value in (('TCP_KEEPIDLE', int(keepalive)), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL), ('TCP_KEEPCNT', KEEPALIVE_PROBES)):
+            if hasattr(socket, name):
+                options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    if buffer_size:
+        # Fixed sizes turn off the kernel's buffer autotuning.
+        options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size))
+        options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size))
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError:
+            pass
+
+def write_eof(conn):
+    # Half-close: the peer reads EOF while the other direction keeps going.
+    write_eof = getattr(conn, 'write_eof', None)
+    if write_eof:
+        write_eof()
+
+class Activity:
+    # Shared by both directions of a relay; each chunk stamps it and the
+    # IdleReaper closes relays whose stamp has gone stale.
+    __slots__ = ('last', 'conns', 'reaped')
+
+    def __init__(self, conns):
+        self.last = time.monotonic()
+        self.conns = conns
+        self.reaped = False
+
+class IdleReaper:
+    # Closes relays that moved no data for idle_timeout seconds, whether the
+    # peers are gone without a FIN or one side left the other half-open.
+    def __init__(self, idle_timeout=300, metrics=None):
+        self.idle_timeout = idle_timeout
+        self.metrics = metrics
+        self.relays = set()
+
+    def track(self, *conns):
+        if not self.idle_timeout:
+            return None
+        activity = Activity(conns)
+        self.relays.add(activity)
+        return activity
+
+    def release(self, activity):
+        self.relays.discard(activity)
+
+    async def run(self):
+        while self.idle_timeout:
+            await asyncio.sleep(max(self.idle_timeout / 4, 1))
+            cutoff = time.monotonic() - self.idle_timeout
+            for activity in [activity for activity in self.relays if activity.last < cutoff]:
+                activity.reaped = True
+                self.relays.discard(activity)
+                for conn in activity.conns:
+                    conn.close()
+                if self.metrics:
+                    self.metrics.inc('idle_reaped_total')
+
 class PipeHandler:
+    use_splice = hasattr(os, 'splice')
+    error_log = Throttle(PIPE_ERROR_RATE)
+
     @staticmethod
     async def async_pipe(src, dst):
         loop = asyncio.get_running_loop()
@@ -27,10 +107,15 @@ class PipeHandler:
             try:
                 data = await loop.sock_recv(src, BUFFER_SIZE)
                 if len(data) == 0:
+                    try:
+                        dst.shutdown(socket.SHUT_WR)
+                    except OSError:
+                        pass
                     break
                 await loop.sock_sendall(dst, data)
             except Exception as e:
-                logger.error(f"Pipe error: {e}")
+                if PipeHandler.error_log.allow():
+                    logger.error(f"Pipe error: {e}")
                 break
 
     @staticmethod
@@ -43,28 +128,320 @@ class PipeHandler:
         ))
         loop.close()
 
-class ConfigManager:
-    CONFIG_FILE = os.path.expanduser('~/tlex_configs.json')
+    @staticmethod
+    def pipe_error(e, metrics=None, activity=None):
+        if activity and activity.reaped:
+            return
+        if PipeHandler.error_log.allow():
+            logger.error(f"Pipe error: {e}")
+        if metrics:
+            metrics.inc('relay_errors_total', type=type(e).__name__)
 
     @staticmethod
-    def load_configs():
-        if os.path.exists(ConfigManager.CONFIG_FILE):
-            with open(ConfigManager.CONFIG_FILE, 'r') as f:
+    async def stream_pipe(src, dst, metrics=None, direction='upstream', activity=None):
+        # One reusable buffer per direction: starts at BUFFER_SIZE for
+        # interactive traffic and doubles while reads keep filling it.
+        buf = memoryview(bytearray(BUFFER_SIZE))
+        small_reads = 0
+        bytes_key = metrics.counter(f"bytes_{direction}_total") if metrics else None
+        try:
+            while True:
+                size = await src.recv_into(buf)
+                if size == 0:
+                    break
+                if activity:
+                    activity.last = time.monotonic()
+                await dst.sendall(buf[:size])
+                if bytes_key:
+                    metrics.add(bytes_key, size)
+                if size == len(buf) and len(buf) < MAX_BUFFER_SIZE:
+                    buf = memoryview(bytearray(len(buf) * 2))
+                    small_reads = 0
+                elif size < len(buf) // 8 and len(buf) > BUFFER_SIZE:
+                    small_reads += 1
+                    if small_reads >= 16:
+                        buf = memoryview(bytearray(len(buf) // 2))
+                        small_reads = 0
+            await dst.drain()
+            write_eof(dst)
+        except Exception as e:
+            PipeHandler.pipe_error(e, metrics, activity)
+
+    @staticmethod
+    def can_splice(src, dst):
+        # A TLS socket can take spliced plaintext once the kernel encrypts
+        # its records (kTLS); reads still go through OpenSSL.
+        return PipeHandler.use_splice and all(isinstance(conn, AsyncSocket) for conn in (src, dst)) \
+            and not isinstance(src.sock, ssl.SSLSocket) and (dst.ktls_send or not isinstance(dst.sock, ssl.SSLSocket))
+
+    @staticmethod
+    async def splice_pipe(src, dst, metrics=None, direction='upstream', activity=None):
+        # Kernel-side copy socket -> pipe -> socket; payload never reaches Python.
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        bytes_key = metrics.counter(f"bytes_{direction}_total") if metrics else None
+        if src.buffer:
+            data = bytes(src.buffer)
+            src.buffer.clear()
+            await dst.sendall(data)
+            if bytes_key:
+                metrics.add(bytes_key, len(data))
+        await dst.drain()
+        read_fd, write_fd = os.pipe()
+        spliced = False
+        try:
+            while True:
                 try:
-                    json_data = json.load(f)
-                    configs = jsonpickle.decode(json.dumps(json_data))
-                    if not isinstance(configs, list):
-                        configs = [configs]
-                    return configs
-                except Exception as e:
-                    logger.error(f"Config load error: {e}")
-                    return []
-        return []
+                    size = os.splice(src.sock.fileno(), write_fd, SPLICE_SIZE, flags=flags)
+                except (BlockingIOError, InterruptedError):
+                    await src.wait_readable()
+                    continue
+                if size == 0:
+                    break
+                spliced = True
+                if activity:
+                    activity.last = time.monotonic()
+                if bytes_key:
+                    metrics.add(bytes_key, size)
+                while size > 0:
+                    try:
+                        size -= os.splice(read_fd, dst.sock.fileno(), size, flags=flags)
+                    except (BlockingIOError, InterruptedError):
+                        await dst.wait_writable()
+            write_eof(dst)
+        except OSError as e:
+            if e.errno in (errno.EINVAL, errno.ENOSYS) and not spliced:
+                await PipeHandler.stream_pipe(src, dst, metrics, direction, activity)
+            else:
+                PipeHandler.pipe_error(e, metrics, activity)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
 
     @staticmethod
-    def save_configs(configs):
-        with open(ConfigManager.CONFIG_FILE, 'w') as f:
-            json.dump(jsonpickle.encode(configs), f, indent=4)
+    def pipe(src, dst, metrics=None, direction='upstream', activity=None):
+        if PipeHandler.can_splice(src, dst):
+            return PipeHandler.splice_pipe(src, dst, metrics, direction, activity)
+        return PipeHandler.stream_pipe(src, dst, metrics, direction, activity)
+
+    @staticmethod
+    async def relay(conn1, conn2, metrics=None, reaper=None):
+        # conn1 is the side closer to the tunnel client, so conn1 -> conn2 is upstream.
+        activity = reaper.track(conn1, conn2) if reaper else None
+        try:
+            await asyncio.gather(PipeHandler.pipe(conn1, conn2, metrics, 'upstream', activity), PipeHandler.pipe(conn2, conn1, metrics, 'downstream', activity))
+        finally:
+            if activity:
+                reaper.release(activity)
+
+class AsyncSocket:
+    # Non-blocking socket (plain or SSL) driven by the running event loop.
+    # loop.sock_* refuse SSLSocket, so readiness is awaited directly here.
+    def __init__(self, sock):
+        sock.setblocking(False)
+        self.sock = sock
+        self.loop = asyncio.get_running_loop()
+        self.buffer = bytearray()
+        self.read_waiters = []
+        self.write_waiters = []
+        self.write_buffer = bytearray()
+        self.drain_waiters = []
+        self.flush_task = None
+        self.write_error = None
+        self.high_water = WRITE_HIGH_WATER
+        self.low_water = WRITE_LOW_WATER
+        self.ktls_send = False
+        self.closed = False
+
+    def _wake(self, waiters, remove):
+        remove(self.sock.fileno())
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+        waiters.clear()
+
+    def wait_readable(self):
+        fut = self.loop.create_future()
+        if not self.read_waiters:
+            self.loop.add_reader(self.sock.fileno(), self._wake, self.read_waiters, self.loop.remove_reader)
+        self.read_waiters.append(fut)
+        return fut
+
+    def wait_writable(self):
+        fut = self.loop.create_future()
+        if not self.write_waiters:
+            self.loop.add_writer(self.sock.fileno(), self._wake, self.write_waiters, self.loop.remove_writer)
+        self.write_waiters.append(fut)
+        return fut
+
+    async def _retry(self, op, *args, writing=False):
+        while True:
+            try:
+                return op(*args)
+            except (BlockingIOError, InterruptedError):
+                await (self.wait_writable() if writing else self.wait_readable())
+            except ssl.SSLWantReadError:
+                await self.wait_readable()
+            except ssl.SSLWantWriteError:
+                await self.wait_writable()
+
+    async def start_tls(self, context, server_side=False, server_hostname=None, session=None):
+        self.sock = context.wrap_socket(self.sock, server_side=server_side, server_hostname=server_hostname, do_handshake_on_connect=False, session=session)
+        await self._retry(self.sock.do_handshake)
+        if context.options & getattr(ssl, 'OP_ENABLE_KTLS', 0):
+            self.ktls_send = ktls_send_active(self.sock)
+
+    async def recv(self, size):
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        return await self._retry(self.sock.recv, size)
+
+    def unread(self, data):
+        self.buffer[:0] = data
+
+    def recv_nowait(self, size):
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        try:
+            return self.sock.recv(size)
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return b''
+
+    async def recv_into(self, view):
+        if self.buffer:
+            size = min(len(view), len(self.buffer))
+            view[:size] = self.buffer[:size]
+            del self.buffer[:size]
+            return size
+        return await self._retry(self.sock.recv_into, view)
+
+    async def readexactly(self, size):
+        while len(self.buffer) < size:
+            data = await self._retry(self.sock.recv, max(size - len(self.buffer), BUFFER_SIZE))
+            if len(data) == 0:
+                raise asyncio.IncompleteReadError(bytes(self.buffer), size)
+            self.buffer += data
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def sendall(self, data):
+        # Writes go straight to the socket; whatever the kernel does not take
+        # is copied to write_buffer and flushed in the background, so callers
+        # may reuse their buffer and only wait above the high-water mark.
+        if self.write_error:
+            raise self.write_error
+        if self.write_buffer:
+            self.write_buffer += data
+        else:
+            view = memoryview(data)
+            while view:
+                try:
+                    view = view[self.sock.send(view):]
+                except (BlockingIOError, InterruptedError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                    self.write_buffer += view
+                    self.flush_task = self.loop.create_task(self._flush())
+                    break
+        while len(self.write_buffer) > self.high_water and not self.write_error:
+            fut = self.loop.create_future()
+            self.drain_waiters.append(fut)
+            await fut
+        if self.write_error:
+            raise self.write_error
+
+    async def _flush(self):
+        try:
+            while self.write_buffer:
+                sent = await self._retry(self.sock.send, self.write_buffer, writing=True)
+                del self.write_buffer[:sent]
+                if len(self.write_buffer) <= self.low_water:
+                    self._wake_drain()
+        except Exception as e:
+            self.write_error = e
+        finally:
+            self.flush_task = None
+            self._wake_drain()
+
+    def _wake_drain(self):
+        for fut in self.drain_waiters:
+            if not fut.done():
+                fut.set_result(None)
+        self.drain_waiters.clear()
+
+    async def drain(self):
+        while self.write_buffer and not self.write_error:
+            fut = self.loop.create_future()
+            self.drain_waiters.append(fut)
+            await fut
+        if self.write_error:
+            raise self.write_error
+
+    def is_alive(self):
+        if self.closed:
+            return False
+        try:
+            if isinstance(self.sock, ssl.SSLSocket):
+                data = self.sock.recv(BUFFER_SIZE)
+                self.buffer += data
+            else:
+                data = self.sock.recv(1, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return True
+        except OSError:
+            return False
+        return len(data) > 0
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def write_eof(self):
+        # Callers drain first. On TLS this is a bare TCP FIN, not a
+        # close_notify: SSLSocket.shutdown would also end reading, and the
+        # peer's recv already treats the FIN as EOF.
+        if self.closed:
+            return
+        try:
+            socket.socket.shutdown(self.sock, socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for waiters, remove in ((self.read_waiters, self.loop.remove_reader), (self.write_waiters, self.loop.remove_writer)):
+            if waiters:
+                remove(self.sock.fileno())
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_result(None)
+            waiters.clear()
+        if self.flush_task:
+            self.flush_task.cancel()
+        self.write_error = self.write_error or ConnectionResetError("Socket closed")
+        self._wake_drain()
+        self.sock.close()
+
+async def open_connection(host, port):
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    error = OSError(f"No address found for {host}:{port}")
+    for family, type_, proto, _, addr in infos:
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, addr)
+            return AsyncSocket(sock)
+        except OSError as e:
+            sock.close()
+            error = e
+        except BaseException:
+            sock.close()
+            raise
+    raise error
 
 def test_connection(host, port, protocol='tcp'):
     start = time.time()
@@ -79,6 +456,15 @@ def test_connection(host, port, protocol='tcp'):
         return False, 0
 
 def suggest_protocol(latency):
+    # Takes a latency in ms or a PathProber result; results are judged on
+    # tail latency, loss and TLS reachability instead of one connect.
+    if isinstance(latency, dict):
+        result = latency
+        if result.get('tls_failures', 0) > 0.1 * result['samples']:
+            return 'ssh'  # TCP gets through but TLS handshakes do not
+        if result['loss'] > 0.1:
+            return 'ssh'  # One persistent transport instead of a handshake per connection
+        latency = result['connect_ms']['p95']
     if latency < 50:
         return 'wireguard'  # Fast for low latency
     elif latency < 100:
@@ -89,6 +475,8 @@ def suggest_protocol(latency):
         return 'ssh'  # Reliable for high latency
 
 def generate_x25519_keys():
+    from cryptography.hazmat.primitives.asymmetric import x25519
+    from cryptography.hazmat.primitives import serialization
     private_key = x25519.X25519PrivateKey.generate()
     private_bytes = private_key.private_bytes(encoding=serialization.Encoding.Raw, format=serialization.PrivateFormat.Raw, encryption_algorithm=serialization.NoEncryption())
     private_b64 = base64.b64encode(private_bytes).decode()
@@ -0,0 +1,110 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from tlex.utils import logger
+
+STATS_INTERVAL = 2
+MAX_RESTART_DELAY = 30
+# A worker that stays up this long is considered healthy again.
+STABLE_UPTIME = 60
+
+def worker_main(server, index, stats_queue):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server.supervisor = None
+    server.listener = None
+    server.setup()
+    asyncio.run(run_worker(server, index, stats_queue))
+
+async def run_worker(server, index, stats_queue):
+    loop = asyncio.get_running_loop()
+    serve_task = asyncio.create_task(server.serve())
+    await asyncio.sleep(0)
+    loop.add_signal_handler(signal.SIGTERM, server.stopping.set)
+    while not serve_task.done():
+        await asyncio.wait({serve_task}, timeout=STATS_INTERVAL)
+        stats_queue.put((index, os.getpid(), server.snapshot()))
+    serve_task.result()
+
+class WorkerSupervisor:
+    def __init__(self, server, workers, drain_timeout=30):
+        self.server = server
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.context = multiprocessing.get_context('fork')
+        self.stats_queue = self.context.Queue()
+        self.processes = {}
+        self.started = {}
+        self.delays = {}
+        self.restart_at = {}
+        self.worker_stats = {}
+        self.restarts = 0
+        self.stopping = False
+
+    def spawn(self, index):
+        process = self.context.Process(target=worker_main, args=(self.server, index, self.stats_queue), name=f"tlex-worker-{index}", daemon=True)
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+        logger.info(f"Worker {index} started (pid {process.pid})")
+
+    def run(self):
+        for index in range(self.workers):
+            self.spawn(index)
+        while not self.stopping:
+            self.collect_stats(timeout=1)
+            self.check_workers()
+        self.shutdown()
+
+    def collect_stats(self, timeout=0):
+        try:
+            while True:
+                index, pid, stats = self.stats_queue.get(timeout=timeout)
+                self.worker_stats[index] = stats
+                timeout = 0
+        except queue.Empty:
+            pass
+
+    def check_workers(self):
+        now = time.monotonic()
+        for index, process in list(self.processes.items()):
+            if process.is_alive() or self.stopping:
+                continue
+            if index not in self.restart_at:
+                uptime = now - self.started[index]
+                delay = 1 if uptime > STABLE_UPTIME else min(self.delays.get(index, 0.5) * 2, MAX_RESTART_DELAY)
+                self.delays[index] = delay
+                self.restart_at[index] = now + delay
+                self.worker_stats.pop(index, None)
+                logger.error(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}; restarting in {delay}s")
+            elif now >= self.restart_at[index]:
+                del self.restart_at[index]
+                process.close()
+                self.restarts += 1
+                self.spawn(index)
+
+    def stats(self):
+        self.collect_stats()
+        totals = {'workers_alive': sum(p.is_alive() for p in self.processes.values()), 'worker_restarts_total': self.restarts}
+        for stats in self.worker_stats.values():
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def stop(self):
+        self.stopping = True
+
+    def shutdown(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.drain_timeout + 5
+        for index, process in self.processes.items():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not drain in time; killing it")
+                process.kill()
+                process.join()
+        self.collect_stats()